@@ -0,0 +1,102 @@
+import torch
+
+
+class CompactMask:
+    """
+    紧凑蒙版批次（COMPACT_MASK类型）
+    每个蒙版只保存包围盒 (x, y, w, h) 和包围盒内量化为uint8的位图，
+    只有在需要普通MASK时才解码为 [N,H,W] 浮点张量
+    """
+
+    def __init__(self, height, width, bboxes=None, bitmaps=None, device=None):
+        self.height = height
+        self.width = width
+        self.bboxes = bboxes if bboxes is not None else []
+        self.bitmaps = bitmaps if bitmaps is not None else []
+        self.device = device if device is not None else torch.device('cpu')
+
+    @classmethod
+    def empty(cls, count, height, width, device=None):
+        """创建count个空蒙版，用于逐个写入"""
+        device = device if device is not None else torch.device('cpu')
+        return cls(height, width, [(0, 0, 0, 0)] * count,
+                   [torch.zeros((0, 0), dtype=torch.uint8, device=device)] * count, device)
+
+    @classmethod
+    def from_segments(cls, segments, height, width, offsets=None, device=None):
+        """
+        由分割区域创建
+        - offsets: 可选，每个区域所在画布左上角在原图中的位置（裁剪模式）
+        """
+        result = cls.empty(0, height, width, device)
+        for i, seg in enumerate(segments):
+            ox, oy = offsets[i] if offsets is not None else (0, 0)
+            bitmap = torch.as_tensor(seg.roi).to(result.device, torch.uint8) * 255
+            result.bboxes.append((seg.x - ox, seg.y - oy, seg.w, seg.h))
+            result.bitmaps.append(bitmap)
+        return result
+
+    @classmethod
+    def from_dense(cls, masks):
+        """由 [N,H,W] 或 [H,W] 的MASK创建"""
+        if len(masks.shape) == 2:
+            masks = masks.unsqueeze(0)
+        result = cls.empty(masks.shape[0], masks.shape[1], masks.shape[2], masks.device)
+        for i in range(masks.shape[0]):
+            result.set(i, masks[i])
+        return result
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def __getitem__(self, index):
+        """切片返回新的CompactMask（共享位图）"""
+        if isinstance(index, slice):
+            return CompactMask(self.height, self.width, self.bboxes[index], self.bitmaps[index], self.device)
+        return CompactMask(self.height, self.width, [self.bboxes[index]], [self.bitmaps[index]], self.device)
+
+    @property
+    def nbytes(self):
+        return sum(bitmap.numel() for bitmap in self.bitmaps)
+
+    def set(self, index, mask):
+        """将 [H,W] 或 [1,H,W] 的蒙版编码后写入第index个位置"""
+        if len(mask.shape) == 3:
+            mask = mask[0]
+        assert tuple(mask.shape) == (self.height, self.width), \
+            f"Mask shape {tuple(mask.shape)} does not match compact mask canvas {(self.height, self.width)}"
+        rows = torch.nonzero(mask.any(dim=1)).flatten()
+        if len(rows) == 0:
+            self.bboxes[index] = (0, 0, 0, 0)
+            self.bitmaps[index] = torch.zeros((0, 0), dtype=torch.uint8, device=self.device)
+            return
+        cols = torch.nonzero(mask.any(dim=0)).flatten()
+        y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        x0, x1 = int(cols[0]), int(cols[-1]) + 1
+        crop = mask[y0:y1, x0:x1].float().clamp(0, 1)
+        self.bboxes[index] = (x0, y0, x1 - x0, y1 - y0)
+        self.bitmaps[index] = (crop * 255).round().to(self.device, torch.uint8)
+
+    def crop(self, index, dtype=torch.float32):
+        """返回第index个蒙版的包围盒和包围盒内的浮点蒙版 [h,w]"""
+        return self.bboxes[index], self.bitmaps[index].to(dtype) / 255.0
+
+    def frame(self, index, dtype=torch.float32, device=None):
+        """只解码第index个蒙版为 [1,H,W]"""
+        device = device if device is not None else self.device
+        result = torch.zeros((1, self.height, self.width), dtype=dtype, device=device)
+        (x, y, w, h), crop = self.crop(index, dtype)
+        if w > 0:
+            result[0, y:y+h, x:x+w] = crop.to(device)
+        return result
+
+    def to_dense(self, dtype=torch.float32, device=None):
+        """解码为普通MASK [N,H,W]"""
+        device = device if device is not None else self.device
+        result = torch.zeros((len(self), self.height, self.width), dtype=dtype, device=device)
+        for i in range(len(self)):
+            (x, y, w, h), crop = self.crop(i, dtype)
+            if w > 0:
+                result[i, y:y+h, x:x+w] = crop.to(device)
+        return result
+
@@ -1,8 +1,18 @@
-from comfy_execution.graph_utils import GraphBuilder, is_link
 from .tools import VariantSupport
+import math
 import torch.nn.functional as F
 import torch
-from nodes import NODE_CLASS_MAPPINGS as ALL_NODE_CLASS_MAPPINGS
+from .compact_mask import CompactMask
+from .loop_checkpoint import (checkpoint_path, load_checkpoint, load_checkpoint_parts, prompt_fingerprint,
+                              remove_checkpoint, save_checkpoint, save_checkpoint_part, unloadable_types)
+from .loop_body import LOOP_BODY_CACHE
+from .loop_state import (ACCUMULATORS, IMAGE_STORAGE, LOOP_STATE_STORE, MASK_STORAGE, HistoryRing, MaskStore,
+                         allocate_buffer, convert_buffer, image_storage_dtype, release_on_error, should_spill)
+from .mask_split import MaskMerge
+from .persistent_list import PersistentList, TensorList, list_schema, schema_matches
+
+CONVERGENCE_METRICS = ["none", "mean_abs", "max_abs", "psnr"]
+LIST_TYPES = ["list", "tensor"]
 
 @VariantSupport()
 class BatchImageLoopOpen:
@@ -14,12 +24,20 @@ class BatchImageLoopOpen:
         inputs = {
             "required": {
                 "segmented_images": ("IMAGE", {"forceInput": True}),
+            },
+            "optional": {
                 "segmented_masks": ("MASK", {"forceInput": True}),
+                "compact_masks": ("COMPACT_MASK", {"forceInput": True}),  # 可代替segmented_masks
+                "chunk_size": ("INT", {"default": 1, "min": 1, "max": 64}),  # 每次迭代处理的区域数量
+                "resume": ("BOOLEAN", {"default": False}),  # 从检查点继续，需与Loop Close一致
+                "checkpoint_dir": ("STRING", {"default": ""}),  # 与Loop Close的checkpoint_dir一致
             },
             "hidden": {
+                "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
                 "iteration_count": ("INT", {"default": 0}),
                 "previous_image": ("IMAGE",),  # 新增：接收上一次循环的图片
+                "state_handle": ("STRING", {"default": ""}),  # 带外存储中的循环状态
             }
         }
         return inputs
@@ -33,15 +51,19 @@ class BatchImageLoopOpen:
         """
         标准化输入格式
         images: 确保是4D tensor [B,H,W,C]
-        masks: 确保是3D tensor [B,H,W]
+        masks: 确保是3D tensor [B,H,W]，或CompactMask
         如果images是单张图片，会扩展到与masks相同的批次大小
         """
         # 处理masks（先处理masks以获取批次大小）
         if isinstance(masks, list):
             masks = torch.cat(masks, dim=0)
-        if len(masks.shape) == 2:  # [H,W] -> [1,H,W]
-            masks = masks.unsqueeze(0)
-        assert len(masks.shape) == 3, f"Masks must be 3D [B,H,W], got shape {masks.shape}"
+        if isinstance(masks, CompactMask):
+            mask_count = len(masks)
+        else:
+            if len(masks.shape) == 2:  # [H,W] -> [1,H,W]
+                masks = masks.unsqueeze(0)
+            assert len(masks.shape) == 3, f"Masks must be 3D [B,H,W], got shape {masks.shape}"
+            mask_count = masks.shape[0]
         
         # 处理images
         if isinstance(images, list):
@@ -51,13 +73,13 @@ class BatchImageLoopOpen:
         assert len(images.shape) == 4, f"Images must be 4D [B,H,W,C], got shape {images.shape}"
 
         # 检查是否需要扩展images
-        if images.shape[0] == 1 and masks.shape[0] > 1:
-            print(f"Expanding single image to match mask batch size: {masks.shape[0]}")
-            images = images.expand(masks.shape[0], -1, -1, -1)
+        if images.shape[0] == 1 and mask_count > 1:
+            print(f"Expanding single image to match mask batch size: {mask_count}")
+            images = images.expand(mask_count, -1, -1, -1)
         
         # 确保batch维度相同
-        assert images.shape[0] == masks.shape[0], \
-            f"Batch size mismatch: images {images.shape[0]} vs masks {masks.shape[0]}"
+        assert images.shape[0] == mask_count, \
+            f"Batch size mismatch: images {images.shape[0]} vs masks {mask_count}"
 
         return images, masks
 
@@ -85,17 +107,42 @@ class BatchImageLoopOpen:
         
         return image
 
-    def while_loop_open(self, segmented_images, segmented_masks, unique_id=None, 
-                       iteration_count=0, previous_image=None):
+    def while_loop_open(self, segmented_images, segmented_masks=None, compact_masks=None, chunk_size=1,
+                       resume=False, checkpoint_dir="", dynprompt=None,
+                       unique_id=None, iteration_count=0, previous_image=None, state_handle=""):
         print(f"while_loop_open Processing iteration {iteration_count}")
+
+        # 上一次循环传回的图片保存在带外存储中
+        if state_handle:
+            previous_image = LOOP_STATE_STORE.get(state_handle).get("previous_image")
+        
+        if segmented_masks is None:
+            if compact_masks is None:
+                raise ValueError("Either segmented_masks or compact_masks must be connected")
+            segmented_masks = compact_masks
         
         # 标准化输入
         segmented_images, segmented_masks = self.standardize_input(segmented_images, segmented_masks)
         
-        # 获取最大迭代次数
-        max_iterations = segmented_images.shape[0]
-        if max_iterations == 0:
+        # 获取最大迭代次数（每次迭代处理chunk_size个区域）
+        total = segmented_images.shape[0]
+        if total == 0:
             raise ValueError("No images provided in segmented_images")
+        max_iterations = math.ceil(total / chunk_size)
+
+        # 从检查点继续：跳过已完成的迭代，使用检查点中传回的图片
+        if resume and checkpoint_dir and iteration_count == 0 and not state_handle:
+            loop_id = dynprompt.get_display_node_id(unique_id)
+            checkpoint = load_checkpoint(
+                checkpoint_path(checkpoint_dir, loop_id), segmented_images.device, max_iterations=max_iterations,
+                chunk_size=chunk_size, fingerprint=prompt_fingerprint(dynprompt, loop_id)
+            )
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+                previous_image = checkpoint["previous_image"]
+
+        start = iteration_count * chunk_size
+        end = min(start + chunk_size, total)
             
         # 验证迭代计数
         if iteration_count >= max_iterations:
@@ -110,13 +157,16 @@ class BatchImageLoopOpen:
             # 调整尺寸以匹配batch中的图片
             previous_image = self.resize_to_match(previous_image, segmented_images.shape)
             
-            # 替换下一次要处理的图片
-            next_idx = min(iteration_count, max_iterations - 1)
-            segmented_images[next_idx:next_idx+1] = previous_image
+            # 按块替换：上一块的第j个结果替换本块的第j张图片（最后一块可能不足chunk_size个）
+            count = min(previous_image.shape[0], end - start)
+            segmented_images[start:start+count] = previous_image[:count]
             
-        # 获取当前迭代的图片和蒙版
-        current_image = segmented_images[iteration_count:iteration_count+1]
-        current_mask = segmented_masks[iteration_count:iteration_count+1]
+        # 获取当前迭代的图片和蒙版（紧凑蒙版只解码当前块）
+        current_image = segmented_images[start:end]
+        if isinstance(segmented_masks, CompactMask):
+            current_mask = segmented_masks[start:end].to_dense()
+        else:
+            current_mask = segmented_masks[start:end]
             
         return tuple(["stub", current_image, current_mask, max_iterations, iteration_count])
     
@@ -137,63 +187,42 @@ class BatchImageLoopClose:
             },
             "optional": {
                 "pass_back": ("BOOLEAN", {"default": False}),  # 新增：控制是否传回图片
+                "bboxes": ("BBOX", {"forceInput": True}),  # 裁剪模式下每个区域的窗口
+                "compact_masks": ("BOOLEAN", {"default": False}),  # 以紧凑格式累积结果蒙版
+                "stream_merge": ("BOOLEAN", {"default": False}),  # 边循环边合并，不保存每次的结果
+                "original_image": ("IMAGE",),  # stream_merge时的合并底图
+                "source_indices": ("LIST", {"forceInput": True}),  # stream_merge时每个区域对应的原图索引
+                "image_storage": (IMAGE_STORAGE, {"default": "float32"}),  # 循环间结果图片的存储精度
+                "mask_storage": (MASK_STORAGE, {"default": "float32"}),  # 循环间结果蒙版的存储格式
+                "unroll_factor": ("INT", {"default": 1, "min": 1, "max": 100}),  # 每次展开的迭代次数
+                "chunk_size": ("INT", {"default": 1, "min": 1, "max": 64}),  # 与Loop Open的chunk_size一致
+                "map_mode": ("BOOLEAN", {"default": False}),  # 迭代互不依赖时一次展开所有迭代
+                "map_window": ("INT", {"default": 0, "min": 0, "max": 10000}),  # map_mode每次展开的迭代数，0表示全部
+                "checkpoint_dir": ("STRING", {"default": ""}),  # 每次迭代后把循环状态写入该目录，为空则不保存
+                "resume": ("BOOLEAN", {"default": False}),  # 从检查点继续，需与Loop Open一致
+                "accumulator": (ACCUMULATORS, {"default": "memory"}),  # 结果缓冲放在内存还是内存映射文件中
+                "ram_budget_mb": ("INT", {"default": 2048, "min": 0, "max": 1048576}),  # auto模式下超过该大小时放到磁盘
+                "spill_dir": ("STRING", {"default": ""}),  # 内存映射文件的目录，为空时使用系统临时目录
             },
             "hidden": {
                 "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
                 "result_images": ("IMAGE",),
                 "result_masks": ("MASK",),
+                "merged_image": ("IMAGE",),
+                "state_handle": ("STRING", {"default": ""}),  # 带外存储中的循环状态
                 "iteration_count": ("INT", {"default": 0}),
+                "body_key": ("STRING", {"default": ""}),  # 缓存的循环体模板
+                "unrolled": ("BOOLEAN", {"default": False}),  # 展开的中间副本，不再展开下一次循环
             }
         }
         return inputs
 
-    RETURN_TYPES = tuple(["IMAGE", "MASK"])
-    RETURN_NAMES = tuple(["result_images", "result_masks"])
+    RETURN_TYPES = tuple(["IMAGE", "MASK", "COMPACT_MASK", "IMAGE"])
+    RETURN_NAMES = tuple(["result_images", "result_masks", "result_compact_masks", "merged_image"])
     FUNCTION = "while_loop_close"
     CATEGORY = "CyberEveLoop🐰"
 
-    def explore_dependencies(self, node_id, dynprompt, upstream, parent_ids):
-        node_info = dynprompt.get_node(node_id)
-        if "inputs" not in node_info:
-            return
-
-        for k, v in node_info["inputs"].items():
-            if is_link(v):
-                parent_id = v[0]
-                display_id = dynprompt.get_display_node_id(parent_id)
-                display_node = dynprompt.get_node(display_id)
-                class_type = display_node["class_type"]
-                # 排除循环结束节点
-                if class_type not in ['BatchImageLoopClose']:
-                    parent_ids.append(display_id)
-                if parent_id not in upstream:
-                    upstream[parent_id] = []
-                    self.explore_dependencies(parent_id, dynprompt, upstream, parent_ids)
-                upstream[parent_id].append(node_id)
-
-    def explore_output_nodes(self, dynprompt, upstream, output_nodes, parent_ids):
-        """探索并添加输出节点的连接"""
-        for parent_id in upstream:
-            display_id = dynprompt.get_display_node_id(parent_id)
-            for output_id in output_nodes:
-                id = output_nodes[output_id][0]
-                if id in parent_ids and display_id == id and output_id not in upstream[parent_id]:
-                    if '.' in parent_id:
-                        arr = parent_id.split('.')
-                        arr[len(arr)-1] = output_id
-                        upstream[parent_id].append('.'.join(arr))
-                    else:
-                        upstream[parent_id].append(output_id)
-
-    def collect_contained(self, node_id, upstream, contained):
-        if node_id not in upstream:
-            return
-        for child_id in upstream[node_id]:
-            if child_id not in contained:
-                contained[child_id] = True
-                self.collect_contained(child_id, upstream, contained)
-
     def standardize_input(self, image, mask):
         """
         标准化输入格式
@@ -212,125 +241,252 @@ class BatchImageLoopClose:
 
         return image, mask
 
-    def initialize_results(self, max_iterations, current_image, current_mask):
+    def resize_to_bbox(self, image, mask, bbox):
+        """
+        裁剪模式下将结果调整回裁剪窗口尺寸
+        （例如循环体中放大了裁剪区域），保证结果批次尺寸一致
         """
-        初始化结果张量，确保与MaskSplit输出格式一致
+        _, _, w, h = bbox
+        if image.shape[1:3] != (h, w):
+            image = F.interpolate(
+                image.permute(0, 3, 1, 2), size=(h, w), mode='bilinear', align_corners=False
+            ).permute(0, 2, 3, 1)
+        if mask.shape[1:3] != (h, w):
+            mask = F.interpolate(
+                mask.unsqueeze(1), size=(h, w), mode='bilinear', align_corners=False
+            ).squeeze(1)
+        return image, mask
+
+    def initialize_results(self, max_iterations, current_image, current_mask, compact_masks=False,
+                           image_storage="float32", mask_storage="float32", accumulator="memory",
+                           ram_budget_mb=0, spill_dir=""):
+        """
+        初始化结果缓冲，确保与MaskSplit输出格式一致
+        - image_storage: 结果图片的存储精度，输出时再转换回输入精度
+        - mask_storage: 结果蒙版的存储格式（MaskStore），compact_masks为True时使用CompactMask
+        - accumulator / ram_budget_mb: 缓冲过大时放到spill_dir下的内存映射文件中
         """
         # 确保维度正确
         assert len(current_image.shape) == 4, "Current image must be 4D [B,H,W,C]"
         assert len(current_mask.shape) == 3, "Current mask must be 3D [B,H,W]"
 
+        shape = (max_iterations, current_image.shape[1], current_image.shape[2], current_image.shape[3])
+        dtype = image_storage_dtype(image_storage)
+        nbytes = math.prod(shape) * torch.finfo(dtype).bits // 8
+        if not compact_masks:
+            nbytes += max_iterations * MaskStore.slot_bytes(current_mask.shape[1], current_mask.shape[2], mask_storage)
+        spill = spill_dir if should_spill(accumulator, nbytes, ram_budget_mb) else None
+        if spill is not None:
+            print(f"Accumulating {nbytes / 1024 / 1024:.1f} MB of loop results in memory-mapped files")
+
         # 创建结果张量，确保格式一致
-        result_images = torch.zeros(
-            (max_iterations, current_image.shape[1], current_image.shape[2], current_image.shape[3]),
-            dtype=current_image.dtype,
-            device=current_image.device
-        )  # 明确指定 [B,H,W,C]
-
-        result_masks = torch.zeros(
-            (max_iterations, current_mask.shape[1], current_mask.shape[2]),
-            dtype=current_mask.dtype,
-            device=current_mask.device
-        )  # 明确指定 [B,H,W]
-        
+        result_images = allocate_buffer(shape, dtype, current_image.device, spill)  # 明确指定 [B,H,W,C]
+
+        if compact_masks:
+            result_masks = CompactMask.empty(
+                max_iterations, current_mask.shape[1], current_mask.shape[2], current_mask.device
+            )
+            return result_images, result_masks
+
+        result_masks = MaskStore(
+            max_iterations, current_mask.shape[1], current_mask.shape[2], mask_storage, current_mask.device, spill
+        )  # [B,H,W]
+
         return result_images, result_masks
 
+    def store_chunk(self, result_images, result_masks, start, images, masks, compact_masks=False):
+        """把一块结果写入从start开始的槽位"""
+        end = start + images.shape[0]
+        result_images[start:end] = images
+        if compact_masks:
+            for j in range(masks.shape[0]):
+                result_masks.set(start + j, masks[j])
+        else:
+            result_masks.store(start, masks)
+
+    def merge_current(self, merged_image, original_image, current_image, current_mask,
+                      start, bboxes=None, source_indices=None):
+        """
+        stream_merge模式：将本次结果直接合并进运行中的合成图
+        - start: 本次结果中第一个区域的索引
+        第一次迭代时复制original_image作为合成图，之后原地更新
+        """
+        if merged_image is None:
+            if original_image is None:
+                raise ValueError("stream_merge requires original_image to be connected")
+            if len(original_image.shape) == 3:
+                original_image = original_image.unsqueeze(0)
+            merged_image = original_image.clone()
+        
+        end = start + current_image.shape[0]
+        MaskMerge().merge_masked_images(
+            merged_image, current_image, current_mask,
+            source_indices=list(source_indices[start:end]) if source_indices is not None else None,
+            bboxes=list(bboxes[start:end]) if bboxes is not None else None,
+            out=merged_image,
+        )
+        return merged_image
+
+    @release_on_error
     def while_loop_close(self, flow_control, current_image, current_mask, max_iterations, 
-                        pass_back=False, iteration_count=0, result_images=None, result_masks=None,
-                        dynprompt=None, unique_id=None,):
+                        pass_back=False, bboxes=None, compact_masks=False, stream_merge=False,
+                        original_image=None, source_indices=None, image_storage="float32",
+                        mask_storage="float32", unroll_factor=1, chunk_size=1, map_mode=False,
+                        map_window=0, checkpoint_dir="", resume=False, accumulator="memory",
+                        ram_budget_mb=2048, spill_dir="", iteration_count=0,
+                        result_images=None, result_masks=None, merged_image=None, state_handle="",
+                        body_key="", unrolled=False, dynprompt=None, unique_id=None,):
+        loop_id = dynprompt.get_display_node_id(flow_control[0])
+        checkpoint_file = checkpoint_path(checkpoint_dir, loop_id) if checkpoint_dir else None
+        fingerprint = prompt_fingerprint(dynprompt, loop_id) if checkpoint_dir else None
+
+        # 从检查点继续：恢复已完成迭代的结果（Loop Open读取的是同一个检查点）
+        restored_parts = []
+        if resume and checkpoint_file and iteration_count == 0 and not body_key:
+            checkpoint = load_checkpoint(
+                checkpoint_file, current_image.device, max_iterations=max_iterations, chunk_size=chunk_size,
+                fingerprint=fingerprint
+            )
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+                merged_image = checkpoint["merged_image"]
+                if not stream_merge:
+                    restored_parts = load_checkpoint_parts(checkpoint_file, iteration_count, current_image.device)
+
         print(f"Iteration {iteration_count} of {max_iterations}")
+
+        # 从带外存储取回累积的结果（展开的后续副本通过连接直接传入）
+        if state_handle:
+            state = LOOP_STATE_STORE.get(state_handle)
+            result_images, result_masks, merged_image = \
+                state["result_images"], state["result_masks"], state["merged_image"]
         
         # 标准化输入，确保格式一致
         current_image, current_mask = self.standardize_input(current_image, current_mask)
+        # 除最后一块外每块必须正好chunk_size个区域，否则结果槽位会错位或留空
+        count = current_image.shape[0]
+        if count > chunk_size or (count != chunk_size and iteration_count < max_iterations - 1):
+            raise ValueError(f"Got {count} images in iteration {iteration_count} of {max_iterations} "
+                             f"for chunk_size {chunk_size}, chunk_size must match Batch Image Loop Open")
+        # 本块第一个区域的索引（裁剪窗口尺寸一致，按第一个窗口调整）
+        start = iteration_count * chunk_size
+        if bboxes is not None:
+            current_image, current_mask = self.resize_to_bbox(current_image, current_mask, bboxes[start])
 
         # 验证迭代计数
         if iteration_count >= max_iterations:
             raise ValueError(f"Iteration count {iteration_count} exceeds max iterations {max_iterations}")
-
-        # 结果初始化或验证
-        if result_images is None or result_masks is None:
-            result_images, result_masks = self.initialize_results(max_iterations, current_image, current_mask)
+        if map_mode and pass_back:
+            raise ValueError("map_mode requires pass_back to be disabled, iterations must be independent")
+
+        if stream_merge:
+            # 只保留一张运行中的合成图，内存与区域数量无关
+            merged_image = self.merge_current(
+                merged_image, original_image, current_image, current_mask,
+                start, bboxes, source_indices
+            )
+        elif result_images is None or result_masks is None:
+            # 结果初始化（按块分配，最后一块可能不满，输出时截断）
+            result_images, result_masks = self.initialize_results(
+                max_iterations * chunk_size, current_image, current_mask, compact_masks, image_storage, mask_storage,
+                accumulator, ram_budget_mb, spill_dir
+            )
         else:
             # 验证现有结果的维度和格式
-            assert result_images.shape[0] == max_iterations and len(result_images.shape) == 4, \
-                f"Result images must be 4D [B,H,W,C] with batch size {max_iterations}"
-            assert result_masks.shape[0] == max_iterations and len(result_masks.shape) == 3, \
-                f"Result masks must be 3D [B,H,W] with batch size {max_iterations}"
+            capacity = max_iterations * chunk_size
+            assert result_images.shape[0] == capacity and len(result_images.shape) == 4, \
+                f"Result images must be 4D [B,H,W,C] with batch size {capacity}"
+            assert len(result_masks) == capacity, \
+                f"Result masks must have {capacity} entries"
             
-        # 存储当前结果
-        result_images[iteration_count:iteration_count+1] = current_image
-        result_masks[iteration_count:iteration_count+1] = current_mask
+        # 存储当前结果（一次写入整块），从检查点继续时先写回已完成迭代的结果块
+        end = start + current_image.shape[0]
+        if not stream_merge:
+            for index, part in enumerate(restored_parts):
+                self.store_chunk(result_images, result_masks, index * chunk_size, part["images"], part["masks"],
+                                 compact_masks)
+            self.store_chunk(result_images, result_masks, start, current_image, current_mask, compact_masks)
+
+        # 检查点：记录已完成的迭代，循环结束时删除
+        # 每次只写入本次的结果块，不再保存整个累积缓冲（也不会读入磁盘上的累积结果）
+        if checkpoint_file and iteration_count == max_iterations - 1:
+            remove_checkpoint(checkpoint_file)
+        elif checkpoint_file:
+            if not stream_merge:
+                # 当前块可能是整批图片的视图，复制后只保存本块
+                save_checkpoint_part(checkpoint_file, iteration_count, {
+                    "images": current_image.clone(),
+                    "masks": current_mask.clone(),
+                })
+            save_checkpoint(checkpoint_file, {
+                "iteration": iteration_count,
+                "max_iterations": max_iterations,
+                "chunk_size": chunk_size,
+                "fingerprint": fingerprint,
+                "merged_image": merged_image,
+                "previous_image": current_image.clone() if pass_back else None,
+            })
         
         # 检查是否继续循环
         if iteration_count == max_iterations - 1:
             print(f"Loop finished with {iteration_count + 1} iterations")
-            return (result_images, result_masks)
-
-        # 准备下一次循环
-        this_node = dynprompt.get_node(unique_id)
-        upstream = {}
-        parent_ids = []
-        self.explore_dependencies(unique_id, dynprompt, upstream, parent_ids)
-        parent_ids = list(set(parent_ids))  # 去重
-
-        # 获取并处理输出节点
-        prompts = dynprompt.get_original_prompt()
-        output_nodes = {}
-        for id in prompts:
-            node = prompts[id]
-            if "inputs" not in node:
-                continue
-            class_type = node["class_type"]
-            if class_type in ALL_NODE_CLASS_MAPPINGS:
-                class_def = ALL_NODE_CLASS_MAPPINGS[class_type]
-                if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
-                    for k, v in node['inputs'].items():
-                        if is_link(v):
-                            output_nodes[id] = v
-
-        # 创建新图
-        graph = GraphBuilder()
-        self.explore_output_nodes(dynprompt, upstream, output_nodes, parent_ids)
-        
-        contained = {}
-        open_node = flow_control[0]
-        self.collect_contained(open_node, upstream, contained)
-        contained[unique_id] = True
-        contained[open_node] = True
-
-        # 创建节点
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.node(original_node["class_type"], 
-                            "Recurse" if node_id == unique_id else node_id)
-            node.set_override_display_id(node_id)
-            
-        # 设置连接
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.lookup_node("Recurse" if node_id == unique_id else node_id)
-            for k, v in original_node["inputs"].items():
-                if is_link(v) and v[0] in contained:
-                    parent = graph.lookup_node(v[0])
-                    node.set_input(k, parent.out(v[1]))
-                else:
-                    node.set_input(k, v)
+            LOOP_STATE_STORE.release_loop(body_key)
+            if stream_merge:
+                return (None, None, None, merged_image)
+            # 只在输出时展开为下游使用的精度：精度相同时内存映射的缓冲直接输出，按需读入；
+            # 精度不同时按块转换到新的内存映射缓冲，不在内存中生成整批副本
+            result_images = convert_buffer(result_images[:end], current_image.dtype)
+            if compact_masks:
+                return (result_images, None, result_masks[:end], None)
+            # 紧凑输出只在compact_masks模式下生成
+            result_masks = result_masks.to_dense(current_mask.dtype, end)
+            return (result_images, result_masks, None, None)
+
+        # 展开的中间副本：只把累积状态交给下一个副本
+        if unrolled:
+            return (result_images, result_masks, None, merged_image)
+
+        # 准备下一次循环：循环体只在第一次迭代时发现，之后克隆缓存的模板
+        body_key, body = LOOP_BODY_CACHE.lookup(
+            dynprompt, flow_control[0], unique_id, body_key, exclude_types=['BatchImageLoopClose']
+        )
+        # 一次展开unroll_factor次迭代，最后不足的部分按剩余次数展开
+        # map_mode：各副本的开始节点互不依赖，执行器可以交错或合并执行循环体，
+        # 只有轻量的结束节点按顺序串联，最后一个结束节点汇总结果
+        window = (map_window if map_window > 0 else max_iterations) if map_mode else unroll_factor
+        copies = min(window, max_iterations - 1 - iteration_count)
+        graph, clones = body.build(copies)
+
+        # 状态放入带外存储，图中只传递句柄
+        state_handle = LOOP_STATE_STORE.put(body_key, iteration_count + 1, {
+            "result_images": result_images,
+            "result_masks": result_masks,
+            "merged_image": merged_image,
+            "previous_image": current_image if pass_back else None,  # 新增：根据pass_back决定是否传回图片
+        }, dynprompt.get_original_prompt())
 
         # 设置节点参数
-        my_clone = graph.lookup_node("Recurse")
-        my_clone.set_input("iteration_count", iteration_count + 1)
-        my_clone.set_input("result_images", result_images)
-        my_clone.set_input("result_masks", result_masks)
-        
-        new_open = graph.lookup_node(open_node)
-        new_open.set_input("iteration_count", iteration_count + 1)
-        if pass_back:  # 新增：根据pass_back决定是否传回图片
-            new_open.set_input("previous_image", current_image)
-
-        print(f"Continuing to iteration {iteration_count + 1}")
+        previous = None
+        for j, (my_clone, new_open) in enumerate(clones):
+            my_clone.set_input("iteration_count", iteration_count + 1 + j)
+            my_clone.set_input("body_key", body_key)
+            my_clone.set_input("unrolled", j < copies - 1)
+            my_clone.set_input("state_handle", state_handle if previous is None else "")
+            new_open.set_input("iteration_count", iteration_count + 1 + j)
+            new_open.set_input("state_handle", state_handle if previous is None else "")
+            if previous is not None:
+                # 展开的副本之间通过连接传递累积状态和传回的图片
+                my_clone.set_input("result_images", previous.out(0))
+                my_clone.set_input("result_masks", previous.out(1))
+                my_clone.set_input("merged_image", previous.out(3))
+                if pass_back:
+                    new_open.set_input("previous_image", previous.get_input("current_image"))
+            previous = my_clone
+
+        print(f"Continuing to iteration {iteration_count + 1}" + (f" (unrolled x{copies})" if copies > 1 else ""))
 
         return {
-            "result": tuple([my_clone.out(0), my_clone.out(1)]),
+            "result": tuple([my_clone.out(0), my_clone.out(1), my_clone.out(2), my_clone.out(3)]),
             "expand": graph.finalize(),
         }
 
@@ -349,12 +505,16 @@ class SingleImageLoopOpen:
             },
             "optional": {
                 "mask": ("MASK",),
+                "resume": ("BOOLEAN", {"default": False}),  # 从检查点继续，需与Loop Close一致
+                "checkpoint_dir": ("STRING", {"default": ""}),  # 与Loop Close的checkpoint_dir一致
             },
             "hidden": {
+                "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
                 "iteration_count": ("INT", {"default": 0}),
                 "previous_image": ("IMAGE",),
                 "previous_mask": ("MASK",),
+                "state_handle": ("STRING", {"default": ""}),  # 带外存储中的循环状态
             }
         }
         return inputs
@@ -364,8 +524,23 @@ class SingleImageLoopOpen:
     FUNCTION = "loop_open"
     CATEGORY = "CyberEveLoop🐰"
 
-    def loop_open(self, image, max_iterations, mask=None, unique_id=None, 
-                 iteration_count=0, previous_image=None, previous_mask=None):
+    def loop_open(self, image, max_iterations, mask=None, resume=False, checkpoint_dir="", dynprompt=None,
+                 unique_id=None, iteration_count=0, previous_image=None, previous_mask=None, state_handle=""):
+        # 上一次循环的结果保存在带外存储中
+        if state_handle:
+            state = LOOP_STATE_STORE.get(state_handle)
+            previous_image, previous_mask = state["previous_image"], state["previous_mask"]
+        elif resume and checkpoint_dir and iteration_count == 0:
+            # 从检查点继续：使用最后完成的迭代的结果
+            loop_id = dynprompt.get_display_node_id(unique_id)
+            checkpoint = load_checkpoint(
+                checkpoint_path(checkpoint_dir, loop_id), image.device, max_iterations=max_iterations,
+                fingerprint=prompt_fingerprint(dynprompt, loop_id)
+            )
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+                previous_image, previous_mask = checkpoint["previous_image"], checkpoint["previous_mask"]
+
         print(f"SingleImageLoopOpen Processing iteration {iteration_count}")
         
         # 确保维度正确
@@ -395,61 +570,93 @@ class SingleImageLoopClose:
             },
             "optional": {
                 "current_mask": ("MASK",),
+                "unroll_factor": ("INT", {"default": 1, "min": 1, "max": 100}),  # 每次展开的迭代次数
+                "convergence_metric": (CONVERGENCE_METRICS, {"default": "none"}),  # 提前结束的收敛判据
+                "convergence_threshold": ("FLOAT", {"default": 0.001, "min": 0.0, "max": 100.0, "step": 0.0001}),  # mean_abs/max_abs的差值上限
+                "psnr_threshold": ("FLOAT", {"default": 40.0, "min": 0.0, "max": 100.0, "step": 0.1}),  # psnr的下限(dB)
+                "mask_convergence": ("BOOLEAN", {"default": False}),  # 同时要求蒙版变化小于mask_threshold
+                "mask_threshold": ("FLOAT", {"default": 0.001, "min": 0.0, "max": 1.0, "step": 0.0001}),
+                "checkpoint_dir": ("STRING", {"default": ""}),  # 每次迭代后把循环状态写入该目录，为空则不保存
+                "resume": ("BOOLEAN", {"default": False}),  # 从检查点继续，需与Loop Open一致
+                "history_size": ("INT", {"default": 0, "min": 0, "max": 100}),  # 保留最近几次迭代的结果，0表示不保留
+                "history_stride": ("INT", {"default": 1, "min": 1, "max": 100}),  # 每几次迭代记录一次
+                "history_storage": (IMAGE_STORAGE, {"default": "float16"}),  # 历史图片的存储精度
             },
             "hidden": {
                 "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
                 "iteration_count": ("INT", {"default": 0}),
+                "body_key": ("STRING", {"default": ""}),  # 缓存的循环体模板
+                "unrolled": ("BOOLEAN", {"default": False}),  # 展开的中间副本，不再展开下一次循环
+                "previous_image": ("IMAGE",),  # 上一次迭代的结果，用于收敛判断
+                "previous_mask": ("MASK",),
+                "state_handle": ("STRING", {"default": ""}),  # 带外存储中的循环状态
+                "history_handle": ("STRING", {"default": ""}),  # 展开的后续副本从带外存储取回迭代历史
             }
         }
         return inputs
 
-    RETURN_TYPES = tuple(["IMAGE", "MASK"])
-    RETURN_NAMES = tuple(["final_image", "final_mask"])
+    RETURN_TYPES = tuple(["IMAGE", "MASK", "INT", "IMAGE", "MASK"])
+    RETURN_NAMES = tuple(["final_image", "final_mask", "iterations", "history_images", "history_masks"])
     FUNCTION = "loop_close"
     CATEGORY = "CyberEveLoop🐰"
 
-    def explore_dependencies(self, node_id, dynprompt, upstream, parent_ids):
-        node_info = dynprompt.get_node(node_id)
-        if "inputs" not in node_info:
-            return
-
-        for k, v in node_info["inputs"].items():
-            if is_link(v):
-                parent_id = v[0]
-                display_id = dynprompt.get_display_node_id(parent_id)
-                display_node = dynprompt.get_node(display_id)
-                class_type = display_node["class_type"]
-                if class_type not in ['SingleImageLoopClose']:
-                    parent_ids.append(display_id)
-                if parent_id not in upstream:
-                    upstream[parent_id] = []
-                    self.explore_dependencies(parent_id, dynprompt, upstream, parent_ids)
-                upstream[parent_id].append(node_id)
-
-    def explore_output_nodes(self, dynprompt, upstream, output_nodes, parent_ids):
-        for parent_id in upstream:
-            display_id = dynprompt.get_display_node_id(parent_id)
-            for output_id in output_nodes:
-                id = output_nodes[output_id][0]
-                if id in parent_ids and display_id == id and output_id not in upstream[parent_id]:
-                    if '.' in parent_id:
-                        arr = parent_id.split('.')
-                        arr[len(arr)-1] = output_id
-                        upstream[parent_id].append('.'.join(arr))
-                    else:
-                        upstream[parent_id].append(output_id)
-
-    def collect_contained(self, node_id, upstream, contained):
-        if node_id not in upstream:
-            return
-        for child_id in upstream[node_id]:
-            if child_id not in contained:
-                contained[child_id] = True
-                self.collect_contained(child_id, upstream, contained)
-
-    def loop_close(self, flow_control, current_image, max_iterations, current_mask=None,
-                  iteration_count=0, dynprompt=None, unique_id=None):
+    def has_converged(self, current_image, previous_image, current_mask, previous_mask,
+                      metric, threshold, mask_convergence=False, mask_threshold=0.0):
+        """
+        判断与上一次迭代相比是否已收敛
+        - mean_abs / max_abs: 平均/最大绝对差 <= threshold
+        - psnr: 峰值信噪比(dB) >= threshold
+        - mask_convergence: 同时要求蒙版平均绝对差 <= mask_threshold
+        """
+        if metric == "none" or previous_image is None or previous_image.shape != current_image.shape:
+            return False
+
+        diff = (current_image.float() - previous_image.float()).abs()
+        if metric == "mean_abs":
+            converged = diff.mean().item() <= threshold
+        elif metric == "max_abs":
+            converged = diff.max().item() <= threshold
+        elif metric == "psnr":
+            mse = diff.pow(2).mean().item()
+            converged = mse == 0 or 10 * math.log10(1.0 / mse) >= threshold
+        else:
+            raise ValueError(f"Unknown convergence metric: {metric}")
+
+        if converged and mask_convergence and current_mask is not None:
+            if previous_mask is None or previous_mask.shape != current_mask.shape:
+                return False
+            converged = (current_mask.float() - previous_mask.float()).abs().mean().item() <= mask_threshold
+        return converged
+
+    @release_on_error
+    def loop_close(self, flow_control, current_image, max_iterations, current_mask=None, unroll_factor=1,
+                  convergence_metric="none", convergence_threshold=0.001, psnr_threshold=40.0,
+                  mask_convergence=False, mask_threshold=0.001, checkpoint_dir="", resume=False, history_size=0, history_stride=1,
+                  history_storage="float16", iteration_count=0, body_key="", unrolled=False,
+                  previous_image=None, previous_mask=None, state_handle="", history_handle="",
+                  dynprompt=None, unique_id=None):
+        loop_id = dynprompt.get_display_node_id(flow_control[0])
+        checkpoint_file = checkpoint_path(checkpoint_dir, loop_id) if checkpoint_dir else None
+        fingerprint = prompt_fingerprint(dynprompt, loop_id) if checkpoint_dir else None
+
+        history = None
+        if state_handle:
+            state = LOOP_STATE_STORE.get(state_handle)
+            previous_image, previous_mask, history = state["previous_image"], state["previous_mask"], state["history"]
+        elif history_handle:
+            # 展开的后续副本：上一次迭代的结果通过连接传入，迭代历史与第一个副本共用
+            history = LOOP_STATE_STORE.get(history_handle)["history"]
+        elif resume and checkpoint_file and iteration_count == 0 and not body_key:
+            # 从检查点继续（Loop Open读取的是同一个检查点）
+            checkpoint = load_checkpoint(checkpoint_file, current_image.device, max_iterations=max_iterations,
+                                         fingerprint=fingerprint)
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+                previous_image, previous_mask = checkpoint["previous_image"], checkpoint["previous_mask"]
+                if checkpoint["history"] is not None:
+                    history = HistoryRing.from_state_dict(checkpoint["history"])
+
         print(f"Iteration {iteration_count} of {max_iterations}")
         
         # 维度处理
@@ -458,75 +665,80 @@ class SingleImageLoopClose:
         if current_mask is not None and len(current_mask.shape) == 2:
             current_mask = current_mask.unsqueeze(0)
 
-        # 检查是否继续循环
-        if iteration_count >= max_iterations - 1:
-            print(f"Loop finished with {iteration_count + 1} iterations")
-            return (current_image, current_mask if current_mask is not None else torch.zeros_like(current_image[:,:,:,0]))
-
-        # 准备下一次循环
-        this_node = dynprompt.get_node(unique_id)
-        upstream = {}
-        parent_ids = []
-        self.explore_dependencies(unique_id, dynprompt, upstream, parent_ids)
-        parent_ids = list(set(parent_ids))
-
-        # 获取并处理输出节点
-        prompts = dynprompt.get_original_prompt()
-        output_nodes = {}
-        for id in prompts:
-            node = prompts[id]
-            if "inputs" not in node:
-                continue
-            class_type = node["class_type"]
-            if class_type in ALL_NODE_CLASS_MAPPINGS:
-                class_def = ALL_NODE_CLASS_MAPPINGS[class_type]
-                if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
-                    for k, v in node['inputs'].items():
-                        if is_link(v):
-                            output_nodes[id] = v
-
-        # 创建新图
-        graph = GraphBuilder()
-        self.explore_output_nodes(dynprompt, upstream, output_nodes, parent_ids)
-        
-        contained = {}
-        open_node = flow_control[0]
-        self.collect_contained(open_node, upstream, contained)
-        contained[unique_id] = True
-        contained[open_node] = True
-
-        # 创建节点
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.node(original_node["class_type"], 
-                            "Recurse" if node_id == unique_id else node_id)
-            node.set_override_display_id(node_id)
-            
-        # 设置连接
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.lookup_node("Recurse" if node_id == unique_id else node_id)
-            for k, v in original_node["inputs"].items():
-                if is_link(v) and v[0] in contained:
-                    parent = graph.lookup_node(v[0])
-                    node.set_input(k, parent.out(v[1]))
-                else:
-                    node.set_input(k, v)
+        # 迭代历史：固定大小的环形缓冲，不需要在循环体中连接保存节点
+        if history is None and history_size > 0:
+            history = HistoryRing(history_size, history_stride, history_storage)
+        if history is not None:
+            history.record(iteration_count, current_image, current_mask)
+
+        # 检查是否继续循环（达到最大次数或已收敛），psnr的阈值单位为dB，与差值阈值分开
+        threshold = psnr_threshold if convergence_metric == "psnr" else convergence_threshold
+        converged = self.has_converged(
+            current_image, previous_image, current_mask, previous_mask,
+            convergence_metric, threshold, mask_convergence, mask_threshold
+        )
+        finished = iteration_count >= max_iterations - 1 or converged
+
+        # 检查点：记录已完成的迭代，循环结束时删除
+        if checkpoint_file and finished:
+            remove_checkpoint(checkpoint_file)
+        elif checkpoint_file:
+            save_checkpoint(checkpoint_file, {
+                "iteration": iteration_count,
+                "max_iterations": max_iterations,
+                "fingerprint": fingerprint,
+                "previous_image": current_image,
+                "previous_mask": current_mask,
+                "history": history.state_dict() if history is not None else None,
+            })
+
+        if finished:
+            print(f"Loop finished with {iteration_count + 1} iterations" + (" (converged)" if converged else ""))
+            LOOP_STATE_STORE.release_loop(body_key)
+            history_images, history_masks = history.to_outputs(current_image.dtype) if history is not None else (None, None)
+            return (current_image, current_mask if current_mask is not None else torch.zeros_like(current_image[:,:,:,0]),
+                    iteration_count + 1, history_images, history_masks)
+
+        # 展开的中间副本：结果直接传给下一个副本的开始节点，迭代历史已原地记录在带外存储中
+        if unrolled:
+            return (current_image, current_mask, iteration_count + 1, None, None)
+
+        # 准备下一次循环：循环体只在第一次迭代时发现，之后克隆缓存的模板
+        body_key, body = LOOP_BODY_CACHE.lookup(
+            dynprompt, flow_control[0], unique_id, body_key, exclude_types=['SingleImageLoopClose']
+        )
+        # 一次展开unroll_factor次迭代，最后不足的部分按剩余次数展开
+        # 启用收敛判断时每次只展开一次迭代，以便收敛后不再执行多余的循环体
+        copies = min(unroll_factor if convergence_metric == "none" else 1, max_iterations - 1 - iteration_count)
+        graph, clones = body.build(copies)
+
+        # 结果放入带外存储，图中只传递句柄
+        state_handle = LOOP_STATE_STORE.put(body_key, iteration_count + 1, {
+            "previous_image": current_image,
+            "previous_mask": current_mask,
+            "history": history,
+        }, dynprompt.get_original_prompt())
 
         # 设置节点参数
-        my_clone = graph.lookup_node("Recurse")
-        my_clone.set_input("iteration_count", iteration_count + 1)
-        
-        new_open = graph.lookup_node(open_node)
-        new_open.set_input("iteration_count", iteration_count + 1)
-        new_open.set_input("previous_image", current_image)
-        if current_mask is not None:
-            new_open.set_input("previous_mask", current_mask)
-
-        print(f"Continuing to iteration {iteration_count + 1}")
+        previous = None
+        for j, (my_clone, new_open) in enumerate(clones):
+            my_clone.set_input("iteration_count", iteration_count + 1 + j)
+            my_clone.set_input("body_key", body_key)
+            my_clone.set_input("unrolled", j < copies - 1)
+            my_clone.set_input("state_handle", state_handle if previous is None else "")
+            new_open.set_input("iteration_count", iteration_count + 1 + j)
+            new_open.set_input("state_handle", state_handle if previous is None else "")
+            if previous is not None:
+                new_open.set_input("previous_image", previous.out(0))
+                new_open.set_input("previous_mask", previous.out(1))
+                # 迭代历史不是IMAGE，不经过输出连接，后续副本按句柄取回同一个环形缓冲
+                my_clone.set_input("history_handle", state_handle if history is not None else "")
+            previous = my_clone
+
+        print(f"Continuing to iteration {iteration_count + 1}" + (f" (unrolled x{copies})" if copies > 1 else ""))
 
         return {
-            "result": tuple([my_clone.out(0), my_clone.out(1)]),
+            "result": tuple([my_clone.out(0), my_clone.out(1), my_clone.out(2), my_clone.out(3), my_clone.out(4)]),
             "expand": graph.finalize(),
         }
 
@@ -549,11 +761,16 @@ class LoopReduceOpen:
             },
             "optional": {
                 "initial": ("LIST",),
+                "list_type": (LIST_TYPES, {"default": "list"}), # tensor: collect IMAGE/MASK values in one batch buffer
+                "resume": ("BOOLEAN", {"default": False}), # continue from a checkpoint, must match the close node
+                "checkpoint_dir": ("STRING", {"default": ""}), # same directory as the close node
             },
             "hidden": {
+                "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
                 "iteration_count": ("INT", {"default": 0}),
                 "previous_list": ("LIST",),
+                "state_handle": ("STRING", {"default": ""}), # loop state kept out of band
             }
         }
         return inputs
@@ -565,19 +782,39 @@ class LoopReduceOpen:
     
     @classmethod
     def _loop_open(cls, input_size, initial=None, unique_id=None, 
-                 iteration_count=0, previous_list=None):
-        
+                 iteration_count=0, previous_list=None, state_handle="",
+                 resume=False, checkpoint_dir="", dynprompt=None, list_type="list"):
+
+        # the list of the previous iteration is kept in the loop state store
+        if state_handle:
+            previous_list = LOOP_STATE_STORE.get(state_handle)["previous_list"]
+        elif resume and checkpoint_dir and iteration_count == 0:
+            # resume: start after the last completed iteration with its list
+            loop_id = dynprompt.get_display_node_id(unique_id)
+            checkpoint = load_checkpoint(
+                checkpoint_path(checkpoint_dir, loop_id), input_size=input_size,
+                fingerprint=prompt_fingerprint(dynprompt, loop_id)
+            )
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+                previous_list = checkpoint["previous_list"]
+
         print(f"{cls.__class__.__name__} Processing iteration {iteration_count}")
                 
-        initial = [] if initial is None else initial
-        
-        current_list = initial[:] if previous_list is None else previous_list
+        # lists are persistent, the previous list is shared instead of copied
+        current_list = initial if previous_list is None else previous_list
+        if list_type == "tensor":
+            # room for one value per iteration up front, the buffer grows if more are appended
+            current_list = TensorList.of(current_list, capacity=input_size)
+        else:
+            current_list = PersistentList.of(current_list)
         
         return tuple(["stub", current_list, input_size, iteration_count])   
     
-    def loop_open(self, input_size, initial=None, unique_id=None, 
-                 iteration_count=0, previous_list=None):
-        return self._loop_open(input_size, initial, unique_id, iteration_count, previous_list)
+    def loop_open(self, input_size, initial=None, list_type="list", resume=False, checkpoint_dir="", dynprompt=None,
+                 unique_id=None, iteration_count=0, previous_list=None, state_handle=""):
+        return self._loop_open(input_size, initial, unique_id, iteration_count, previous_list, state_handle,
+                               resume, checkpoint_dir, dynprompt, list_type)
 
 @VariantSupport()
 class EmptyList:
@@ -658,8 +895,11 @@ class AppendList:
     
     def appending(self, current_list, current_value):
         
-        current_list.append(current_value)
-        return tuple([current_list])
+        # returns a new list, the input (possibly a cached output) is left untouched
+        if isinstance(current_list, PersistentList):
+            # list carried by a LoopReduce loop, shares its items with the previous iteration
+            return tuple([current_list.appended(current_value)])
+        return tuple([list(current_list if current_list is not None else []) + [current_value]])
 
 @VariantSupport()
 class ConcatList:
@@ -685,19 +925,17 @@ class ConcatList:
     def concat(self, type_check, list_base, list_add):
         
         if type_check:
-            type_list = set()
-            for v_b in list_base:
-                type_list.add(type(v_b))   
-            for v_a in list_add:
-                if isinstance(v_a, tuple(type_list)):
-                    pass
-                else:
-                    raise ValueError(f"a value type \"{type(v_a)}\" of list_add is not correspond to list_base {type_list} ")
-        
-        # TODO: [a,b, [c,d,e]] -> validate [c,d,e], [type(c), type(d), type(e)] instead of LIST 
-                
-        list_base.extend(list_add)
-        return tuple([list_base])
+            # compare the element-type schemas, lists carried by a loop keep theirs so they are not
+            # walked on each call, nested lists are compared by their element types
+            base_schema = list_schema(list_base)
+            for entry in list_schema(list_add):
+                if not schema_matches(entry, base_schema):
+                    raise ValueError(f"a value type \"{entry}\" of list_add is not correspond to list_base {set(base_schema)} ")
+
+        if isinstance(list_base, PersistentList):
+            # list carried by a LoopReduce loop, shares its items with the previous iteration
+            return tuple([list_base.extended(list_add)])
+        return tuple([list(list_base) + list(list_add)])
 
 
 class LoopReduceClose:
@@ -710,130 +948,109 @@ class LoopReduceClose:
                 "current_list" : ("LIST",),
                 "input_size" : ("INT", {"forceInput" : True}),
             },
+            "optional" : {
+                "unroll_factor" : ("INT", {"default" : 1, "min" : 1, "max" : 100}), # iterations expanded at once
+                "checkpoint_dir" : ("STRING", {"default" : ""}), # write the loop state here after each iteration
+                "resume" : ("BOOLEAN", {"default" : False}), # continue from a checkpoint, must match the open node
+            },
             "hidden" : {
                 "dynprompt" : "DYNPROMPT",
                 "unique_id" : "UNIQUE_ID",
                 "iteration_count" : ("INT", {"default":0}),
+                "body_key" : ("STRING", {"default":""}), # cached loop body template
+                "unrolled" : ("BOOLEAN", {"default":False}), # intermediate unrolled copy, does not expand
             }
         }
         return inputs
 
-    RETURN_TYPES = tuple(["LIST"])
-    RETURN_NAME = tuple(["final_list"])
+    RETURN_TYPES = tuple(["LIST", "*"])
+    RETURN_NAME = tuple(["final_list", "final_batch"])
     FUNCTION = "loop_close"
     CATEGORY = "Intellicode/loop_control"
 
-    def explore_dependencies(self, node_id, dynprompt, upstream, parent_ids):
-        node_info = dynprompt.get_node(node_id)
-        if "inputs" not in node_info:
-            return
-
-        for k, v in node_info["inputs"].items():
-            if is_link(v):
-                parent_id = v[0]
-                display_id = dynprompt.get_display_node_id(parent_id)
-                display_node = dynprompt.get_node(display_id)
-                class_type = display_node["class_type"]
-                if class_type not in ['LoopReduceClose']:
-                    parent_ids.append(display_id)
-                if parent_id not in upstream:
-                    upstream[parent_id] = []
-                    self.explore_dependencies(parent_id, dynprompt, upstream, parent_ids)
-                upstream[parent_id].append(node_id)
-
-    def loop_close(self, flow_control, current_list, input_size,
-                  iteration_count=0, dynprompt=None, unique_id=None):
+    @release_on_error
+    def loop_close(self, flow_control, current_list, input_size, unroll_factor=1, checkpoint_dir="",
+                  resume=False, iteration_count=0, body_key="", unrolled=False, dynprompt=None, unique_id=None):
+        loop_id = dynprompt.get_display_node_id(flow_control[0])
+        checkpoint_file = checkpoint_path(checkpoint_dir, loop_id) if checkpoint_dir else None
+        fingerprint = prompt_fingerprint(dynprompt, loop_id) if checkpoint_dir else None
+
+        # resume: the open node has already picked up the same checkpoint
+        if resume and checkpoint_file and iteration_count == 0 and not body_key:
+            checkpoint = load_checkpoint(checkpoint_file, input_size=input_size, fingerprint=fingerprint)
+            if checkpoint is not None:
+                iteration_count = checkpoint["iteration"] + 1
+
         print(f"Iteration {iteration_count} of {input_size}")
 
+        # checkpoint the completed iteration, removed once the loop ends
+        if checkpoint_file and iteration_count >= input_size - 1:
+            remove_checkpoint(checkpoint_file)
+        elif checkpoint_file:
+            # values that torch.load(weights_only=True) cannot read back would make resume start over,
+            # keep the last checkpoint the list could still be restored from instead
+            unsupported = unloadable_types(list_schema(current_list))
+            if unsupported:
+                names = ", ".join(sorted(t.__name__ for t in unsupported))
+                print(f"Not checkpointing iteration {iteration_count} of loop {loop_id}: "
+                      f"its list holds values that cannot be restored ({names})")
+            else:
+                save_checkpoint(checkpoint_file, {
+                    "iteration": iteration_count,
+                    "input_size": input_size,
+                    "fingerprint": fingerprint,
+                    "previous_list": list(current_list),
+                })
+
         # Loop End
         if iteration_count >= input_size - 1:
             print(f"Loop finished with {iteration_count + 1} iterations")
-            return (current_list[-input_size:],)
+            LOOP_STATE_STORE.release_loop(body_key)
+            final_list = current_list[-input_size:]
+            # a tensor list is returned as one IMAGE/MASK batch as well, a view of its buffer
+            final_batch = final_list.as_batch() if isinstance(final_list, TensorList) else None
+            # the shared list stays inside the loop, downstream nodes get a plain python list
+            return (list(final_list), final_batch)
+
+        # Intermediate unrolled copy: hand the whole list to the next copy's open node
+        if unrolled:
+            return (current_list, None)
         
-        # prepare next iteration
-        this_node = dynprompt.get_node(unique_id)
-        upstream = {}
-        parent_ids = []
-        self.explore_dependencies(unique_id, dynprompt, upstream, parent_ids)
-        parent_ids = list(set(parent_ids))
-
-        # Getting and processing output nodes
-        prompts = dynprompt.get_original_prompt()
-        output_nodes = {}
-        for id in prompts:
-            node = prompts[id]
-            if "inputs" not in node:
-                continue
-            class_type = node["class_type"]
-            if class_type in ALL_NODE_CLASS_MAPPINGS:
-                class_def = ALL_NODE_CLASS_MAPPINGS[class_type]
-                if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
-                    for k, v in node['inputs'].items():
-                        if is_link(v):
-                            output_nodes[id] = v
-
-        # Creating a New Diagram
-        graph = GraphBuilder()
-        self.explore_output_nodes(dynprompt, upstream, output_nodes, parent_ids) ###
-        
-        contained = {}
-        open_node = flow_control[0]
-        self.collect_contained(open_node, upstream, contained)
-        contained[unique_id] = True
-        contained[open_node] = True
-
-        # Create a node
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.node(original_node["class_type"], 
-                            "Recurse" if node_id == unique_id else node_id)
-            node.set_override_display_id(node_id)
-            
-        # Setting up the connection
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.lookup_node("Recurse" if node_id == unique_id else node_id)
-            for k, v in original_node["inputs"].items():
-                if is_link(v) and v[0] in contained:
-                    parent = graph.lookup_node(v[0])
-                    node.set_input(k, parent.out(v[1]))
-                else:
-                    node.set_input(k, v)
+        # prepare next iteration: the loop body is discovered on the first iteration only,
+        # later iterations clone the cached template
+        body_key, body = LOOP_BODY_CACHE.lookup(
+            dynprompt, flow_control[0], unique_id, body_key, exclude_types=['LoopReduceClose']
+        )
+        # expand unroll_factor iterations at once, the last chunk only covers the remaining ones
+        copies = min(unroll_factor, input_size - 1 - iteration_count)
+        graph, clones = body.build(copies)
+
+        # keep the list out of band, only a handle goes into the graph
+        state_handle = LOOP_STATE_STORE.put(body_key, iteration_count + 1, {
+            "previous_list": current_list,
+        }, dynprompt.get_original_prompt())
 
         # Setting Node Parameters
-        my_clone = graph.lookup_node("Recurse")
-        my_clone.set_input("iteration_count", iteration_count + 1)
-        
-        new_open = graph.lookup_node(open_node)
-        new_open.set_input("iteration_count", iteration_count + 1)
-        new_open.set_input("previous_list", current_list)
-
-        print(f"Continuing to iteration {iteration_count + 1}")
+        previous = None
+        for j, (my_clone, new_open) in enumerate(clones):
+            my_clone.set_input("iteration_count", iteration_count + 1 + j)
+            my_clone.set_input("body_key", body_key)
+            my_clone.set_input("unrolled", j < copies - 1)
+            new_open.set_input("iteration_count", iteration_count + 1 + j)
+            if previous is None:
+                new_open.set_input("state_handle", state_handle)
+            else:
+                new_open.set_input("state_handle", "")
+                new_open.set_input("previous_list", previous.out(0))
+            previous = my_clone
+
+        print(f"Continuing to iteration {iteration_count + 1}" + (f" (unrolled x{copies})" if copies > 1 else ""))
 
         return {
-            "result": tuple([my_clone.out(0)[-input_size:]]),
+            "result": tuple([my_clone.out(0)[-input_size:], my_clone.out(1)]),
             "expand": graph.finalize(),
         }
-    def explore_output_nodes(self, dynprompt, upstream, output_nodes, parent_ids):
-        for parent_id in upstream:
-            display_id = dynprompt.get_display_node_id(parent_id)
-            for output_id in output_nodes:
-                id = output_nodes[output_id][0]
-                if id in parent_ids and display_id == id and output_id not in upstream[parent_id]:
-                    if '.' in parent_id:
-                        arr = parent_id.split('.')
-                        arr[len(arr)-1] = output_id
-                        upstream[parent_id].append('.'.join(arr))
-                    else:
-                        upstream[parent_id].append(output_id)
-    def collect_contained(self, node_id, upstream, contained):
-        if node_id not in upstream:
-            return
-        for child_id in upstream[node_id]:
-            if child_id not in contained:
-                contained[child_id] = True
-                self.collect_contained(child_id, upstream, contained)
-                
+
 @VariantSupport()
 class LoopIndexSwitch:
     def __init__(self):
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+
+from comfy_execution.graph_utils import GraphBuilder, is_link
+from nodes import NODE_CLASS_MAPPINGS as ALL_NODE_CLASS_MAPPINGS
+
+
+class LoopBody:
+    """
+    循环体模板
+    - nodes: [(node_id, class_type, inputs)]，inputs为 [(key, value, 是否为循环体内部连接)]
+    - 包含开始/结束节点、两者之间的节点以及挂接的输出节点
+    节点ID为首次迭代时的ID，之后每次迭代只需克隆到新的GraphBuilder
+    """
+
+    def __init__(self, open_node, close_node, nodes):
+        self.open_node = open_node
+        self.close_node = close_node
+        self.nodes = nodes
+
+    def local_id(self, node_id, tag=""):
+        return tag + ("Recurse" if node_id == self.close_node else node_id)
+
+    def build(self, copies=1):
+        """
+        克隆模板，返回 (graph, [(结束节点的克隆, 开始节点的克隆)])
+        - copies: 克隆的份数（循环展开），最后一份使用原有ID，之前的加上前缀区分
+        各份之间的连接由调用方设置
+        """
+        graph = GraphBuilder()
+        tags = [f"unroll{j}." for j in range(copies - 1)] + [""]
+        for tag in tags:
+            for node_id, class_type, _ in self.nodes:
+                node = graph.node(class_type, self.local_id(node_id, tag))
+                node.set_override_display_id(node_id)
+
+        for tag in tags:
+            for node_id, _, inputs in self.nodes:
+                node = graph.lookup_node(self.local_id(node_id, tag))
+                for k, v, internal in inputs:
+                    if internal:
+                        node.set_input(k, graph.lookup_node(self.local_id(v[0], tag)).out(v[1]))
+                    else:
+                        node.set_input(k, v)
+
+        return graph, [
+            (graph.lookup_node(self.local_id(self.close_node, tag)), graph.lookup_node(self.local_id(self.open_node, tag)))
+            for tag in tags
+        ]
+
+
+def find_output_nodes(dynprompt):
+    """扫描原始prompt中的输出节点，返回 {输出节点ID: 最后一个连接的输入}"""
+    prompts = dynprompt.get_original_prompt()
+    output_nodes = {}
+    for id in prompts:
+        node = prompts[id]
+        if "inputs" not in node:
+            continue
+        class_type = node["class_type"]
+        if class_type in ALL_NODE_CLASS_MAPPINGS:
+            class_def = ALL_NODE_CLASS_MAPPINGS[class_type]
+            if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
+                for k, v in node['inputs'].items():
+                    if is_link(v):
+                        output_nodes[id] = v
+    return output_nodes
+
+
+def explore_dependencies(dynprompt, close_node, exclude_types=()):
+    """
+    从结束节点向上游遍历（显式栈，不受递归深度限制）
+    返回 (upstream, parent_ids, display_ids)
+    - upstream: {节点ID: [下游节点ID]}，包含结束节点上游的所有节点
+    - parent_ids: 上游节点的显示ID集合（不含exclude_types类型的节点）
+    - display_ids: {节点ID: 显示ID}
+    """
+    upstream = {}
+    parent_ids = set()
+    display_ids = {}
+    stack = [close_node]
+    while stack:
+        node_id = stack.pop()
+        node_info = dynprompt.get_node(node_id)
+        if "inputs" not in node_info:
+            continue
+        for k, v in node_info["inputs"].items():
+            if not is_link(v):
+                continue
+            parent_id = v[0]
+            if parent_id not in display_ids:
+                display_ids[parent_id] = dynprompt.get_display_node_id(parent_id)
+            display_id = display_ids[parent_id]
+            if dynprompt.get_node(display_id)["class_type"] not in exclude_types:
+                parent_ids.add(display_id)
+            if parent_id not in upstream:
+                upstream[parent_id] = []
+                stack.append(parent_id)
+            upstream[parent_id].append(node_id)
+    return upstream, parent_ids, display_ids
+
+
+def attach_output_nodes(upstream, output_nodes, parent_ids, display_ids):
+    """
+    把连接在上游节点上的输出节点挂到对应节点的下游
+    先按来源显示ID建立索引，每个上游节点只查一次
+    """
+    by_source = {}
+    for output_id, link in output_nodes.items():
+        if link[0] in parent_ids:
+            by_source.setdefault(link[0], []).append(output_id)
+
+    for parent_id, children in upstream.items():
+        for output_id in by_source.get(display_ids[parent_id], ()):
+            if output_id in children:
+                continue
+            if '.' in parent_id:
+                # 展开后的节点，输出节点使用同一前缀
+                children.append(parent_id.rsplit('.', 1)[0] + '.' + output_id)
+            else:
+                children.append(output_id)
+
+
+def collect_contained(open_node, upstream):
+    """从开始节点向下游遍历，返回循环体包含的节点（保持发现顺序）"""
+    contained = {open_node: True}
+    stack = [open_node]
+    while stack:
+        node_id = stack.pop()
+        for child_id in upstream.get(node_id, ()):
+            if child_id not in contained:
+                contained[child_id] = True
+                stack.append(child_id)
+    return contained
+
+
+def discover_loop_body(dynprompt, open_node, close_node, exclude_types=()):
+    """
+    发现循环体，整体为 O(V+E)
+    - exclude_types: 不作为输出节点挂接来源的节点类型（通常是结束节点自身的类型）
+    """
+    upstream, parent_ids, display_ids = explore_dependencies(dynprompt, close_node, exclude_types)
+    attach_output_nodes(upstream, find_output_nodes(dynprompt), parent_ids, display_ids)
+
+    contained = collect_contained(open_node, upstream)
+    contained[close_node] = True
+
+    nodes = []
+    for node_id in contained:
+        original_node = dynprompt.get_node(node_id)
+        inputs = [(k, v, is_link(v) and v[0] in contained) for k, v in original_node["inputs"].items()]
+        nodes.append((node_id, original_node["class_type"], inputs))
+    return LoopBody(open_node, close_node, nodes)
+
+
+class LoopBodyCache:
+    """
+    循环体模板的LRU缓存，键为 (prompt, 开始节点, 结束节点)
+    首次迭代发现循环体后，通过隐藏输入body_key把键传给下一次迭代的结束节点，
+    之后的迭代不再遍历整个prompt
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(dynprompt, open_node, close_node):
+        return f"{id(dynprompt.get_original_prompt())}:{open_node}:{close_node}"
+
+    def get(self, key, dynprompt):
+        entry = self.entries.get(key)
+        # id()可能被新的prompt复用，需要确认是同一个prompt
+        if entry is None or entry[0] is not dynprompt.get_original_prompt():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, dynprompt, body):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (dynprompt.get_original_prompt(), body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, dynprompt, open_node, unique_id, body_key="", exclude_types=()):
+        """
+        获取循环体模板，返回 (body_key, body)
+        - body_key: 上一次迭代传下来的键，为空表示本次循环的第一次迭代
+        """
+        if body_key:
+            body = self.get(body_key, dynprompt)
+            if body is not None:
+                return body_key, body
+        else:
+            body_key = self.make_key(dynprompt, open_node, unique_id)
+        body = discover_loop_body(dynprompt, open_node, unique_id, exclude_types)
+        self.put(body_key, dynprompt, body)
+        return body_key, body
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+LOOP_BODY_CACHE = LoopBodyCache()
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import re
+import shutil
+from collections import OrderedDict
+
+import torch
+
+# 最近计算的prompt指纹，键为 (prompt的id, 开始节点的显示ID)，每次迭代保存检查点时不再遍历prompt
+_FINGERPRINTS = OrderedDict()
+_MAX_FINGERPRINTS = 16
+
+# 开始节点上只影响检查点本身、不影响循环输入的参数
+_CHECKPOINT_INPUTS = ("resume", "checkpoint_dir")
+
+# torch.load(weights_only=True)能读取的值的类型（容器中的元素也须为这些类型）
+_LOADABLE_TYPES = (bool, int, float, complex, str, bytes, type(None), torch.Tensor, list, tuple, dict)
+
+
+def checkpoint_path(directory, loop_id):
+    """检查点文件路径，每个循环（以开始节点的显示ID区分）一个文件"""
+    name = re.sub(r"[^\w.-]", "_", str(loop_id))
+    return os.path.join(directory, f"loop_{name}.pt")
+
+
+def parts_dir(path):
+    """按迭代增量保存的结果块所在的目录"""
+    return os.path.splitext(path)[0] + ".parts"
+
+
+def prompt_fingerprint(dynprompt, open_node):
+    """
+    循环输入的指纹：开始节点及其所有上游节点的类型、参数和连接的哈希
+    开始节点和结束节点都从原始prompt计算，得到同一个值；
+    输入图片、种子等参数不同的任务留下的检查点因此不会被误用
+    """
+    prompt = dynprompt.get_original_prompt()
+    key = (id(prompt), open_node)
+    entry = _FINGERPRINTS.get(key)
+    # id()可能被新的prompt复用，需要确认是同一个prompt
+    if entry is not None and entry[0] is prompt:
+        return entry[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    seen = set()
+    stack = [open_node]
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or node_id not in prompt:
+            continue
+        seen.add(node_id)
+        node = prompt[node_id]
+        inputs = sorted(
+            (k, v) for k, v in node.get("inputs", {}).items()
+            if not (node_id == open_node and k in _CHECKPOINT_INPUTS)
+        )
+        digest.update(repr((node_id, node.get("class_type"), inputs)).encode())
+        for _, v in inputs:
+            if isinstance(v, list) and len(v) == 2 and isinstance(v[0], str):
+                stack.append(v[0])
+    fingerprint = digest.hexdigest()
+
+    _FINGERPRINTS[key] = (prompt, fingerprint)
+    while len(_FINGERPRINTS) > _MAX_FINGERPRINTS:
+        _FINGERPRINTS.popitem(last=False)
+    return fingerprint
+
+
+def _save_atomic(path, state):
+    """先写临时文件再替换，进程中途退出时不会留下损坏的文件"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(path, state):
+    """保存循环状态（迭代次数、指纹等小字段，累积的结果见save_checkpoint_part）"""
+    _save_atomic(path, state)
+
+
+def save_checkpoint_part(path, index, state):
+    """
+    保存第index次迭代新完成的结果块
+    每次迭代只写入本次的结果，写入量与已完成的迭代次数无关；
+    先于save_checkpoint调用，检查点记录的迭代的结果块总是已经存在
+    """
+    _save_atomic(os.path.join(parts_dir(path), f"{index}.pt"), state)
+
+
+def unloadable_types(schema):
+    """
+    列表元素类型（persistent_list.element_type的集合）中检查点无法读回的类型
+    保存前检查，否则继续执行时读取失败，循环会从头开始
+    """
+    result = set()
+    for entry in schema:
+        if isinstance(entry, tuple):
+            # 嵌套列表，逐层检查其元素类型
+            result |= unloadable_types(entry[1])
+        elif not issubclass(entry, _LOADABLE_TYPES):
+            result.add(entry)
+    return result
+
+
+def load_checkpoint(path, map_location=None, **expected):
+    """
+    读取检查点
+    - expected: 必须一致的字段（例如max_iterations、fingerprint），不一致时视为其他任务的检查点
+    文件不存在、无法读取或不匹配时返回None，循环从头开始
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        state = torch.load(path, map_location=map_location, weights_only=True)
+    except Exception as e:
+        print(f"Ignoring unreadable loop checkpoint {path}: {e}")
+        return None
+    for key, value in expected.items():
+        if state.get(key) != value:
+            print(f"Ignoring loop checkpoint {path}: {key} is {state.get(key)}, expected {value}")
+            return None
+    print(f"Resuming loop from checkpoint {path} after iteration {state['iteration']}")
+    return state
+
+
+def load_checkpoint_parts(path, count, map_location=None):
+    """按顺序读取前count次迭代的结果块，缺失或损坏时抛出异常（检查点已被开始节点采用，不能静默从头开始）"""
+    parts = []
+    for index in range(count):
+        part_path = os.path.join(parts_dir(path), f"{index}.pt")
+        try:
+            parts.append(torch.load(part_path, map_location=map_location, weights_only=True))
+        except Exception as e:
+            raise RuntimeError(f"Loop checkpoint {path} is missing the results of iteration {index}, "
+                               f"delete it or disable resume: {e}")
+    return parts
+
+
+def remove_checkpoint(path):
+    """循环正常结束后删除检查点及其结果块"""
+    if os.path.exists(path):
+        os.remove(path)
+    shutil.rmtree(parts_dir(path), ignore_errors=True)
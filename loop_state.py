@@ -0,0 +1,327 @@
+import functools
+import math
+import os
+import tempfile
+
+import torch
+
+
+IMAGE_STORAGE = ["float32", "float16", "bfloat16"]
+MASK_STORAGE = ["float32", "uint8", "bitpacked"]
+ACCUMULATORS = ["memory", "disk", "auto"]
+
+IMAGE_STORAGE_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def image_storage_dtype(storage):
+    if storage not in IMAGE_STORAGE_DTYPES:
+        raise ValueError(f"Unknown image storage: {storage}")
+    return IMAGE_STORAGE_DTYPES[storage]
+
+
+def should_spill(accumulator, nbytes, ram_budget_mb=0):
+    """
+    结果缓冲是否放到磁盘
+    - memory: 始终在内存（或显存）中
+    - disk: 始终使用内存映射文件
+    - auto: 超过ram_budget_mb时使用内存映射文件
+    """
+    if accumulator == "memory":
+        return False
+    if accumulator == "disk":
+        return True
+    if accumulator == "auto":
+        return nbytes > ram_budget_mb * 1024 * 1024
+    raise ValueError(f"Unknown accumulator: {accumulator}")
+
+
+def allocate_buffer(shape, dtype, device=None, spill_dir=None):
+    """
+    分配初始为0的缓冲
+    - spill_dir: 不为None时放在该目录（空字符串表示系统临时目录）下的内存映射文件中，
+      只有访问到的页才会读入内存，内存占用不随缓冲大小增长
+    """
+    if spill_dir is None:
+        device = device if device is not None else torch.device('cpu')
+        return torch.zeros(shape, dtype=dtype, device=device)
+
+    fd, path = tempfile.mkstemp(prefix="loop_accumulator_", suffix=".bin", dir=spill_dir or None)
+    os.close(fd)
+    buffer = torch.from_file(path, shared=True, size=math.prod(shape), dtype=dtype).view(shape)
+    try:
+        # 映射建立后即可删除文件，缓冲释放时磁盘空间随之回收
+        os.remove(path)
+    except OSError:
+        # Windows上无法删除映射中的文件，留在spill_dir中
+        print(f"Could not remove accumulator file {path}")
+    return buffer
+
+
+# 内存映射缓冲转换精度时每块的大小，峰值内存只增加这么多
+CONVERT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def spill_location(buffer):
+    """内存映射缓冲（allocate_buffer）所在的目录，普通缓冲返回None"""
+    filename = buffer.untyped_storage().filename
+    return None if filename is None else os.path.dirname(filename)
+
+
+def convert_buffer(buffer, dtype, decode=None, shape=None):
+    """
+    转换缓冲的精度
+    - decode / shape: 可选，把一块存储数据解码为dtype的函数及解码后整个缓冲的形状
+    内存映射的缓冲解码到同一目录下新的内存映射缓冲中，每次转换CONVERT_CHUNK_BYTES左右，
+    峰值内存与缓冲大小无关；普通缓冲整体转换，无需转换时直接返回
+    """
+    if decode is None:
+        if buffer.dtype == dtype:
+            return buffer
+        decode = lambda data: data.to(dtype)
+    spill_dir = spill_location(buffer)
+    if spill_dir is None:
+        return decode(buffer)
+
+    result = allocate_buffer(tuple(shape) if shape is not None else tuple(buffer.shape), dtype, buffer.device, spill_dir)
+    slot_bytes = max(buffer[:1].numel() * buffer.element_size(), result[:1].numel() * result.element_size(), 1)
+    rows = max(1, CONVERT_CHUNK_BYTES // slot_bytes)
+    for start in range(0, buffer.shape[0], rows):
+        result[start:start + rows] = decode(buffer[start:start + rows])
+    return result
+
+
+def pack_bits(masks):
+    """[N,H,W] 蒙版按0.5二值化后沿W方向每8个像素打包为一个uint8 -> [N,H,ceil(W/8)]"""
+    width = masks.shape[-1]
+    bits = (masks > 0.5).to(torch.uint8)
+    pad = (-width) % 8
+    if pad:
+        bits = torch.nn.functional.pad(bits, (0, pad))
+    bits = bits.view(*bits.shape[:-1], -1, 8)
+    weights = torch.tensor([1 << i for i in range(8)], dtype=torch.uint8, device=masks.device)
+    return (bits * weights).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, width, dtype=torch.float32):
+    """pack_bits的逆操作 -> [N,H,W]"""
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.view(*packed.shape[:-1], -1)[..., :width].to(dtype)
+
+
+class MaskStore:
+    """
+    按存储策略保存循环中累积的 [N,H,W] 蒙版
+    - float32: 原样保存
+    - uint8: 量化为0-255，内存为float32的1/4
+    - bitpacked: 二值化后按位打包，内存为float32的1/32
+    只有to_dense时才展开为浮点MASK
+    """
+
+    def __init__(self, count, height, width, storage="float32", device=None, spill_dir=None):
+        """spill_dir: 不为None时保存在内存映射文件中，见allocate_buffer"""
+        self.height = height
+        self.width = width
+        self.storage = storage
+        if storage == "float32":
+            self.data = allocate_buffer((count, height, width), torch.float32, device, spill_dir)
+        elif storage == "uint8":
+            self.data = allocate_buffer((count, height, width), torch.uint8, device, spill_dir)
+        elif storage == "bitpacked":
+            self.data = allocate_buffer((count, height, (width + 7) // 8), torch.uint8, device, spill_dir)
+        else:
+            raise ValueError(f"Unknown mask storage: {storage}")
+
+    @staticmethod
+    def slot_bytes(height, width, storage="float32"):
+        """每个蒙版占用的字节数"""
+        if storage == "float32":
+            return height * width * 4
+        if storage == "uint8":
+            return height * width
+        return height * ((width + 7) // 8)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
+
+    def encode(self, masks):
+        if self.storage == "float32":
+            return masks.to(torch.float32)
+        if self.storage == "uint8":
+            return (masks.float().clamp(0, 1) * 255).round().to(torch.uint8)
+        return pack_bits(masks)
+
+    def store(self, index, masks):
+        """从第index个位置开始写入 [k,H,W] 蒙版"""
+        assert tuple(masks.shape[1:]) == (self.height, self.width), \
+            f"Mask shape {tuple(masks.shape[1:])} does not match stored masks {(self.height, self.width)}"
+        self.data[index:index + masks.shape[0]] = self.encode(masks).to(self.data.device)
+
+    def decode(self, data, dtype=torch.float32):
+        """把存储的数据展开为浮点MASK"""
+        if self.storage == "float32":
+            return data.to(dtype)
+        if self.storage == "uint8":
+            return data.to(dtype) / 255.0
+        return unpack_bits(data, self.width, dtype)
+
+    def to_dense(self, dtype=torch.float32, count=None):
+        """
+        展开前count个（默认全部）为浮点MASK [N,H,W]
+        保存在内存映射文件中时展开到同一目录下的内存映射文件，按块解码，不在内存中生成整批副本
+        """
+        data = self.data if count is None else self.data[:count]
+        if self.storage == "float32":
+            return convert_buffer(data, dtype)
+        return convert_buffer(data, dtype, lambda chunk: self.decode(chunk, dtype),
+                              (data.shape[0], self.height, self.width))
+
+    def state_dict(self):
+        """只包含张量和基本类型，用于保存检查点"""
+        return {"height": self.height, "width": self.width, "storage": self.storage, "data": self.data}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        result = cls(0, state["height"], state["width"], state["storage"], state["data"].device)
+        result.data = state["data"]
+        return result
+
+
+class HistoryRing:
+    """
+    SingleImageLoop的迭代历史，预先分配的环形缓冲，只保留最近size次记录
+    - stride: 每stride次迭代记录一次（第0, stride, 2*stride...次）
+    - image_storage: 图片的存储精度；float32时蒙版原样保存，否则量化为uint8
+    每次记录保存一整批 [B,H,W,C]，第一次记录时按其尺寸分配缓冲
+    """
+
+    def __init__(self, size, stride=1, image_storage="float32"):
+        self.size = size
+        self.stride = stride
+        self.image_storage = image_storage
+        self.count = 0  # 已记录的次数
+        self.images = None  # [size,B,H,W,C]
+        self.masks = None  # MaskStore，size*B个蒙版
+
+    def record(self, iteration, image, mask=None):
+        if iteration % self.stride != 0:
+            return
+        if self.images is None:
+            self.images = torch.zeros((self.size, *image.shape), dtype=image_storage_dtype(self.image_storage),
+                                      device=image.device)
+            mask_storage = "float32" if self.image_storage == "float32" else "uint8"
+            self.masks = MaskStore(self.size * image.shape[0], image.shape[1], image.shape[2],
+                                   mask_storage, image.device)
+        if tuple(image.shape) != tuple(self.images.shape[1:]):
+            raise ValueError(f"Iteration history needs images of a fixed shape, got {tuple(image.shape)} "
+                             f"after {tuple(self.images.shape[1:])}")
+
+        slot = self.count % self.size
+        batch = image.shape[0]
+        self.images[slot] = image
+        if mask is None:
+            mask = torch.zeros(image.shape[:3], device=image.device)
+        self.masks.store(slot * batch, mask.expand(batch, -1, -1))
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def to_outputs(self, image_dtype=torch.float32, mask_dtype=torch.float32):
+        """按从旧到新的顺序输出 (images [n*B,H,W,C], masks [n*B,H,W])"""
+        if self.images is None:
+            return None, None
+        n = len(self)
+        order = [(self.count - n + i) % self.size for i in range(n)]
+        batch = self.images.shape[1]
+        images = self.images[order].flatten(0, 1).to(image_dtype)
+        masks = self.masks.to_dense(mask_dtype).view(self.size, batch, self.masks.height, self.masks.width)
+        masks = masks[order].flatten(0, 1)
+        return images, masks
+
+    def state_dict(self):
+        """只包含张量和基本类型，用于保存检查点"""
+        return {"size": self.size, "stride": self.stride, "image_storage": self.image_storage,
+                "count": self.count, "images": self.images,
+                "masks": self.masks.state_dict() if self.masks is not None else None}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        result = cls(state["size"], state["stride"], state["image_storage"])
+        result.count = state["count"]
+        result.images = state["images"]
+        if state["masks"] is not None:
+            result.masks = MaskStore.from_state_dict(state["masks"])
+        return result
+
+
+class LoopStateStore:
+    """
+    循环状态的带外存储
+    结束节点把下一次迭代需要的状态（结果缓冲、传回的图片、列表等）放在这里，
+    展开的图中只传递一个字符串句柄，执行器不需要对大张量做哈希、复制和缓存
+    - 每个循环只保留最新一次迭代的状态，循环结束或结束节点出错时释放
+    - 存入新prompt的状态时，丢弃之前prompt遗留的状态（例如执行中断）
+    - 最多保留max_loops个循环的状态，循环体中的节点出错时结束节点不会再执行，
+      超出时丢弃最早存入的循环
+    """
+
+    def __init__(self, max_loops=8):
+        self.max_loops = max_loops
+        self.entries = {}  # handle -> (loop_id, prompt, state)，按存入顺序
+
+    @staticmethod
+    def make_handle(loop_id, iteration):
+        return f"{loop_id}#{iteration}"
+
+    def put(self, loop_id, iteration, state, prompt=None):
+        """保存第iteration次迭代的状态，返回句柄"""
+        self.entries = {
+            handle: entry for handle, entry in self.entries.items()
+            if entry[0] != loop_id and (prompt is None or entry[1] is prompt)
+        }
+        handle = self.make_handle(loop_id, iteration)
+        self.entries[handle] = (loop_id, prompt, state)
+        # 每个循环只有一个条目，超出上限时丢弃最早的
+        while len(self.entries) > self.max_loops:
+            del self.entries[next(iter(self.entries))]
+        return handle
+
+    def get(self, handle):
+        entry = self.entries.get(handle)
+        if entry is None:
+            raise ValueError(f"Loop state {handle} is no longer available")
+        return entry[2]
+
+    def release_loop(self, loop_id):
+        """循环结束时释放该循环的所有状态"""
+        self.entries = {handle: entry for handle, entry in self.entries.items() if entry[0] != loop_id}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+LOOP_STATE_STORE = LoopStateStore()
+
+
+def release_on_error(loop_close):
+    """
+    结束节点的装饰器：出错时释放该循环（隐藏输入body_key）保存的状态
+    出错后不会再有节点按句柄取回这些状态，不释放的话结果缓冲会一直占用内存
+    """
+    @functools.wraps(loop_close)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return loop_close(self, *args, **kwargs)
+        except Exception:
+            LOOP_STATE_STORE.release_loop(kwargs.get("body_key", ""))
+            raise
+    return wrapper
@@ -1,7 +1,13 @@
+import math
 import torch
 import torch.nn.functional as F
-import cv2
 import numpy as np
+from .segmentation import (
+    label_components, label_components_torch, filter_segments, sort_segments, apply_morphology,
+    SORT_ORDERS, MORPHOLOGY_OPS
+)
+from .compact_mask import CompactMask
+from .segment_cache import SEGMENT_CACHE
 
 
 class MaskSplit:
@@ -16,124 +22,204 @@ class MaskSplit:
                 "mask": ("MASK",),
 
             },
+            "optional": {
+                "batch_mode": ("BOOLEAN", {"default": False}),  # 分割批次中的所有蒙版
+                "crop_to_bbox": ("BOOLEAN", {"default": False}),  # 只输出包围盒区域
+                "crop_padding": ("INT", {"default": 16, "min": 0, "max": 4096}),
+                "min_area": ("INT", {"default": 0, "min": 0, "max": 0xffffffff}),  # 丢弃小于该面积的区域
+                "top_k": ("INT", {"default": 0, "min": 0, "max": 10000}),  # 只保留面积最大的K个，0为全部
+                "max_count": ("INT", {"default": 0, "min": 0, "max": 10000}),  # 排序后最多保留的数量，0为全部
+                "sort_by": (SORT_ORDERS, {"default": "left_to_right"}),
+                "morphology": (MORPHOLOGY_OPS, {"default": "none"}),  # 只在每个区域的包围盒内执行
+                "morph_radius": ("INT", {"default": 3, "min": 0, "max": 256}),
+                "mask_format": (["dense", "compact"], {"default": "dense"}),  # compact时segmented_masks为空
+                "backend": (["auto", "opencv", "torch"], {"default": "auto"}),  # auto: GPU上的蒙版使用torch
+                "use_cache": ("BOOLEAN", {"default": True}),  # 相同蒙版和选项时复用分割结果
+            },
         }
     
-    RETURN_TYPES = ("IMAGE","MASK")
-    RETURN_NAMES = ("segmented_images","segmented_masks")
+    RETURN_TYPES = ("IMAGE","MASK","LIST","BBOX","COMPACT_MASK")
+    RETURN_NAMES = ("segmented_images","segmented_masks","source_indices","bboxes","compact_masks")
     FUNCTION = "segment_mask"
     
     CATEGORY = "CyberEveLoop🐰"
 
-    def find_top_left_point(self, mask_np):
-        """找到mask中最左上角的点"""
-        # 找到所有非零点
-        y_coords, x_coords = np.nonzero(mask_np)
-        if len(x_coords) == 0:
-            return float('inf'), float('inf')
-        
-        # 找到最小x值
-        min_x = np.min(x_coords)
-        # 在最小x值的点中找到最小y值
-        min_y = np.min(y_coords[x_coords == min_x])
+    def crop_windows(self, segments, height, width, padding):
+        """
+        计算每个区域的裁剪窗口 (x, y, w, h)
+        所有窗口尺寸相同（最大包围盒+padding，不超过画布），以便组成一个批次
+        窗口以区域包围盒为中心，并限制在画布内
+        """
+        crop_w = min(width, max(seg.w for seg in segments) + 2 * padding)
+        crop_h = min(height, max(seg.h for seg in segments) + 2 * padding)
+        windows = []
+        for seg in segments:
+            x0 = min(max(seg.x + seg.w // 2 - crop_w // 2, 0), width - crop_w)
+            y0 = min(max(seg.y + seg.h // 2 - crop_h // 2, 0), height - crop_h)
+            windows.append((x0, y0, crop_w, crop_h))
+        return windows
+
+    def crop_images(self, windows, image, image_indices):
+        """按裁剪窗口生成 [N,h,w,C] 图像"""
+        crop_w, crop_h = windows[0][2], windows[0][3]
+        result_images = torch.empty(
+            (len(windows), crop_h, crop_w, image.shape[3]), dtype=image.dtype, device=image.device
+        )
+        for i, (x0, y0, w, h) in enumerate(windows):
+            result_images[i] = image[image_indices[i], y0:y0+h, x0:x0+w]
+        return result_images
+
+    def dense_masks(self, segments, height, width, offsets=None, device=None):
+        """
+        直接由分割区域生成整帧MASK [N,H,W]（dense模式，不经过紧凑格式）
+        - offsets: 可选，每个区域所在画布左上角在原图中的位置（裁剪模式）
+        """
+        result = torch.zeros((len(segments), height, width), dtype=torch.float32, device=device)
+        for i, seg in enumerate(segments):
+            ox, oy = offsets[i] if offsets is not None else (0, 0)
+            x, y = seg.x - ox, seg.y - oy
+            result[i, y:y+seg.h, x:x+seg.w] = torch.as_tensor(seg.roi).to(device, torch.float32)
+        return result
+
+    def frame_segments(self, segments, height, width, min_area=0, top_k=0, max_count=0,
+                       sort_by="left_to_right", morphology="none", morph_radius=3):
+        """
+        处理单帧的连通区域：过滤 -> 排序 -> 截断 -> 形态学
+        全部基于区域统计，形态学只在各区域包围盒内执行
+        """
+        segments = filter_segments(segments, min_area, top_k)
+        segments = sort_segments(segments, sort_by, height, width)
+        if max_count > 0:
+            segments = segments[:max_count]
+        if morphology != "none":
+            segments = [apply_morphology(seg, morphology, morph_radius, height, width) for seg in segments]
+            segments = [seg for seg in segments if seg is not None]
+        return segments
+
+    def label_frames(self, frames, backend="auto"):
+        """
+        标记每帧的连通区域，返回每帧的区域列表
+        - opencv: 转换到CPU/numpy后逐帧标记
+        - torch: 在张量所在设备上批量标记，失败或迭代次数超过上限（蛇形等长路径区域）时回退到opencv
+        - auto: 蒙版不在CPU上时使用torch（同样受迭代上限保护），在CPU上时使用opencv
+        """
+        is_tensor = isinstance(frames, torch.Tensor)
+        use_torch = is_tensor and (backend == "torch" or (backend == "auto" and frames.device.type != 'cpu'))
+        if use_torch:
+            try:
+                return label_components_torch(frames * 255 >= 1)
+            except RuntimeError as e:
+                print(f"Torch labeling failed, falling back to OpenCV: {e}")
         
-        return min_x, min_y
+        if is_tensor:
+            mask_np = (frames * 255).cpu().numpy().astype(np.uint8)
+        else:
+            mask_np = (frames * 255).astype(np.uint8)
+        return [label_components(mask_np[i]) for i in range(mask_np.shape[0])]
 
-    def segment_mask(self, mask, image):
-        """使用OpenCV快速分割蒙版并处理图像"""
+    def segment_mask(self, mask, image, batch_mode=False, crop_to_bbox=False, crop_padding=16,
+                     min_area=0, top_k=0, max_count=0, sort_by="left_to_right",
+                     morphology="none", morph_radius=3, mask_format="dense", backend="auto", use_cache=True):
+        """
+        使用连通域标记快速分割蒙版并处理图像
+        - batch_mode=False: 只分割mask[0]
+        - batch_mode=True: 分割批次中的每个蒙版，source_indices记录每个区域来自第几张
+        - crop_to_bbox=True: 每个区域只输出其包围盒（含padding）内的图像和蒙版，
+          bboxes记录裁剪窗口在原图中的位置 (x, y, w, h)
+        - min_area / top_k / max_count / sort_by / morphology: 见frame_segments，逐帧执行
+        - mask_format: dense时只输出整帧segmented_masks，compact时只输出compact_masks（包围盒位图）
+        - backend: 连通域标记后端，见label_frames
+        - use_cache: 区域列表按前景位图和选项缓存在SEGMENT_CACHE中，重复运行时跳过连通域标记、过滤和形态学
+          （输出的图像和蒙版仍按区域重新生成）
+        """
         # 保存原始设备信息
         device = mask.device if isinstance(mask, torch.Tensor) else torch.device('cpu')
         
-        # 确保mask是正确的形状并转换为numpy数组
+        # 确保mask是正确的形状 [B,H,W]
         if isinstance(mask, torch.Tensor):
             if len(mask.shape) == 2:
                 mask = mask.unsqueeze(0)
-            mask_np = (mask[0] * 255).cpu().numpy().astype(np.uint8)
+            frames = mask if batch_mode else mask[:1]
         else:
-            mask_np = (mask * 255).astype(np.uint8)
-        
-        # 使用OpenCV找到轮廓
-        contours, hierarchy = cv2.findContours(
-            mask_np, 
-            cv2.RETR_TREE,
-            cv2.CHAIN_APPROX_SIMPLE
-        )
+            frames = mask if len(mask.shape) == 3 else mask[np.newaxis]
+            if not batch_mode:
+                frames = frames[:1]
+        height, width = frames.shape[1], frames.shape[2]
         
-        mask_info = []  # 用于排序的信息列表
-        
-        if hierarchy is not None and len(contours) > 0:
-            hierarchy = hierarchy[0]
-            contour_masks = {}
-            
-            # 创建每个轮廓的mask
-            for i, contour in enumerate(contours):
-                mask = np.zeros_like(mask_np)
-                cv2.drawContours(mask, [contour], -1, 255, -1)
-                contour_masks[i] = mask
-
-            # 处理每个轮廓
-            processed_indices = set()
-            
-            for i, (contour, h) in enumerate(zip(contours, hierarchy)):
-                if i in processed_indices:
-                    continue
-                    
-                current_mask = contour_masks[i].copy()
-                child_idx = h[2]
-                
-                if child_idx != -1:
-                    while child_idx != -1:
-                        current_mask = cv2.subtract(current_mask, contour_masks[child_idx])
-                        processed_indices.add(child_idx)
-                        child_idx = hierarchy[child_idx][0]
-                
-                # 找到最左上角的点
-                min_x, min_y = self.find_top_left_point(current_mask)
-                
-                # 转换为tensor
-                mask_tensor = torch.from_numpy(current_mask).float() / 255.0
-                mask_tensor = mask_tensor.unsqueeze(0)
-                mask_tensor = mask_tensor.to(device)
-                
-                # 保存mask和排序信息
-                mask_info.append((mask_tensor, min_x, min_y))
-                processed_indices.add(i)
-        
-        # 如果没有找到任何轮廓，使用原始mask
-        if not mask_info:
-            if isinstance(mask, torch.Tensor):
-                mask_info.append((mask, 0, 0))
-            else:
-                mask_tensor = torch.from_numpy(mask).float()
-                if len(mask_tensor.shape) == 2:
-                    mask_tensor = mask_tensor.unsqueeze(0)
-                mask_tensor = mask_tensor.to(device)
-                mask_info.append((mask_tensor, 0, 0))
+        # 每帧单次遍历得到所有连通区域，帧内过滤并排序（结果与后端无关，不计入缓存键）
+        frame_lists = None
+        if use_cache:
+            cache_key = SEGMENT_CACHE.make_key(
+                frames, (min_area, top_k, max_count, sort_by, morphology, morph_radius)
+            )
+            frame_lists = SEGMENT_CACHE.get(cache_key)
+            if frame_lists is not None:
+                print(f"MaskSplit cache hit: {SEGMENT_CACHE.stats()}")
+        if frame_lists is None:
+            frame_lists = [
+                self.frame_segments(
+                    frame_segments, height, width, min_area, top_k, max_count, sort_by, morphology, morph_radius
+                )
+                for frame_segments in self.label_frames(frames, backend)
+            ]
+            if use_cache:
+                SEGMENT_CACHE.put(cache_key, frame_lists)
         
-        # 根据最左上角点排序
-        mask_info.sort(key=lambda x: (x[1], x[2]))
+        segments = []
+        source_indices = []
+        for frame_idx, frame_segments in enumerate(frame_lists):
+            segments.extend(frame_segments)
+            source_indices.extend([frame_idx] * len(frame_segments))
         
         # 确保image是正确的形状
         if len(image.shape) == 3:
             image = image.unsqueeze(0)
         
-        # 处理masks和images
-        result_masks = None
-        result_images = None
+        compact = mask_format == "compact"
         
-        for mask_tensor, _, _ in mask_info:
-            # 处理masks
-            if result_masks is None:
-                result_masks = mask_tensor
+        # 如果没有找到任何区域，使用原始mask
+        if not segments:
+            if isinstance(mask, torch.Tensor):
+                result_masks = mask
             else:
-                result_masks = torch.cat([result_masks, mask_tensor], dim=0)
-            
-            # 处理images
-            if result_images is None:
-                result_images = image.clone()
+                result_masks = torch.from_numpy(mask).float()
+                if len(result_masks.shape) == 2:
+                    result_masks = result_masks.unsqueeze(0)
+                result_masks = result_masks.to(device)
+            full_frame = (0, 0, result_masks.shape[2], result_masks.shape[1])
+            compact_masks = CompactMask.from_dense(result_masks) if compact else None
+            return (image.clone(), None if compact else result_masks, list(range(result_masks.shape[0])),
+                    [full_frame] * result_masks.shape[0], compact_masks)
+        
+        if batch_mode:
+            assert image.shape[0] in (1, frames.shape[0]), \
+                f"Batch size mismatch: image {image.shape[0]} vs mask {frames.shape[0]}"
+            image_indices = source_indices if image.shape[0] > 1 else [0] * len(segments)
+        else:
+            image_indices = [0] * len(segments)
+        
+        # 处理masks和images
+        if crop_to_bbox:
+            # 裁剪模式：只输出包围盒区域，蒙版画布为裁剪窗口
+            windows = self.crop_windows(segments, height, width, crop_padding)
+            result_images = self.crop_images(windows, image, image_indices)
+            canvas = (windows[0][3], windows[0][2])
+            offsets = [(x0, y0) for x0, y0, _, _ in windows]
+        else:
+            windows = [(0, 0, width, height)] * len(segments)
+            if batch_mode:
+                result_images = image[image_indices]
             else:
-                result_images = torch.cat([result_images, image.clone()], dim=0)
+                result_images = image.repeat(len(segments), 1, 1, 1)
+            canvas = (height, width)
+            offsets = None
         
-        return (result_images, result_masks)
+        # 只生成所选格式的蒙版
+        if compact:
+            compact_masks = CompactMask.from_segments(segments, canvas[0], canvas[1], offsets, device)
+            return (result_images, None, source_indices, windows, compact_masks)
+        result_masks = self.dense_masks(segments, canvas[0], canvas[1], offsets, device)
+        return (result_images, result_masks, source_indices, windows, None)
 
 
 
@@ -150,6 +236,9 @@ class MaskMerge:
             "optional": {
                 "processed_images": ("IMAGE", {"forceInput": True}),
                 "masks": ("MASK", {"forceInput": True}),
+                "source_indices": ("LIST", {"forceInput": True}),  # 每个区域对应的原图索引
+                "bboxes": ("BBOX", {"forceInput": True}),  # 裁剪区域在原图中的位置
+                "compact_masks": ("COMPACT_MASK", {"forceInput": True}),  # 可代替masks
             }
         }
     
@@ -213,60 +302,299 @@ class MaskMerge:
             
         return x
 
-    def merge_masked_images(self, original_image, processed_images=None, masks=None):
-        """合并处理后的图像"""
+    def paste_crops(self, result, processed_images, masks, bboxes, source_indices=None):
+        """将裁剪区域按bboxes贴回结果图像，只在包围盒内混合"""
+        assert len(bboxes) == processed_images.shape[0], \
+            f"bboxes length {len(bboxes)} does not match {processed_images.shape[0]} processed images"
+        for i in range(processed_images.shape[0]):
+            x, y, w, h = bboxes[i]
+            current_image = processed_images[i:i+1]
+            current_mask = masks[i:i+1]
+            
+            # 调整裁剪区域尺寸以匹配包围盒（如果需要）
+            if current_image.shape[1:3] != (h, w):
+                current_image = self.resize_tensor(current_image, (h, w), mode='bilinear')
+            if current_mask.shape[1:3] != (h, w):
+                current_mask = F.interpolate(
+                    current_mask.unsqueeze(1), size=(h, w), mode='bilinear', align_corners=False
+                ).squeeze(1)
+            current_mask = current_mask.unsqueeze(-1)
+            
+            if source_indices is None:
+                region = result[:, y:y+h, x:x+w]
+                result[:, y:y+h, x:x+w] = current_mask * current_image + (1 - current_mask) * region
+            else:
+                idx = source_indices[i]
+                region = result[idx:idx+1, y:y+h, x:x+w]
+                result[idx:idx+1, y:y+h, x:x+w] = current_mask * current_image + (1 - current_mask) * region
+        return result
+
+    def paste_compact(self, result, processed_images, compact_masks, bboxes=None, source_indices=None):
+        """
+        按紧凑蒙版贴回结果图像，只在每个蒙版的包围盒内混合
+        - bboxes: 可选，蒙版画布（裁剪窗口）在原图中的位置
+        """
+        assert len(compact_masks) == processed_images.shape[0], \
+            f"compact_masks length {len(compact_masks)} does not match {processed_images.shape[0]} processed images"
+        canvas = (compact_masks.height, compact_masks.width)
+        if processed_images.shape[1:3] != canvas:
+            processed_images = self.resize_tensor(processed_images, canvas, mode='bilinear')
+        
+        for i in range(len(compact_masks)):
+            (mx, my, mw, mh), crop = compact_masks.crop(i, result.dtype)
+            if mw == 0:
+                continue
+            ox, oy = (bboxes[i][0], bboxes[i][1]) if bboxes is not None else (0, 0)
+            x, y = ox + mx, oy + my
+            current_image = processed_images[i:i+1, my:my+mh, mx:mx+mw]
+            current_mask = crop.to(result.device).unsqueeze(0).unsqueeze(-1)
+            if source_indices is None:
+                batch = slice(None)
+            else:
+                batch = slice(source_indices[i], source_indices[i] + 1)
+            region = result[batch, y:y+mh, x:x+mw]
+            result[batch, y:y+mh, x:x+mw] = current_mask * current_image + (1 - current_mask) * region
+        return result
+
+    def composite(self, result, processed_images, masks):
+        """
+        按顺序合成所有图像（后写入者优先），结果写回result
+        二值蒙版时每个像素只取最后一个覆盖它的图像：
+        - 逐个蒙版更新索引图（覆盖该像素的最后一个图像的编号），只读写单通道的蒙版大小的张量
+        - 最后一次gather取出对应像素并写入result，图像只被读写一次
+        蒙版含0和1以外的值（软边缘）时改用composite_soft
+        """
+        height, width, channels = processed_images.shape[1:]
+        # 编号使用整数，float16/bfloat16的蒙版超过2048/256个时无法精确表示编号
+        last = torch.zeros((height, width), dtype=torch.int32, device=masks.device)
+        scratch = torch.empty((height, width), dtype=masks.dtype, device=masks.device)
+        hit = torch.empty((height, width), dtype=torch.bool, device=masks.device)
+        softness = torch.zeros((), dtype=masks.dtype, device=masks.device)
+        for i in range(masks.shape[0]):
+            # 小数部分只在0和1之间的值上非零
+            torch.frac(masks[i], out=scratch)
+            torch.maximum(softness, scratch.amax(), out=softness)
+            # 二值蒙版上覆盖像素的编号为 i+1，后面的蒙版覆盖前面的
+            torch.ne(masks[i], 0, out=hit)
+            last.masked_fill_(hit, i + 1)
+        if softness.item() > 0:
+            return self.composite_soft(result, processed_images, masks)
+        covered = last > 0
+        index = (last.long() - 1).clamp_(min=0).view(1, height, width, 1).expand(1, height, width, channels)
+        picked = processed_images.gather(0, index)[0]
+        torch.where(covered.unsqueeze(-1), picked.to(result.dtype), result, out=result)
+        return result
+
+    def composite_soft(self, result, processed_images, masks):
+        """
+        软蒙版的顺序合成，等价于依次执行 result = m_i * I_i + (1 - m_i) * result，
+        每个图像做三次原地的整帧运算，但不分配临时张量：
+        - 从最后一个图像向前遍历，keep累乘 (1 - m_j)，即之后的蒙版覆盖后剩余的权重
+        - 第i个图像的最终权重为 m_i * keep，累加到预分配的acc中
+        - 最后一次性合成 result = keep * result + acc
+        """
+        height, width = result.shape[1], result.shape[2]
+        keep = torch.ones((height, width, 1), dtype=result.dtype, device=result.device)
+        weight = torch.empty_like(keep)
+        acc = torch.zeros(result.shape[1:], dtype=result.dtype, device=result.device)
+        for i in reversed(range(processed_images.shape[0])):
+            current_mask = masks[i].unsqueeze(-1).to(result.dtype)
+            torch.mul(current_mask, keep, out=weight)
+            acc.addcmul_(weight, processed_images[i].to(result.dtype))
+            keep.sub_(weight)
+        result.mul_(keep).add_(acc)
+        return result
+
+    def mask_bboxes(self, masks):
+        """每个蒙版非零区域的包围盒 (x0, y0, x1, y1)，空蒙版为None"""
+        nonzero = masks != 0
+        rows = nonzero.any(dim=2).int()
+        cols = nonzero.any(dim=1).int()
+        y0 = rows.argmax(dim=1)
+        y1 = rows.shape[1] - rows.flip(1).argmax(dim=1)
+        x0 = cols.argmax(dim=1)
+        x1 = cols.shape[1] - cols.flip(1).argmax(dim=1)
+        stats = torch.stack([rows.amax(dim=1), x0, y0, x1, y1]).cpu().tolist()
+        return [(sx0, sy0, sx1, sy1) if has else None for has, sx0, sy0, sx1, sy1 in zip(*stats)]
+
+    def target_window(self, bbox, source_size, target_size):
+        """将源蒙版中的包围盒映射为目标尺寸下受影响的区域（双线性插值的保守范围）"""
+        x0, y0, x1, y1 = bbox
+        if tuple(source_size) == tuple(target_size):
+            return bbox
+        sy = source_size[0] / target_size[0]
+        sx = source_size[1] / target_size[1]
+        return (
+            max(0, math.floor((x0 - 0.5) / sx - 0.5)),
+            max(0, math.floor((y0 - 0.5) / sy - 0.5)),
+            min(target_size[1], math.ceil((x1 + 0.5) / sx - 0.5) + 1),
+            min(target_size[0], math.ceil((y1 + 0.5) / sy - 0.5) + 1),
+        )
+
+    def axis_samples(self, start, stop, source_len, target_len, device):
+        """与F.interpolate(bilinear, align_corners=False)相同的一维采样位置"""
+        scale = source_len / target_len
+        pos = ((torch.arange(start, stop, device=device, dtype=torch.float64) + 0.5) * scale - 0.5).clamp(min=0)
+        i0 = pos.floor().long().clamp(max=source_len - 1)
+        i1 = torch.where(i0 < source_len - 1, i0 + 1, i0)
+        return i0, i1, pos - i0
+
+    def sample_region(self, x, target_size, window):
+        """
+        只计算x调整到target_size后window区域内的值，结果与整张resize后裁剪一致
+        - x: [N,H,W] 或 [N,H,W,C]
+        """
+        x0, y0, x1, y1 = window
+        if tuple(x.shape[1:3]) == tuple(target_size):
+            return x[:, y0:y1, x0:x1]
+        
+        row0, row1, fy = self.axis_samples(y0, y1, x.shape[1], target_size[0], x.device)
+        col0, col1, fx = self.axis_samples(x0, x1, x.shape[2], target_size[1], x.device)
+        # 只取用到的源区域
+        r_min, r_max = int(row0.min()), int(row1.max()) + 1
+        c_min, c_max = int(col0.min()), int(col1.max()) + 1
+        x = x[:, r_min:r_max, c_min:c_max]
+        extra = (1,) * (x.dim() - 3)
+        fy = fy.to(x.dtype).view(1, -1, 1, *extra)
+        fx = fx.to(x.dtype).view(1, 1, -1, *extra)
+        
+        top, bottom = x[:, row0 - r_min], x[:, row1 - r_min]
+        rows = top + (bottom - top) * fy
+        left, right = rows[:, :, col0 - c_min], rows[:, :, col1 - c_min]
+        return left + (right - left) * fx
+
+    def blend_regions(self, result, processed_images, masks, windows, source_indices=None):
+        """按顺序只在每个蒙版的影响区域内调整尺寸并混合，结果写回result"""
+        target_size = (result.shape[1], result.shape[2])
+        for i, window in enumerate(windows):
+            if window is None:
+                continue
+            x0, y0, x1, y1 = window
+            current_image = self.sample_region(processed_images[i:i+1], target_size, window).to(result.dtype)
+            current_mask = self.sample_region(masks[i:i+1], target_size, window).to(result.dtype).unsqueeze(-1)
+            if source_indices is None:
+                batch = slice(None)
+            else:
+                batch = slice(source_indices[i], source_indices[i] + 1)
+            result[batch, y0:y1, x0:x1].lerp_(current_image, current_mask)
+        return result
+
+    def output_buffer(self, original_image, out=None):
+        """结果张量：original_image的副本，或写入了original_image的out（out本身就是original_image时不复制）"""
+        if out is None:
+            return original_image.clone()
+        if out.data_ptr() != original_image.data_ptr():
+            out.copy_(original_image)
+        return out
+
+    def merge_masked_images(self, original_image, processed_images=None, masks=None, source_indices=None,
+                            bboxes=None, compact_masks=None, out=None):
+        """
+        合并处理后的图像
+        - source_indices: 可选，第i个区域合并回original_image[source_indices[i]]
+        - bboxes: 可选，processed_images/masks为裁剪区域时，按包围盒贴回原图
+        - compact_masks: 可选，未连接masks时使用，只在各蒙版包围盒内混合
+        - out: 可选，预分配的输出张量 [B,H,W,C]，结果写入其中而不是新的副本（不作为节点输入）
+        不会修改任何输入张量
+        """
         # 确保输入有效
-        if processed_images is None or masks is None:
+        if processed_images is None or (masks is None and compact_masks is None):
             return (original_image,)
         
+        # 紧凑蒙版：画布与原图（或裁剪窗口）一致时直接按包围盒贴回，否则解码后按普通蒙版处理
+        if masks is None:
+            if len(original_image.shape) == 3:
+                original_image = original_image.unsqueeze(0)
+            if len(processed_images.shape) == 3:
+                processed_images = processed_images.unsqueeze(0)
+            canvas = (compact_masks.height, compact_masks.width)
+            if bboxes is not None:
+                assert all((w, h) == (canvas[1], canvas[0]) for _, _, w, h in bboxes), \
+                    f"bboxes do not match compact mask canvas {canvas}"
+            if bboxes is not None or canvas == tuple(original_image.shape[1:3]):
+                result = self.paste_compact(
+                    self.output_buffer(original_image, out), processed_images, compact_masks, bboxes, source_indices
+                )
+                return (result,)
+            masks = compact_masks.to_dense(processed_images.dtype, processed_images.device)
+        
         # 标准化输入
         original_image, processed_images, masks = self.standardize_input(
             original_image, processed_images, masks
         )
         
-        # 创建结果图像的副本
-        result = original_image.clone()
+        # 结果写入副本或调用方提供的输出张量
+        result = self.output_buffer(original_image, out)
         
-        # 获取目标尺寸
-        target_height = original_image.shape[1]
-        target_width = original_image.shape[2]
+        if source_indices is not None:
+            assert len(source_indices) == processed_images.shape[0], \
+                f"source_indices length {len(source_indices)} does not match {processed_images.shape[0]} processed images"
         
-        # 调整处理图像的尺寸（如果需要）
-        if processed_images.shape[1:3] != (target_height, target_width):
-            processed_images = self.resize_tensor(
-                processed_images,
-                (target_height, target_width),
-                mode='bilinear'
-            )
+        # 裁剪区域直接贴回
+        if bboxes is not None:
+            result = self.paste_crops(result, processed_images, masks, bboxes, source_indices)
+            return (result,)
         
-        # 调整蒙版尺寸（如果需要）
-        if masks.shape[1:3] != (target_height, target_width):
-            masks = self.resize_tensor(
-                masks,
-                (target_height, target_width),
-                mode='bilinear'
-            )
+        # 获取目标尺寸
+        target_size = (original_image.shape[1], original_image.shape[2])
         
-        # 扩展蒙版维度以匹配图像通道
-        masks = masks.unsqueeze(-1).expand(-1, -1, -1, 3)
+        # 每个蒙版在结果图像中影响的区域
+        windows = [
+            None if bbox is None else self.target_window(bbox, masks.shape[1:3], target_size)
+            for bbox in self.mask_bboxes(masks)
+        ]
+        region_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in filter(None, windows))
         
-        # 批量处理所有图片
-        for i in range(processed_images.shape[0]):
-            current_image = processed_images[i:i+1]
-            current_mask = masks[i:i+1]
-            result = current_mask * current_image + (1 - current_mask) * result
+        # 需要调整尺寸或区域较小时只在包围盒内调整尺寸并混合，避免整批resize
+        resize_needed = processed_images.shape[1:3] != target_size or masks.shape[1:3] != target_size
+        if resize_needed or region_area * 2 <= len(windows) * target_size[0] * target_size[1]:
+            self.blend_regions(result, processed_images, masks, windows, source_indices)
+            return (result,)
+        
+        # 批量合成所有图片
+        if source_indices is None:
+            self.composite(result, processed_images, masks)
+        else:
+            # 按原图索引分组，组内保持原有顺序
+            for idx in dict.fromkeys(source_indices):
+                selected = [i for i, source in enumerate(source_indices) if source == idx]
+                self.composite(result[idx:idx+1], processed_images[selected], masks[selected])
         
         assert len(result.shape) == 4, "Output must be 4D [B,H,W,C]"
         return (result,)
     
 
+class CompactMaskDecode:
+    """将COMPACT_MASK解码为普通MASK，供其他节点使用"""
+    def __init__(self):
+        pass
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "compact_masks": ("COMPACT_MASK", {"forceInput": True}),
+            },
+        }
+    
+    RETURN_TYPES = ("MASK",)
+    RETURN_NAMES = ("masks",)
+    FUNCTION = "decode"
+    CATEGORY = "CyberEveLoop🐰"
+
+    def decode(self, compact_masks):
+        return (compact_masks.to_dense(),)
+
+
 Mask_CLASS_MAPPINGS = {
     "CyberEve_MaskSegmentation": MaskSplit,
     "CyberEve_MaskMerge": MaskMerge,
+    "CyberEve_CompactMaskDecode": CompactMaskDecode,
 }
 
 Mask_DISPLAY_NAME_MAPPINGS = {
     "CyberEve_MaskSegmentation": "Mask Segmentation🐰",
     "CyberEve_MaskMerge": "Mask Merge🐰",
+    "CyberEve_CompactMaskDecode": "Compact Mask Decode🐰",
 }
 
@@ -0,0 +1,243 @@
+from collections.abc import Sequence
+from itertools import islice
+
+import torch
+
+
+def element_type(value):
+    """schema entry of one LIST element, nested lists are described by their own element types"""
+    if isinstance(value, PersistentList):
+        return ("LIST", value.schema)
+    if isinstance(value, list):
+        return ("LIST", frozenset(element_type(v) for v in value))
+    return type(value)
+
+
+def schema_matches(entry, schema):
+    """whether an element described by entry may join a list with the given schema"""
+    for base in schema:
+        if isinstance(entry, tuple):
+            # nested lists: every element type has to match, an empty nested list accepts anything
+            if isinstance(base, tuple) and (not base[1] or all(schema_matches(e, base[1]) for e in entry[1])):
+                return True
+        elif not isinstance(base, tuple) and issubclass(entry, base):
+            return True
+    return False
+
+
+def list_schema(values):
+    """element-type schema of a LIST value, carried by persistent lists and built for plain ones"""
+    if isinstance(values, PersistentList):
+        return values.schema
+    return frozenset(element_type(v) for v in values)
+
+
+def with_type(schema, entry):
+    """schema extended by entry, the same object when entry is already known"""
+    return schema if entry in schema else schema | {entry}
+
+
+class PersistentList(Sequence):
+    """
+    Immutable LIST value with structural sharing.
+
+    An instance is a view of the first `length` items of a backing python list.
+    Appending to the newest view extends the shared backing list in place (O(1) amortized),
+    appending to an older view copies its prefix first, so a list handed to another node
+    never changes afterwards and cached node outputs stay valid.
+
+    Each list also carries its element-type schema (see element_type), built once and extended
+    with the new elements only, so type checks do not walk the whole list.
+    """
+
+    __slots__ = ("_items", "_length", "_schema")
+
+    def __init__(self, items=None, length=None, schema=None):
+        # takes ownership of items, use PersistentList.of() for lists owned by someone else
+        self._items = items if items is not None else []
+        self._length = len(self._items) if length is None else length
+        if schema is None:
+            schema = frozenset(element_type(v) for v in islice(self._items, self._length))
+        self._schema = schema
+
+    @property
+    def schema(self):
+        """frozenset of the element types in this list"""
+        return self._schema
+
+    @classmethod
+    def of(cls, values):
+        """wrap a LIST input, plain lists are copied once since their owner may still mutate them"""
+        if values is None:
+            return cls()
+        if isinstance(values, cls):
+            return values
+        return cls(list(values))
+
+    def _owned_items(self):
+        """backing list that can be extended without changing any other view"""
+        if len(self._items) == self._length:
+            return self._items
+        return self._items[:self._length]
+
+    def appended(self, value):
+        """new list with value at the end, self is unchanged"""
+        items = self._owned_items()
+        items.append(value)
+        return PersistentList(items, schema=with_type(self._schema, element_type(value)))
+
+    def extended(self, values):
+        """new list with all values at the end, self is unchanged"""
+        if isinstance(values, PersistentList):
+            schema = self._schema | values.schema
+        else:
+            values = list(values)
+            schema = self._schema
+            for value in values:
+                schema = with_type(schema, element_type(value))
+        items = self._owned_items()
+        items.extend(values)
+        return PersistentList(items, schema=schema)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PersistentList([self._items[i] for i in range(*index.indices(self._length))])
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("list index out of range")
+        return self._items[index]
+
+    def __iter__(self):
+        return islice(self._items, self._length)
+
+    def __add__(self, other):
+        return self.extended(other)
+
+    def __radd__(self, other):
+        return PersistentList(list(other) + list(self))
+
+    def __eq__(self, other):
+        if not isinstance(other, (PersistentList, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"PersistentList({list(self)!r})"
+
+
+class _TensorBuffer:
+    """batch buffer shared by TensorList views, spans holds the (first row, end row) of each value"""
+
+    __slots__ = ("data", "spans")
+
+    def __init__(self):
+        self.data = None
+        self.spans = []
+
+    def write(self, value, capacity):
+        """write value into the next rows, allocating room for capacity values on first use and doubling after"""
+        rows = self.spans[-1][1] if self.spans else 0
+        needed = rows + value.shape[0]
+        if self.data is None:
+            self.data = torch.empty((max(capacity * value.shape[0], needed), *value.shape[1:]),
+                                    dtype=value.dtype, device=value.device)
+        elif tuple(value.shape[1:]) != tuple(self.data.shape[1:]):
+            raise ValueError(f"TensorList values must share their shape, got {tuple(value.shape[1:])} "
+                             f"after {tuple(self.data.shape[1:])}")
+        elif needed > self.data.shape[0]:
+            grown = torch.empty((max(2 * self.data.shape[0], needed), *self.data.shape[1:]),
+                                dtype=self.data.dtype, device=self.data.device)
+            grown[:rows] = self.data[:rows]
+            self.data = grown
+        self.data[rows:needed] = value
+        self.spans.append((rows, needed))
+
+
+class TensorList(PersistentList):
+    """
+    PersistentList of IMAGE/MASK tensors kept in one batch buffer.
+
+    Each appended tensor [B,...] is written into the next rows of the buffer, which starts with
+    room for `capacity` values shaped like the first one and doubles when full. Rows handed out
+    are never written again, so views stay valid, and as_batch() returns all values as one batch
+    without copying.
+    """
+
+    __slots__ = ("_buffer", "_start", "_stop", "_capacity")
+
+    @property
+    def schema(self):
+        return frozenset([torch.Tensor]) if len(self) else frozenset()
+
+    def __init__(self, capacity=1, buffer=None, start=0, stop=None):
+        self._capacity = capacity
+        self._buffer = buffer if buffer is not None else _TensorBuffer()
+        self._start = start
+        self._stop = len(self._buffer.spans) if stop is None else stop
+
+    @classmethod
+    def of(cls, values, capacity=1):
+        if isinstance(values, cls):
+            return values
+        return cls(capacity).extended(values if values is not None else [])
+
+    def appended(self, value):
+        if not isinstance(value, torch.Tensor):
+            raise ValueError(f"TensorList only holds IMAGE/MASK tensors, got {type(value)}")
+        if self._stop == len(self._buffer.spans):
+            buffer, start = self._buffer, self._start
+        else:
+            # another list already extends this one, continue in a copy
+            buffer, start = _TensorBuffer(), 0
+            for item in self:
+                buffer.write(item, self._capacity)
+        buffer.write(value, self._capacity)
+        return TensorList(self._capacity, buffer, start, len(buffer.spans))
+
+    def extended(self, values):
+        result = self
+        for value in values:
+            result = result.appended(value)
+        return result
+
+    def as_batch(self):
+        """all values as one [N,...] batch, a view of the shared buffer"""
+        if len(self) == 0:
+            return None
+        spans = self._buffer.spans
+        return self._buffer.data[spans[self._start][0]:spans[self._stop - 1][1]]
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return TensorList(self._capacity, self._buffer, self._start + start, self._start + max(start, stop))
+            return TensorList.of([self[i] for i in range(start, stop, step)], self._capacity)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("list index out of range")
+        first, end = self._buffer.spans[self._start + index]
+        return self._buffer.data[first:end]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __eq__(self, other):
+        if not isinstance(other, (PersistentList, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(torch.equal(a, b) for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"TensorList({len(self)} values)"
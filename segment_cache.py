@@ -0,0 +1,120 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .segmentation import Segment
+
+
+class SegmentCache:
+    """
+    按内容寻址的LRU缓存，保存MaskSplit的分割结果
+    - 键: 前景位图的哈希 + 分割选项（位图在蒙版所在设备上打包，只传回1/8字节）
+    - 值: 每帧的区域列表（过滤/排序/形态学之后），roi保存为CPU上的numpy数组，不占用显存
+    - 命中时只跳过连通域标记/过滤/形态学，输出的图像和蒙版仍需重新生成
+    - 超过max_entries或max_bytes时淘汰最久未使用的结果
+    """
+
+    def __init__(self, max_entries=32, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(frames, options):
+        """
+        前景位图和选项的哈希
+        分割只取决于前景（frames*255 >= 1，与label_frames一致），所以按位打包后再哈希
+        """
+        shape = tuple(frames.shape)
+        if isinstance(frames, torch.Tensor):
+            fg = (frames.detach() * 255 >= 1).flatten()
+            fg = torch.cat([fg, fg.new_zeros(-fg.numel() % 8)]).view(-1, 8).to(torch.uint8)
+            weights = torch.tensor([1, 2, 4, 8, 16, 32, 64, 128], dtype=torch.uint8, device=fg.device)
+            data = (fg * weights).sum(dim=1, dtype=torch.uint8).cpu().numpy()
+        else:
+            data = np.packbits(np.asarray(frames) * 255 >= 1, bitorder="little")
+        digest = hashlib.blake2b(data.tobytes(), digest_size=20)
+        digest.update(repr((shape, options)).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def host_copy(frame_lists):
+        """区域列表的副本，设备上的roi一次性拷贝到CPU"""
+        device_rois = [seg.roi.flatten() for segments in frame_lists for seg in segments
+                       if isinstance(seg.roi, torch.Tensor)]
+        if device_rois:
+            host = iter(np.split(torch.cat(device_rois).cpu().numpy(), np.cumsum([r.numel() for r in device_rois])[:-1]))
+        copies = []
+        for segments in frame_lists:
+            frame = []
+            for seg in segments:
+                roi = next(host).reshape(seg.h, seg.w) if isinstance(seg.roi, torch.Tensor) else seg.roi
+                frame.append(Segment(seg.label, seg.x, seg.y, seg.w, seg.h, seg.area, seg.top_left, seg.centroid, roi))
+            copies.append(frame)
+        return copies
+
+    @staticmethod
+    def entry_bytes(frame_lists):
+        total = 0
+        for segments in frame_lists:
+            for seg in segments:
+                total += seg.roi.nbytes
+        return total
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return [list(segments) for segments in entry[0]]
+
+    def put(self, key, frame_lists):
+        if self.max_entries <= 0:
+            return
+        frame_lists = self.host_copy(frame_lists)
+        size = self.entry_bytes(frame_lists)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (frame_lists, size)
+        self.total_bytes += size
+        self.evict()
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def configure(self, max_entries=None, max_bytes=None):
+        """调整容量限制，立即淘汰超出部分"""
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+SEGMENT_CACHE = SegmentCache()
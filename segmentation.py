@@ -0,0 +1,235 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class Segment:
+    """
+    单个连通区域
+    - x, y, w, h: 区域的包围盒
+    - area: 像素面积
+    - top_left: 最左列中最上方的点 (x, y)，用于排序
+    - roi: 包围盒内的布尔蒙版 [h,w]，只包含本区域的像素
+      （OpenCV后端为numpy数组，torch后端为设备上的张量）
+    """
+    __slots__ = ("label", "x", "y", "w", "h", "area", "top_left", "centroid", "roi")
+
+    def __init__(self, label, x, y, w, h, area, top_left, centroid, roi):
+        self.label = label
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.area = area
+        self.top_left = top_left
+        self.centroid = centroid
+        self.roi = roi
+
+    @property
+    def bbox(self):
+        return (self.x, self.y, self.w, self.h)
+
+
+def label_components(mask_np):
+    """
+    单次遍历生成标签图并返回所有连通区域
+    - mask_np: uint8 [H,W]，非零即前景
+    - 8连通，与findContours(RETR_TREE)的外轮廓/孔洞语义一致：
+      带孔区域保留孔洞，孔洞中的岛屿作为独立区域
+    - 每个区域只保存包围盒内的蒙版，不分配整帧缓冲
+    """
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        mask_np, connectivity=8, ltype=cv2.CV_32S
+    )
+
+    segments = []
+    for label in range(1, num_labels):
+        x, y, w, h, area = (int(v) for v in stats[label])
+        roi = labels[y:y+h, x:x+w] == label
+        # 包围盒左边界即最小x，在该列中找最小y
+        top = int(np.argmax(roi[:, 0]))
+        segments.append(Segment(
+            label, x, y, w, h, area,
+            (x, y + top),
+            (float(centroids[label][0]), float(centroids[label][1])),
+            roi,
+        ))
+
+    return segments
+
+
+# 标签传播的迭代上限：迭代次数随区域大小对数增长（1024²的蛇形区域约21次），超过时回退到OpenCV
+MAX_PROPAGATION_ITERATIONS = 64
+
+
+def propagate_labels(fg, max_iterations=MAX_PROPAGATION_ITERATIONS):
+    """
+    批量8连通标记：每个前景像素的标签收敛为其所在连通域内最小的线性索引
+    - fg: bool [B,H,W]
+    - 每个像素指向同一连通域内不大于自身的像素（父指针），每次迭代：
+      1. 挂接：父像素取3x3邻域内最小的祖父标签（scatter amin），整棵树一次合并到相邻的树上
+      2. 激进挂接 + 路径压缩：像素自身取邻域最小的祖父标签和自己的祖父标签
+      迭代次数随树的深度对数增长，而不是随区域内的路径长度线性增长
+    - max_iterations: 超过该次数仍未收敛时抛出RuntimeError
+    返回 int64 [B,H,W]，背景为 B*H*W
+    """
+    total = fg.numel()
+    # 池化需要浮点类型，float32可精确表示2^24以内的索引
+    dtype = torch.float32 if total <= 2 ** 24 else torch.float64
+    # 末尾的哨兵代表背景，指向自身
+    sentinel = torch.tensor([total], device=fg.device)
+    index = torch.arange(total, device=fg.device)
+    parent = torch.cat([torch.where(fg.flatten(), index, total), sentinel])
+    for _ in range(max_iterations):
+        grandparent = parent[parent]
+        pooled = -F.max_pool2d(-grandparent[:total].view(fg.shape).to(dtype).unsqueeze(1), 3, stride=1, padding=1)
+        pooled = torch.cat([torch.where(fg, pooled.squeeze(1).long(), total).flatten(), sentinel])
+        updated = parent.scatter_reduce(0, parent, pooled, "amin")
+        updated = torch.minimum(torch.minimum(updated, pooled), grandparent)
+        if torch.equal(updated, parent):
+            return parent[:total].view(fg.shape)
+        parent = updated
+    raise RuntimeError(f"Label propagation did not converge within {max_iterations} iterations")
+
+
+def label_components_torch(fg, max_iterations=MAX_PROPAGATION_ITERATIONS):
+    """
+    torch后端：在输入张量所在设备上批量标记所有帧
+    - fg: bool [B,H,W]
+    - 与label_components的区域集合和统计量一致；标签顺序可能不同，filter_segments/sort_segments的结果与顺序无关
+    - 区域统计（包括标签）一次性传回CPU，roi为设备上的布尔张量
+    - max_iterations: 见propagate_labels，未收敛时抛出RuntimeError
+    返回每帧的区域列表
+    """
+    batch, height, width = fg.shape
+    labels = propagate_labels(fg, max_iterations)
+    frames = [[] for _ in range(batch)]
+
+    b, y, x = torch.nonzero(fg, as_tuple=True)
+    if len(b) == 0:
+        return frames
+    # 标签即连通域内最小线性索引（光栅顺序的第一个像素）
+    ids, inverse = torch.unique(labels[b, y, x], return_inverse=True)
+    count = len(ids)
+
+    def reduce(values, op, fill):
+        init = torch.full((count,), fill, dtype=values.dtype, device=values.device)
+        return init.scatter_reduce(0, inverse, values, op, include_self=False)
+
+    area = torch.bincount(inverse, minlength=count)
+    x0 = reduce(x, "amin", width)
+    x1 = reduce(x, "amax", -1) + 1
+    y0 = reduce(y, "amin", height)
+    y1 = reduce(y, "amax", -1) + 1
+    # 最左列中最上方的点
+    top_left = reduce(x * height + y, "amin", width * height)
+    cx = torch.zeros(count, dtype=torch.float64, device=fg.device).scatter_add(0, inverse, x.double())
+    cy = torch.zeros(count, dtype=torch.float64, device=fg.device).scatter_add(0, inverse, y.double())
+
+    stats = torch.stack([ids, ids // (height * width), x0, y0, x1, y1, area, top_left]).cpu().tolist()
+    centroids = torch.stack([cx / area, cy / area]).cpu().tolist()
+    for i, (label, frame, sx0, sy0, sx1, sy1, sarea, key) in enumerate(zip(*stats)):
+        roi = labels[frame, sy0:sy1, sx0:sx1] == label
+        frames[frame].append(Segment(
+            label, sx0, sy0, sx1 - sx0, sy1 - sy0, sarea,
+            (key // height, key % height),
+            (centroids[0][i], centroids[1][i]),
+            roi,
+        ))
+    return frames
+
+
+SORT_ORDERS = ["left_to_right", "reading_order", "area", "centroid_distance"]
+MORPHOLOGY_OPS = ["none", "dilate", "erode", "fill_holes"]
+
+
+def segment_from_roi(label, x, y, roi):
+    """根据包围盒蒙版（可能含空白边）重新计算区域统计，返回紧凑的Segment；空区域返回None"""
+    ys, xs = np.nonzero(roi)
+    if len(xs) == 0:
+        return None
+    x0, x1 = int(xs.min()), int(xs.max()) + 1
+    y0, y1 = int(ys.min()), int(ys.max()) + 1
+    roi = roi[y0:y1, x0:x1]
+    top = int(np.argmax(roi[:, 0]))
+    return Segment(
+        label, x + x0, y + y0, x1 - x0, y1 - y0, len(xs),
+        (x + x0, y + y0 + top),
+        (float(x + xs.mean()), float(y + ys.mean())),
+        roi,
+    )
+
+
+def filter_segments(segments, min_area=0, top_k=0):
+    """
+    按统计信息过滤区域
+    - min_area: 丢弃面积小于该值的区域
+    - top_k: 只保留面积最大的K个区域（0表示全部保留），保持原有顺序
+    面积相同时按最左上角点取舍，结果与标记后端的标签顺序无关
+    """
+    if min_area > 0:
+        segments = [seg for seg in segments if seg.area >= min_area]
+    if 0 < top_k < len(segments):
+        keep = set(id(seg) for seg in sorted(segments, key=lambda seg: (-seg.area, seg.top_left))[:top_k])
+        segments = [seg for seg in segments if id(seg) in keep]
+    return segments
+
+
+def sort_segments(segments, sort_by, height, width):
+    """
+    按统计信息排序
+    - left_to_right: 最左列最上方的点，先左后上（默认）
+    - reading_order: 包围盒左上角，先上后左
+    - area: 面积从大到小
+    - centroid_distance: 质心到画面中心的距离从近到远
+    相同时均按最左上角点排序（各区域唯一），结果与标记后端的标签顺序无关
+    """
+    if sort_by == "left_to_right":
+        key = lambda seg: seg.top_left
+    elif sort_by == "reading_order":
+        key = lambda seg: (seg.y, seg.x, seg.top_left)
+    elif sort_by == "area":
+        key = lambda seg: (-seg.area, seg.top_left)
+    elif sort_by == "centroid_distance":
+        cx, cy = (width - 1) / 2.0, (height - 1) / 2.0
+        key = lambda seg: ((seg.centroid[0] - cx) ** 2 + (seg.centroid[1] - cy) ** 2, seg.top_left)
+    else:
+        raise ValueError(f"Unknown sort order: {sort_by}")
+    return sorted(segments, key=key)
+
+
+def apply_morphology(seg, op, radius, height, width):
+    """
+    只在区域包围盒（外扩radius）内执行形态学操作
+    - dilate / erode: 椭圆结构元素，半径radius
+    - fill_holes: 填充区域内部的孔洞
+    操作后区域为空时返回None
+    """
+    if op == "none" or (radius <= 0 and op != "fill_holes"):
+        return seg
+
+    pad = radius if op == "dilate" else 0
+    x0, y0 = max(seg.x - pad, 0), max(seg.y - pad, 0)
+    x1, y1 = min(seg.x + seg.w + pad, width), min(seg.y + seg.h + pad, height)
+    roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    seg_roi = seg.roi.cpu().numpy() if isinstance(seg.roi, torch.Tensor) else seg.roi
+    roi[seg.y - y0:seg.y - y0 + seg.h, seg.x - x0:seg.x - x0 + seg.w] = seg_roi
+
+    if op == "fill_holes":
+        # 从外边框泛洪填充背景，未被填充到的背景即为孔洞
+        flood = np.pad(roi, 1) * 255
+        ff_mask = np.zeros((flood.shape[0] + 2, flood.shape[1] + 2), dtype=np.uint8)
+        cv2.floodFill(flood, ff_mask, (0, 0), 255)
+        roi = roi | (flood[1:-1, 1:-1] == 0)
+    else:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+        if op == "dilate":
+            roi = cv2.dilate(roi, kernel)
+        elif op == "erode":
+            # 包围盒外视为背景
+            roi = cv2.erode(roi, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        else:
+            raise ValueError(f"Unknown morphology op: {op}")
+
+    return segment_from_roi(seg.label, x0, y0, roi > 0)
@@ -0,0 +1,91 @@
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def is_link(obj):
+    return isinstance(obj, list) and len(obj) == 2 and isinstance(obj[0], str) and isinstance(obj[1], (int, float))
+
+
+class Node:
+    def __init__(self, id, class_type, inputs):
+        self.id = id
+        self.class_type = class_type
+        self.inputs = dict(inputs)
+        self.override_display_id = None
+
+    def out(self, index):
+        return [self.id, index]
+
+    def set_input(self, key, value):
+        if value is None:
+            self.inputs.pop(key, None)
+        else:
+            self.inputs[key] = value
+
+    def get_input(self, key):
+        return self.inputs.get(key)
+
+    def set_override_display_id(self, display_id):
+        self.override_display_id = display_id
+
+    def serialize(self):
+        result = {"class_type": self.class_type, "inputs": self.inputs}
+        if self.override_display_id is not None:
+            result["override_display_id"] = self.override_display_id
+        return result
+
+
+class GraphBuilder:
+    """GraphBuilder的替身，与ComfyUI一样给每次展开的节点ID加上唯一前缀"""
+    _count = 0
+
+    def __init__(self, prefix=None):
+        GraphBuilder._count += 1
+        self.prefix = prefix if prefix is not None else f"g{GraphBuilder._count}."
+        self.nodes = {}
+
+    def node(self, class_type, id=None, **kwargs):
+        node = Node(self.prefix + str(id), class_type, kwargs)
+        self.nodes[str(id)] = node
+        return node
+
+    def lookup_node(self, id):
+        return self.nodes.get(id)
+
+    def finalize(self):
+        return {node.id: node.serialize() for node in self.nodes.values()}
+
+
+def install_comfy_stubs():
+    """节点依赖的ComfyUI模块（comfy_execution.graph_utils、nodes）不存在时注册替身"""
+    if "comfy_execution" not in sys.modules:
+        graph_utils = types.ModuleType("comfy_execution.graph_utils")
+        graph_utils.is_link = is_link
+        graph_utils.GraphBuilder = GraphBuilder
+        package = types.ModuleType("comfy_execution")
+        package.graph_utils = graph_utils
+        sys.modules["comfy_execution"] = package
+        sys.modules["comfy_execution.graph_utils"] = graph_utils
+    if "nodes" not in sys.modules:
+        nodes = types.ModuleType("nodes")
+        nodes.NODE_CLASS_MAPPINGS = {}
+        sys.modules["nodes"] = nodes
+
+
+def load_package(name="loop_image"):
+    """仓库目录名不是合法的模块名，按固定名称导入"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, ROOT / "__init__.py", submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+install_comfy_stubs()
+load_package()
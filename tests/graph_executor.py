@@ -0,0 +1,185 @@
+"""
+测试用的最小执行器：按需执行prompt中的节点
+支持图展开（expand）、rawLink输入和DYNPROMPT/UNIQUE_ID隐藏输入，足以驱动循环节点的多次展开
+"""
+import torch
+from comfy_execution.graph_utils import is_link
+from nodes import NODE_CLASS_MAPPINGS
+
+from loop_image import NODE_CLASS_MAPPINGS as PACKAGE_NODES
+
+
+class Const:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"value": ("*",)}}
+
+    RETURN_TYPES = ("*",)
+    FUNCTION = "run"
+
+    def run(self, value):
+        return (value,)
+
+
+class AddHalf:
+    """(x + 1) / 2，每次迭代的结果都不同，展开错位时结果随之不同"""
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"image": ("IMAGE",)}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "run"
+
+    def run(self, image):
+        return ((image + 1) / 2,)
+
+
+class Save:
+    """循环体中的输出节点，记录每次执行收到的图片"""
+    OUTPUT_NODE = True
+    saved = []
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"images": ("IMAGE",)}}
+
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+
+    def run(self, images):
+        Save.saved.append(images)
+        return ()
+
+
+NODE_CLASS_MAPPINGS.update(PACKAGE_NODES)
+NODE_CLASS_MAPPINGS.update({"Const": Const, "AddHalf": AddHalf, "Save": Save})
+
+
+class DynPrompt:
+    def __init__(self, prompt):
+        self.original_prompt = prompt
+        self.ephemeral_prompt = {}
+        self.ephemeral_display = {}
+
+    def get_node(self, node_id):
+        if node_id in self.ephemeral_prompt:
+            return self.ephemeral_prompt[node_id]
+        return self.original_prompt[node_id]
+
+    def add_ephemeral_node(self, node_id, node_info, parent_id, display_id):
+        self.ephemeral_prompt[node_id] = node_info
+        self.ephemeral_display[node_id] = display_id
+
+    def get_display_node_id(self, node_id):
+        while True:
+            display_id = self.ephemeral_display.get(node_id)
+            if display_id is None or display_id == node_id:
+                return node_id
+            node_id = display_id
+
+    def get_original_prompt(self):
+        return self.original_prompt
+
+
+class Executor:
+    def __init__(self, prompt):
+        self.dynprompt = DynPrompt(prompt)
+        self.outputs = {}
+        self.expansions = 0
+
+    def value(self, link):
+        return self.run(link[0])[link[1]]
+
+    def run(self, node_id):
+        if node_id in self.outputs:
+            return self.outputs[node_id]
+        node = self.dynprompt.get_node(node_id)
+        cls = NODE_CLASS_MAPPINGS[node["class_type"]]
+        input_types = cls.INPUT_TYPES()
+        spec = {**input_types.get("required", {}), **input_types.get("optional", {})}
+        kwargs = {}
+        for key, value in node["inputs"].items():
+            options = spec[key][1] if key in spec and len(spec[key]) > 1 else {}
+            raw = isinstance(options, dict) and options.get("rawLink")
+            kwargs[key] = self.value(value) if is_link(value) and not raw else value
+        for key, value in input_types.get("hidden", {}).items():
+            if value == "UNIQUE_ID":
+                kwargs[key] = node_id
+            elif value == "DYNPROMPT":
+                kwargs[key] = self.dynprompt
+
+        result = getattr(cls(), cls.FUNCTION)(**kwargs)
+        if isinstance(result, dict):
+            if "expand" in result:
+                self.expansions += 1
+                for new_id, new_node in result["expand"].items():
+                    display_id = new_node.get("override_display_id", new_id)
+                    self.dynprompt.add_ephemeral_node(new_id, new_node, node_id, display_id)
+                # 展开的图中的输出节点没有下游，与ComfyUI一样直接执行
+                for new_id, new_node in result["expand"].items():
+                    if getattr(NODE_CLASS_MAPPINGS[new_node["class_type"]], "OUTPUT_NODE", False):
+                        self.run(new_id)
+            result = tuple(self.value(v) if is_link(v) else v for v in result["result"])
+        self.outputs[node_id] = result
+        return result
+
+
+def segment_prompt(image, mask, **split_options):
+    """图片、蒙版和MaskSplit节点，循环测试在此基础上连接循环节点"""
+    return {
+        "img": {"class_type": "Const", "inputs": {"value": image}},
+        "msk": {"class_type": "Const", "inputs": {"value": mask}},
+        "split": {"class_type": "CyberEve_MaskSegmentation", "inputs": {
+            "image": ["img", 0], "mask": ["msk", 0], "use_cache": False, **split_options,
+        }},
+    }
+
+
+def batch_loop_prompt(image, mask, split=None, open=None, close=None):
+    """MaskSplit -> Batch Image Loop，循环体对每块区域执行AddHalf"""
+    prompt = segment_prompt(image, mask, **(split or {}))
+    prompt["open"] = {"class_type": "CyberEve_BatchImageLoopOpen", "inputs": {
+        "segmented_images": ["split", 0], "segmented_masks": ["split", 1], **(open or {}),
+    }}
+    prompt["body"] = {"class_type": "AddHalf", "inputs": {"image": ["open", 1]}}
+    prompt["close"] = {"class_type": "CyberEve_BatchImageLoopClose", "inputs": {
+        "flow_control": ["open", 0], "current_image": ["body", 0], "current_mask": ["open", 2],
+        "max_iterations": ["open", 3], **(close or {}),
+    }}
+    return prompt
+
+
+def single_loop_prompt(image, max_iterations, close=None):
+    """Single Image Loop，循环体对图片执行AddHalf"""
+    return {
+        "img": {"class_type": "Const", "inputs": {"value": image}},
+        "open": {"class_type": "CyberEve_SingleImageLoopOpen", "inputs": {
+            "image": ["img", 0], "max_iterations": max_iterations,
+        }},
+        "body": {"class_type": "AddHalf", "inputs": {"image": ["open", 1]}},
+        "close": {"class_type": "CyberEve_SingleImageLoopClose", "inputs": {
+            "flow_control": ["open", 0], "current_image": ["body", 0], "current_mask": ["open", 2],
+            "max_iterations": ["open", 3], **(close or {}),
+        }},
+    }
+
+
+def reduce_loop_prompt(input_size, open=None, close=None):
+    """LoopReduce，每次迭代把迭代次数追加到列表"""
+    return {
+        "open": {"class_type": "LoopReduceOpen", "inputs": {"input_size": input_size, **(open or {})}},
+        "append": {"class_type": "AppendList", "inputs": {"current_list": ["open", 1], "current_value": ["open", 3]}},
+        "close": {"class_type": "LoopReduceClose", "inputs": {
+            "flow_control": ["open", 0], "current_list": ["append", 0], "input_size": ["open", 2], **(close or {}),
+        }},
+    }
+
+
+def sample_inputs(seed=0):
+    """60x80的图片，蒙版中有5个大小不同的区域"""
+    generator = torch.Generator().manual_seed(seed)
+    mask = torch.zeros((1, 60, 80))
+    for y0, y1, x0, x1 in ((5, 15, 5, 15), (30, 50, 40, 70), (40, 55, 5, 20), (2, 4, 50, 52), (20, 22, 20, 22)):
+        mask[0, y0:y1, x0:x1] = 1.0
+    return torch.rand((1, 60, 80, 3), generator=generator), mask
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from loop_image.compact_mask import CompactMask
+from loop_image.mask_split import CompactMaskDecode, MaskSplit
+
+from graph_executor import Executor, batch_loop_prompt, sample_inputs
+
+
+@pytest.mark.parametrize("crop_to_bbox", [False, True])
+def test_compact_split_decodes_to_the_dense_split(crop_to_bbox):
+    image, mask = sample_inputs()
+    options = {"crop_to_bbox": crop_to_bbox, "use_cache": False}
+    _, dense, _, dense_bboxes, _ = MaskSplit().segment_mask(mask, image, **options)
+    _, empty, _, bboxes, compact = MaskSplit().segment_mask(mask, image, mask_format="compact", **options)
+    assert empty is None
+    assert bboxes == dense_bboxes
+    assert torch.equal(CompactMaskDecode().decode(compact)[0], dense)
+    # 只保存包围盒内的位图
+    assert compact.nbytes == int(dense.sum())
+
+
+def test_dense_round_trip_and_per_frame_decoding():
+    masks = torch.zeros((3, 16, 20))
+    masks[0, 2:6, 3:9] = 1.0
+    masks[2, 10:16, 0:4] = torch.linspace(0, 1, 4)
+    compact = CompactMask.from_dense(masks)
+    # 软蒙版量化为uint8
+    assert torch.allclose(compact.to_dense(), masks, atol=1 / 255)
+    assert compact.bboxes == [(3, 2, 6, 4), (0, 0, 0, 0), (1, 10, 3, 6)]
+    for index in range(3):
+        assert torch.equal(compact.frame(index)[0], compact.to_dense()[index])
+    assert torch.equal(compact[1:].to_dense(), compact.to_dense()[1:])
+
+
+def test_compact_masks_through_the_batch_loop():
+    image, mask = sample_inputs()
+    dense_prompt = batch_loop_prompt(image, mask)
+    compact_prompt = batch_loop_prompt(image, mask, split={"mask_format": "compact"}, close={"compact_masks": True})
+    del compact_prompt["open"]["inputs"]["segmented_masks"]
+    compact_prompt["open"]["inputs"]["compact_masks"] = ["split", 4]
+    images, masks, _, _ = Executor(dense_prompt).run("close")
+    compact_images, empty, compact, _ = Executor(compact_prompt).run("close")
+    assert empty is None
+    assert torch.equal(compact_images, images)
+    assert torch.equal(CompactMaskDecode().decode(compact)[0], masks)
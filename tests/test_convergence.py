@@ -0,0 +1,25 @@
+import torch
+
+from loop_image.flow_control import SingleImageLoopClose
+
+
+def test_psnr_uses_its_own_threshold():
+    node = SingleImageLoopClose()
+    previous = torch.full((1, 8, 8, 3), 0.5)
+    # 均匀差值0.1，PSNR为20dB
+    current = previous + 0.1
+    inputs = SingleImageLoopClose.INPUT_TYPES()["optional"]
+    assert inputs["psnr_threshold"][1]["default"] == 40.0
+    assert not node.has_converged(current, previous, None, None, "psnr", inputs["psnr_threshold"][1]["default"])
+    assert node.has_converged(current, previous, None, None, "psnr", 15.0)
+    assert node.has_converged(previous, previous, None, None, "psnr", 40.0)
+
+
+def test_difference_metrics():
+    node = SingleImageLoopClose()
+    previous = torch.zeros((1, 4, 4, 3))
+    current = previous.clone()
+    current[0, 0, 0, 0] = 0.5
+    assert node.has_converged(current, previous, None, None, "mean_abs", 0.011)
+    assert not node.has_converged(current, previous, None, None, "max_abs", 0.1)
+    assert not node.has_converged(current, None, None, None, "mean_abs", 1.0)
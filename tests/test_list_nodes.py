@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from loop_image.flow_control import AppendList, ConcatList, EmptyList, LoopReduceClose
+from loop_image.persistent_list import PersistentList, TensorList
+
+
+class DynPrompt:
+    def get_display_node_id(self, node_id):
+        return node_id
+
+
+def test_plain_lists_stay_plain_and_unchanged():
+    empty, = EmptyList().empty_list(False)
+    assert empty == [] and type(empty) is list
+    appended, = AppendList().appending(empty, 1)
+    assert appended == [1] and type(appended) is list and empty == []
+    concatenated, = ConcatList().concat(True, appended, [2, 3])
+    assert concatenated == [1, 2, 3] and type(concatenated) is list and appended == [1]
+    with pytest.raises(ValueError):
+        ConcatList().concat(True, appended, ["a"])
+
+
+def test_loop_lists_share_items():
+    base = PersistentList([1, 2])
+    appended, = AppendList().appending(base, 3)
+    assert isinstance(appended, PersistentList) and appended == [1, 2, 3]
+    assert appended._items is base._items
+    concatenated, = ConcatList().concat(True, appended, [4])
+    assert isinstance(concatenated, PersistentList) and concatenated == [1, 2, 3, 4]
+    assert list(base) == [1, 2]
+
+
+def test_reduce_close_returns_plain_lists():
+    values = [torch.full((1, 2, 2, 3), float(i)) for i in range(3)]
+    final_list, final_batch = LoopReduceClose().loop_close(
+        ["open", 0], TensorList.of(values, capacity=3), 3, iteration_count=2, dynprompt=DynPrompt()
+    )
+    assert type(final_list) is list
+    assert torch.equal(torch.cat(final_list), final_batch)
+    final_list, final_batch = LoopReduceClose().loop_close(
+        ["open", 0], PersistentList([1, 2, 3]), 2, iteration_count=1, dynprompt=DynPrompt()
+    )
+    assert final_list == [2, 3] and type(final_list) is list and final_batch is None
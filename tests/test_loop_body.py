@@ -0,0 +1,106 @@
+import gc
+import sys
+import time
+
+from nodes import NODE_CLASS_MAPPINGS
+
+from loop_image.loop_body import LoopBodyCache, discover_loop_body
+
+
+class PreviewStub:
+    OUTPUT_NODE = True
+
+
+NODE_CLASS_MAPPINGS.setdefault("PreviewStub", PreviewStub)
+
+
+class DynPrompt:
+    """只实现循环体发现用到的接口，并统计节点查询次数"""
+
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.lookups = 0
+
+    def get_node(self, node_id):
+        self.lookups += 1
+        return self.prompt[node_id]
+
+    def get_display_node_id(self, node_id):
+        return node_id
+
+    def get_original_prompt(self):
+        return self.prompt
+
+
+def chain_prompt(length):
+    """
+    开始节点 -> length个处理节点 -> 结束节点
+    每个处理节点还连接前两个节点，每10个节点挂一个输出节点，另有一个循环外的上游节点
+    """
+    prompt = {
+        "source": {"class_type": "Source", "inputs": {}},
+        "open": {"class_type": "Open", "inputs": {"image": ["source", 0]}},
+    }
+    previous = ["open", "open"]
+    for i in range(length):
+        node_id = f"n{i}"
+        prompt[node_id] = {"class_type": "Proc", "inputs": {
+            "a": [previous[-1], 0], "b": [previous[-2], 0], "strength": 0.5,
+        }}
+        if i % 10 == 0:
+            prompt[f"preview{i}"] = {"class_type": "PreviewStub", "inputs": {"images": [node_id, 0]}}
+        previous.append(node_id)
+    prompt["close"] = {"class_type": "Close", "inputs": {"flow_control": ["open", 0], "image": [previous[-1], 0]}}
+    return prompt
+
+
+def discover_time(length, repeats=5):
+    """多次运行取最短耗时，计时期间关闭垃圾回收以免其停顿干扰比较"""
+    prompt = chain_prompt(length)
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            discover_loop_body(DynPrompt(prompt), "open", "close", ("Close",))
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+
+def test_discovery_finds_body_and_output_nodes():
+    dynprompt = DynPrompt(chain_prompt(100))
+    body = discover_loop_body(dynprompt, "open", "close", ("Close",))
+    node_ids = [node_id for node_id, _, _ in body.nodes]
+    assert set(node_ids) == {"open", "close"} | {f"n{i}" for i in range(100)} | {f"preview{i}" for i in range(0, 100, 10)}
+    assert "source" not in node_ids
+    inputs = dict((node_id, inputs) for node_id, _, inputs in body.nodes)
+    assert ("image", ["source", 0], False) in inputs["open"]
+    assert ("a", ["open", 0], True) in inputs["n0"]
+
+
+def test_discovery_is_linear_in_prompt_size():
+    # 每个节点只被查询常数次
+    for length in (10_000, 40_000):
+        dynprompt = DynPrompt(chain_prompt(length))
+        discover_loop_body(dynprompt, "open", "close", ("Close",))
+        assert dynprompt.lookups <= 5 * len(dynprompt.prompt)
+    # 规模扩大8倍，平方增长时耗时为64倍，线性时约8倍，留出计时抖动和缓存效应的余量
+    assert discover_time(40_000) < 24 * discover_time(5_000)
+
+
+def test_discovery_is_not_limited_by_recursion_depth():
+    length = 5 * sys.getrecursionlimit()
+    body = discover_loop_body(DynPrompt(chain_prompt(length)), "open", "close", ("Close",))
+    assert sum(1 for _, class_type, _ in body.nodes if class_type == "Proc") == length
+
+
+def test_cache_reuses_body_for_later_iterations():
+    cache = LoopBodyCache()
+    dynprompt = DynPrompt(chain_prompt(50))
+    body_key, body = cache.lookup(dynprompt, "open", "close", exclude_types=("Close",))
+    lookups = dynprompt.lookups
+    assert cache.lookup(dynprompt, "open", "close", body_key, ("Close",)) == (body_key, body)
+    assert dynprompt.lookups == lookups
+    assert cache.stats()["hits"] == 1
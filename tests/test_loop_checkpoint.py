@@ -0,0 +1,91 @@
+import os
+
+import pytest
+import torch
+
+from loop_image.flow_control import LoopReduceClose
+from loop_image.loop_checkpoint import (checkpoint_path, load_checkpoint, load_checkpoint_parts, prompt_fingerprint,
+                                        remove_checkpoint, save_checkpoint, save_checkpoint_part, unloadable_types)
+from loop_image.persistent_list import PersistentList, list_schema
+
+
+class DynPrompt:
+    def __init__(self, prompt):
+        self.prompt = prompt
+
+    def get_original_prompt(self):
+        return self.prompt
+
+
+class ReduceDynPrompt(DynPrompt):
+    def __init__(self):
+        super().__init__({"open": {"class_type": "LoopReduceOpen", "inputs": {"input_size": 4}}})
+
+    def get_display_node_id(self, node_id):
+        return node_id
+
+
+def loop_prompt(filename="a.png", resume=False, steps=20):
+    return {
+        "load": {"class_type": "LoadImage", "inputs": {"image": filename}},
+        "open": {"class_type": "Open", "inputs": {"image": ["load", 0], "resume": resume, "checkpoint_dir": "ckpt"}},
+        "body": {"class_type": "Sampler", "inputs": {"image": ["open", 1], "steps": steps}},
+        "close": {"class_type": "Close", "inputs": {"flow_control": ["open", 0], "image": ["body", 0]}},
+    }
+
+
+def test_fingerprint_covers_loop_inputs_only():
+    fingerprint = prompt_fingerprint(DynPrompt(loop_prompt()), "open")
+    # resume / checkpoint_dir and the loop body do not change the loop inputs
+    assert prompt_fingerprint(DynPrompt(loop_prompt(resume=True)), "open") == fingerprint
+    assert prompt_fingerprint(DynPrompt(loop_prompt(steps=30)), "open") == fingerprint
+    assert prompt_fingerprint(DynPrompt(loop_prompt("b.png")), "open") != fingerprint
+
+
+def test_mismatched_fingerprint_is_ignored(tmp_path):
+    path = checkpoint_path(str(tmp_path), "open")
+    save_checkpoint(path, {"iteration": 2, "max_iterations": 5, "fingerprint": "job-a"})
+    assert load_checkpoint(path, max_iterations=5, fingerprint="job-b") is None
+    assert load_checkpoint(path, max_iterations=5, fingerprint="job-a")["iteration"] == 2
+
+
+def test_parts_are_written_per_iteration_and_removed(tmp_path):
+    path = checkpoint_path(str(tmp_path), "open")
+    for index in range(3):
+        save_checkpoint_part(path, index, {"images": torch.full((2, 4, 4, 3), float(index))})
+        save_checkpoint(path, {"iteration": index})
+    parts = load_checkpoint_parts(path, 3)
+    assert [float(part["images"][0, 0, 0, 0]) for part in parts] == [0.0, 1.0, 2.0]
+    with pytest.raises(RuntimeError):
+        load_checkpoint_parts(path, 4)
+    remove_checkpoint(path)
+    assert os.listdir(tmp_path) == []
+
+
+class Opaque:
+    pass
+
+
+def test_unloadable_list_values_are_detected_before_saving():
+    assert unloadable_types(list_schema([1, "a", torch.zeros(1), [1.5, None], {"k": 1}])) == set()
+    assert unloadable_types(list_schema([1, Opaque()])) == {Opaque}
+    assert unloadable_types(list_schema([[Opaque()]])) == {Opaque}
+
+
+def test_reduce_loop_skips_checkpoints_it_could_not_resume_from(tmp_path, capsys):
+    close = LoopReduceClose()
+    options = {"checkpoint_dir": str(tmp_path), "dynprompt": ReduceDynPrompt(), "unique_id": "close"}
+    close.loop_close(["open", 0], PersistentList([1]), 4, iteration_count=0, unrolled=True, **options)
+    path = checkpoint_path(str(tmp_path), "open")
+    assert load_checkpoint(path)["previous_list"] == [1]
+    close.loop_close(["open", 0], PersistentList([1, Opaque()]), 4, iteration_count=1, unrolled=True, **options)
+    assert "cannot be restored (Opaque)" in capsys.readouterr().out
+    # the last restorable checkpoint is kept
+    assert load_checkpoint(path)["iteration"] == 0
+
+
+def test_unreadable_checkpoints_are_reported(tmp_path, capsys):
+    path = checkpoint_path(str(tmp_path), "open")
+    save_checkpoint(path, {"iteration": 0, "previous_list": [Opaque()]})
+    assert load_checkpoint(path) is None
+    assert "Ignoring unreadable loop checkpoint" in capsys.readouterr().out
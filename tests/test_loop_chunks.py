@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from graph_executor import Executor, batch_loop_prompt, sample_inputs
+
+
+def run_chunks(chunk_size, close_chunk_size=None, **close):
+    image, mask = sample_inputs()
+    prompt = batch_loop_prompt(image, mask, open={"chunk_size": chunk_size},
+                               close={"chunk_size": close_chunk_size or chunk_size, **close})
+    executor = Executor(prompt)
+    return executor, executor.run("close")
+
+
+@pytest.mark.parametrize("chunk_size,iterations", [(1, 5), (2, 3), (3, 2), (5, 1), (8, 1)])
+def test_chunks_take_ceil_n_over_k_iterations(chunk_size, iterations):
+    executor, (images, masks, _, _) = run_chunks(chunk_size)
+    assert executor.run("open")[3] == iterations
+    assert executor.expansions == iterations - 1
+    # 最后一块不满时结果按区域数量截断
+    _, (single_images, single_masks, _, _) = run_chunks(1)
+    assert torch.equal(images, single_images)
+    assert torch.equal(masks, single_masks)
+
+
+def test_last_chunk_holds_the_remaining_regions():
+    executor, _ = run_chunks(2)
+    # 5个区域分为2、2、1，最后一次迭代的块只有一个区域
+    sizes = [value[0].shape[0] for node_id, value in executor.outputs.items() if node_id.endswith("body")]
+    assert sizes == [2, 2, 1]
+
+
+def test_chunk_size_mismatch_raises():
+    with pytest.raises(ValueError, match="chunk_size must match"):
+        run_chunks(2, close_chunk_size=1)
+    with pytest.raises(ValueError, match="chunk_size must match"):
+        run_chunks(2, close_chunk_size=3)
+
+
+def test_pass_back_replaces_image_j_of_the_next_chunk():
+    _, (images, _, _, _) = run_chunks(2, pass_back=True)
+    original, _ = sample_inputs()
+    once = (original[0] + 1) / 2
+    twice = (once + 1) / 2
+    # 第一块：原图；第二块的第j张为第一块的第j个结果；最后一块只有一张，为第二块的第0个结果
+    for index, expected in enumerate([once, once, twice, twice, (twice + 1) / 2]):
+        assert torch.allclose(images[index], expected)
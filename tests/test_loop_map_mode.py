@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from graph_executor import Executor, batch_loop_prompt, sample_inputs
+
+
+def run_batch(**close):
+    image, mask = sample_inputs()
+    prompt = batch_loop_prompt(image, mask, split={"crop_to_bbox": True}, close={"bboxes": ["split", 3], **close})
+    executor = Executor(prompt)
+    return executor, executor.run("close")
+
+
+@pytest.mark.parametrize("map_window,expansions", [(0, 1), (2, 2), (3, 2), (10, 1)])
+def test_map_mode_matches_plain_run(map_window, expansions):
+    _, (images, masks, _, _) = run_batch()
+    executor, (mapped_images, mapped_masks, _, _) = run_batch(map_mode=True, map_window=map_window)
+    assert torch.equal(images, mapped_images)
+    assert torch.equal(masks, mapped_masks)
+    # 剩余的4次迭代按窗口展开
+    assert executor.expansions == expansions
+
+
+def test_map_mode_open_copies_do_not_depend_on_each_other():
+    executor, _ = run_batch(map_mode=True)
+    opens = {node_id: node for node_id, node in executor.dynprompt.ephemeral_prompt.items()
+             if node["class_type"] == "CyberEve_BatchImageLoopOpen"}
+    assert len(opens) == 4
+    for node in opens.values():
+        assert "previous_image" not in node["inputs"]
+
+
+def test_map_mode_rejects_pass_back():
+    with pytest.raises(ValueError, match="map_mode requires pass_back"):
+        run_batch(map_mode=True, pass_back=True)
@@ -0,0 +1,96 @@
+import pytest
+import torch
+
+from loop_image import loop_state
+from loop_image.flow_control import BatchImageLoopClose
+from loop_image.loop_state import (LOOP_STATE_STORE, LoopStateStore, MaskStore, allocate_buffer, convert_buffer,
+                                   spill_location)
+
+from graph_executor import DynPrompt
+
+
+def test_spilled_buffers_convert_into_spilled_buffers(tmp_path, monkeypatch):
+    # 小的分块，确保按块转换
+    monkeypatch.setattr(loop_state, "CONVERT_CHUNK_BYTES", 1024)
+    images = torch.rand((7, 8, 8, 3))
+    buffer = allocate_buffer(images.shape, torch.float16, spill_dir=str(tmp_path))
+    buffer[:] = images
+    result = convert_buffer(buffer[:5], torch.float32)
+    assert spill_location(result) == str(tmp_path)
+    assert torch.equal(result, images[:5].half().float())
+    assert convert_buffer(result, torch.float32) is result
+
+
+def test_memory_buffers_convert_in_memory():
+    buffer = torch.rand((3, 4, 4, 3)).half()
+    result = convert_buffer(buffer, torch.float32)
+    assert spill_location(result) is None
+    assert convert_buffer(buffer, torch.float16) is buffer
+
+
+@pytest.mark.parametrize("storage", ["float32", "uint8", "bitpacked"])
+def test_spilled_masks_decode_like_memory_masks(tmp_path, monkeypatch, storage):
+    monkeypatch.setattr(loop_state, "CONVERT_CHUNK_BYTES", 512)
+    masks = (torch.rand((6, 9, 13)) > 0.5).float()
+    spilled = MaskStore(6, 9, 13, storage, spill_dir=str(tmp_path))
+    memory = MaskStore(6, 9, 13, storage)
+    spilled.store(0, masks)
+    memory.store(0, masks)
+    dense = spilled.to_dense(torch.float32, 4)
+    assert spill_location(dense) == str(tmp_path)
+    assert torch.equal(dense, memory.to_dense()[:4])
+    assert torch.equal(memory.to_dense(), masks)
+
+
+def test_state_store_put_get_release():
+    store = LoopStateStore()
+    prompt = {}
+    first = store.put("loop", 1, {"value": 1}, prompt)
+    other = store.put("other", 3, {"value": 3}, prompt)
+    assert store.get(first) == {"value": 1}
+    # 同一个循环只保留最新一次迭代的状态
+    second = store.put("loop", 2, {"value": 2}, prompt)
+    assert store.get(second) == {"value": 2}
+    with pytest.raises(ValueError, match="no longer available"):
+        store.get(first)
+    store.release_loop("loop")
+    with pytest.raises(ValueError, match="no longer available"):
+        store.get(second)
+    assert store.get(other) == {"value": 3}
+    assert len(store) == 1
+
+
+def test_state_store_drops_states_of_earlier_prompts():
+    store = LoopStateStore()
+    stale = store.put("loop", 1, {}, {})
+    current = store.put("other", 1, {}, {})
+    with pytest.raises(ValueError, match="no longer available"):
+        store.get(stale)
+    assert store.get(current) == {}
+
+
+def test_state_store_keeps_at_most_max_loops():
+    store = LoopStateStore(max_loops=2)
+    prompt = {}
+    handles = [store.put(f"loop{i}", 1, {}, prompt) for i in range(3)]
+    assert len(store) == 2
+    with pytest.raises(ValueError, match="no longer available"):
+        store.get(handles[0])
+    assert store.get(handles[2]) == {}
+
+
+def test_close_node_errors_release_the_loop_state():
+    prompt = {}
+    other = LOOP_STATE_STORE.put("other", 1, {}, prompt)
+    handle = LOOP_STATE_STORE.put("body", 1, {"result_images": None, "result_masks": None, "merged_image": None}, prompt)
+    # 第二次迭代收到的区域数量与chunk_size不一致，结束节点出错
+    with pytest.raises(ValueError, match="chunk_size must match"):
+        BatchImageLoopClose().while_loop_close(
+            flow_control=["open", 0], current_image=torch.rand((3, 8, 8, 3)), current_mask=torch.rand((3, 8, 8)),
+            max_iterations=3, chunk_size=2, iteration_count=1, state_handle=handle, body_key="body",
+            dynprompt=DynPrompt(prompt), unique_id="close",
+        )
+    with pytest.raises(ValueError, match="no longer available"):
+        LOOP_STATE_STORE.get(handle)
+    assert LOOP_STATE_STORE.get(other) == {}
+    LOOP_STATE_STORE.release_loop("other")
@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from graph_executor import Executor, batch_loop_prompt, reduce_loop_prompt, sample_inputs, single_loop_prompt
+
+
+def run_batch(unroll_factor, crop_to_bbox=False, **close):
+    image, mask = sample_inputs()
+    if crop_to_bbox:
+        # 每个区域的裁剪图片各不相同，结果错位时可以发现
+        close["bboxes"] = ["split", 3]
+    prompt = batch_loop_prompt(image, mask, split={"crop_to_bbox": crop_to_bbox},
+                               close={"unroll_factor": unroll_factor, **close})
+    executor = Executor(prompt)
+    return executor.run("close"), executor.expansions
+
+
+def expected_expansions(iterations, unroll_factor):
+    """每次展开unroll_factor次迭代，中间副本不再展开"""
+    return -(-(iterations - 1) // unroll_factor)
+
+
+# 5个区域：1为不展开，2不能整除剩余的4次迭代，4正好一次展开，8大于剩余次数
+@pytest.mark.parametrize("unroll_factor", [2, 4, 8])
+@pytest.mark.parametrize("pass_back,crop_to_bbox", [(False, True), (True, False), (True, True)])
+def test_batch_loop_unroll_matches_single_steps(unroll_factor, pass_back, crop_to_bbox):
+    (images, masks, _, _), _ = run_batch(1, crop_to_bbox, pass_back=pass_back)
+    (unrolled_images, unrolled_masks, _, _), expansions = run_batch(unroll_factor, crop_to_bbox, pass_back=pass_back)
+    assert images.shape[0] == unrolled_images.shape[0] == 5
+    assert torch.equal(images, unrolled_images)
+    assert torch.equal(masks, unrolled_masks)
+    assert expansions == expected_expansions(5, unroll_factor)
+
+
+def test_batch_loop_pass_back_feeds_each_result_into_the_next_region():
+    (images, _, _, _), _ = run_batch(3, pass_back=True)
+    # 每个区域都以上一个区域的结果为输入，第k个结果经过了k+1次AddHalf
+    original, _ = sample_inputs()
+    expected = original
+    for k in range(5):
+        expected = (expected + 1) / 2
+        assert torch.allclose(images[k], expected[0])
+
+
+@pytest.mark.parametrize("unroll_factor", [2, 3, 7, 9])
+def test_single_loop_unroll_matches_single_steps(unroll_factor):
+    image, _ = sample_inputs()
+    final, _, iterations, _, _ = Executor(single_loop_prompt(image, 7)).run("close")
+    executor = Executor(single_loop_prompt(image, 7, close={"unroll_factor": unroll_factor}))
+    unrolled, _, unrolled_iterations, _, _ = executor.run("close")
+    assert iterations == unrolled_iterations == 7
+    assert torch.equal(final, unrolled)
+    assert executor.expansions == expected_expansions(7, unroll_factor)
+
+
+@pytest.mark.parametrize("unroll_factor", [2, 3, 6, 10])
+def test_reduce_loop_unroll_matches_single_steps(unroll_factor):
+    final_list, _ = Executor(reduce_loop_prompt(6)).run("close")
+    executor = Executor(reduce_loop_prompt(6, close={"unroll_factor": unroll_factor}))
+    unrolled_list, _ = executor.run("close")
+    assert final_list == unrolled_list == list(range(6))
+    assert type(unrolled_list) is list
+    assert executor.expansions == expected_expansions(6, unroll_factor)
+
+
+@pytest.mark.parametrize("unroll_factor", [1, 3, 4])
+def test_single_loop_unroll_keeps_history_order_and_stride(unroll_factor):
+    image, _ = sample_inputs()
+    close = {"unroll_factor": unroll_factor, "history_size": 3, "history_stride": 2, "history_storage": "float32"}
+    executor = Executor(single_loop_prompt(image, 9, close=close))
+    _, _, iterations, history_images, history_masks = executor.run("close")
+    assert iterations == 9
+    # 记录第0、2、4、6、8次迭代，保留最近3次，从旧到新
+    expected = [image]
+    for _ in range(9):
+        expected.append((expected[-1] + 1) / 2)
+    assert history_images.shape[0] == history_masks.shape[0] == 3
+    for index, iteration in enumerate([4, 6, 8]):
+        assert torch.allclose(history_images[index], expected[iteration + 1][0])
+    # IMAGE输出槽位中只有图片，迭代历史不经过展开副本之间的连接
+    for node_id, node in executor.dynprompt.ephemeral_prompt.items():
+        if node["class_type"] == "CyberEve_SingleImageLoopClose":
+            assert "history" not in node["inputs"]
+            assert executor.outputs[node_id][3] is None or isinstance(executor.outputs[node_id][3], torch.Tensor)
@@ -0,0 +1,135 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from loop_image.compact_mask import CompactMask
+from loop_image.mask_split import MaskMerge
+
+
+def sequential(original, images, masks):
+    result = original.clone()
+    for image, mask in zip(images, masks):
+        result = mask.unsqueeze(-1) * image + (1 - mask.unsqueeze(-1)) * result
+    return result
+
+
+def boxes(count, size, seed):
+    generator = torch.Generator().manual_seed(seed)
+    masks = torch.zeros((count, size, size))
+    for i in range(count):
+        x, y = torch.randint(0, size // 2, (2,), generator=generator).tolist()
+        masks[i, y:y + size // 2, x:x + size // 2] = 1.0
+    return masks
+
+
+def test_binary_masks_use_last_writer():
+    original = torch.rand((1, 48, 48, 3))
+    images = torch.rand((12, 48, 48, 3))
+    masks = boxes(12, 48, 0)
+    expected = sequential(original, images, masks)
+    assert torch.equal(MaskMerge().merge_masked_images(original, images, masks)[0], expected)
+    assert torch.equal(MaskMerge().composite(original.clone(), images, masks), expected)
+
+
+def test_soft_masks_match_sequential_blending():
+    original = torch.rand((1, 32, 32, 3))
+    images = torch.rand((6, 32, 32, 3))
+    masks = boxes(6, 32, 1) * torch.rand((6, 32, 32))
+    expected = sequential(original, images, masks)
+    assert torch.allclose(MaskMerge().merge_masked_images(original, images, masks)[0], expected, atol=1e-6)
+    assert torch.allclose(MaskMerge().composite(original.clone(), images, masks), expected, atol=1e-6)
+
+
+def test_source_indices_composite_each_frame():
+    original = torch.rand((2, 32, 32, 3))
+    images = torch.rand((5, 32, 32, 3))
+    masks = boxes(5, 32, 2)
+    source_indices = [0, 1, 0, 1, 1]
+    result = MaskMerge().merge_masked_images(original, images, masks, source_indices)[0]
+    for frame in range(2):
+        selected = [i for i, source in enumerate(source_indices) if source == frame]
+        expected = sequential(original[frame:frame + 1], images[selected], masks[selected])
+        assert torch.equal(result[frame:frame + 1], expected)
+
+
+def test_inputs_are_never_modified():
+    original = torch.rand((1, 32, 32, 3))
+    images = torch.rand((4, 32, 32, 3))
+    masks = boxes(4, 32, 3)
+    before = original.clone()
+    out = torch.empty_like(original)
+    result = MaskMerge().merge_masked_images(original, images, masks, out=out)[0]
+    assert result is out
+    assert torch.equal(original, before)
+    assert torch.equal(result, sequential(original, images, masks))
+
+
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16])
+def test_index_map_is_exact_beyond_half_precision_range(dtype):
+    # bfloat16只能精确表示256以内的整数，float16为2048
+    count = 2100 if dtype == torch.float16 else 300
+    original = torch.rand((1, 16, 16, 3))
+    images = torch.rand((count, 16, 16, 3))
+    masks = boxes(count, 16, 4)
+    expected = sequential(original, images, masks)
+    assert torch.equal(MaskMerge().composite(original.clone(), images, masks.to(dtype)), expected)
+
+
+def full_frame(crops, crop_masks, bboxes, original):
+    """把裁剪结果放回整帧：区域外图片取原图、蒙版为0"""
+    images = original.expand(len(bboxes), -1, -1, -1).clone()
+    masks = torch.zeros(images.shape[:3])
+    for i, (x, y, w, h) in enumerate(bboxes):
+        images[i, y:y + h, x:x + w] = crops[i]
+        masks[i, y:y + h, x:x + w] = crop_masks[i]
+    return images, masks
+
+
+def test_crop_paste_matches_full_frame_merge():
+    original = torch.rand((1, 40, 40, 3))
+    bboxes = [(0, 0, 16, 12), (20, 5, 16, 12), (10, 25, 16, 12), (6, 4, 16, 12)]
+    crops = torch.rand((4, 12, 16, 3))
+    crop_masks = torch.rand((4, 12, 16))
+    images, masks = full_frame(crops, crop_masks, bboxes, original)
+    result = MaskMerge().merge_masked_images(original, crops, crop_masks, bboxes=bboxes)[0]
+    assert torch.allclose(result, sequential(original, images, masks), atol=1e-6)
+
+
+def test_compact_paste_matches_full_frame_merge():
+    original = torch.rand((2, 40, 40, 3))
+    images = torch.rand((5, 40, 40, 3))
+    masks = boxes(5, 40, 5)
+    source_indices = [1, 0, 1, 1, 0]
+    compact = CompactMask.from_dense(masks)
+    result = MaskMerge().merge_masked_images(original, images, source_indices=source_indices, compact_masks=compact)[0]
+    expected = MaskMerge().composite(original[1:].clone(), images[[0, 2, 3]], masks[[0, 2, 3]])
+    assert torch.equal(result[1:], expected)
+    expected = MaskMerge().composite(original[:1].clone(), images[[1, 4]], masks[[1, 4]])
+    assert torch.equal(result[:1], expected)
+    # 裁剪模式的紧凑蒙版按bboxes贴回
+    bboxes = [(0, 0, 16, 12), (20, 5, 16, 12), (10, 25, 16, 12)]
+    crops = torch.rand((3, 12, 16, 3))
+    crop_masks = (torch.rand((3, 12, 16)) > 0.5).float()
+    result = MaskMerge().merge_masked_images(original[:1], crops, bboxes=bboxes,
+                                             compact_masks=CompactMask.from_dense(crop_masks))[0]
+    images, masks = full_frame(crops, crop_masks, bboxes, original[:1])
+    assert torch.allclose(result, sequential(original[:1], images, masks), atol=1e-6)
+
+
+@pytest.mark.parametrize("size", [(20, 30), (50, 45)], ids=["upscale", "downscale"])
+def test_resize_path_matches_full_resize(size):
+    original = torch.rand((1, 40, 40, 3))
+    images = torch.rand((3, *size, 3))
+    masks = torch.zeros((3, *size))
+    masks[0, 2:8, 3:9] = 1.0
+    masks[1, 10:18, 12:20] = torch.rand((8, 8))
+    masks[2, 5:12, 5:25] = 1.0
+    resized_images = F.interpolate(images.permute(0, 3, 1, 2), size=(40, 40), mode="bilinear",
+                                   align_corners=False).permute(0, 2, 3, 1)
+    resized_masks = F.interpolate(masks.unsqueeze(1), size=(40, 40), mode="bilinear", align_corners=False).squeeze(1)
+    result = MaskMerge().merge_masked_images(original, images, masks)[0]
+    assert torch.allclose(result, sequential(original, resized_images, resized_masks), atol=1e-5)
+    # 只采样窗口内的值与整张resize后裁剪一致
+    window = (7, 3, 31, 22)
+    region = MaskMerge().sample_region(images, (40, 40), window)
+    assert torch.allclose(region, resized_images[:, 3:22, 7:31], atol=1e-6)
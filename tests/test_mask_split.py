@@ -0,0 +1,113 @@
+import torch
+
+from loop_image.mask_split import MaskSplit
+
+
+def squares(*frames, size=32):
+    """每帧一组 (x, y, 边长) 的正方形区域"""
+    mask = torch.zeros((len(frames), size, size))
+    for index, boxes in enumerate(frames):
+        for x, y, side in boxes:
+            mask[index, y:y + side, x:x + side] = 1.0
+    return mask
+
+
+def split(mask, image=None, **options):
+    if image is None:
+        image = torch.rand((mask.shape[0], mask.shape[1], mask.shape[2], 3))
+    return MaskSplit().segment_mask(mask, image, use_cache=False, **options)
+
+
+def test_batch_mode_splits_every_frame_with_source_indices():
+    mask = squares([(2, 2, 4), (20, 4, 6)], [], [(10, 10, 5)])
+    image = torch.rand((3, 32, 32, 3))
+    images, masks, source_indices, _, _ = split(mask, image, batch_mode=True)
+    assert source_indices == [0, 0, 2]
+    for index, source in enumerate(source_indices):
+        assert torch.equal(images[index], image[source])
+        # 每个区域的蒙版都在其原图的蒙版之内
+        assert torch.equal(masks[index] * mask[source], masks[index])
+    assert torch.equal(masks.sum(0), mask.sum(0))
+
+
+def test_without_batch_mode_only_the_first_frame_is_split():
+    mask = squares([(2, 2, 4)], [(10, 10, 5), (20, 20, 3)])
+    images, masks, source_indices, _, _ = split(mask)
+    assert source_indices == [0]
+    assert torch.equal(masks[0], mask[0])
+
+
+def test_crop_to_bbox_uses_one_crop_size_clamped_to_the_canvas():
+    # 左上角和右下角的区域，窗口需要被限制在画布内
+    mask = squares([(0, 0, 4), (26, 25, 6), (12, 12, 8)])
+    image = torch.rand((1, 32, 32, 3))
+    images, masks, _, bboxes, _ = split(mask, image, crop_to_bbox=True, crop_padding=3)
+    # 最大的包围盒为8x8，加上两侧的padding
+    assert images.shape == (3, 14, 14, 3)
+    assert masks.shape == (3, 14, 14)
+    for index, (x, y, w, h) in enumerate(bboxes):
+        assert (w, h) == (14, 14)
+        assert 0 <= x <= 32 - w and 0 <= y <= 32 - h
+        assert torch.equal(images[index], image[0, y:y + h, x:x + w])
+    # 蒙版在裁剪窗口中的位置与原图一致
+    assert sorted(bboxes) == [(0, 0, 14, 14), (9, 9, 14, 14), (18, 18, 14, 14)]
+    for index, (x, y, w, h) in enumerate(bboxes):
+        full = torch.zeros((32, 32))
+        full[y:y + h, x:x + w] = masks[index]
+        assert torch.equal(full * mask[0], full)
+    assert masks.sum() == mask.sum()
+
+
+def test_crop_size_never_exceeds_the_canvas():
+    mask = squares([(4, 4, 20)], size=24)
+    images, _, _, bboxes, _ = split(mask, crop_to_bbox=True, crop_padding=16)
+    assert images.shape[1:3] == (24, 24)
+    assert bboxes == [(0, 0, 24, 24)]
+
+
+def areas(masks):
+    return [int(m.sum()) for m in masks]
+
+
+def test_min_area_and_top_k_filter_by_area():
+    # 面积 4、36、16、9、25
+    mask = squares([(0, 0, 2), (4, 4, 6), (20, 2, 4), (2, 20, 3), (20, 20, 5)])
+    _, masks, _, _, _ = split(mask, min_area=10)
+    assert sorted(areas(masks)) == [16, 25, 36]
+    # top_k保留面积最大的K个，顺序仍由sort_by决定
+    _, masks, _, _, _ = split(mask, top_k=2, sort_by="left_to_right")
+    assert areas(masks) == [36, 25]
+    _, masks, _, _, _ = split(mask, min_area=10, max_count=2, sort_by="area")
+    assert areas(masks) == [36, 25]
+
+
+def test_sort_orders():
+    # 区域以面积区分：A(4) 左上角，B(36)，C(16) 右上，D(9) 左下，E(25) 右下
+    mask = squares([(0, 0, 2), (4, 4, 6), (20, 2, 4), (2, 20, 3), (20, 20, 5)])
+    expected = {
+        "left_to_right": [4, 9, 36, 16, 25],  # 最左列最上方的点：x为0、2、4、20、20
+        "reading_order": [4, 16, 36, 9, 25],  # 包围盒左上角，先上后左
+        "area": [36, 25, 16, 9, 4],
+        "centroid_distance": [25, 36, 16, 9, 4],  # 到画面中心(15.5, 15.5)的距离
+    }
+    for sort_by, order in expected.items():
+        _, masks, _, _, _ = split(mask, sort_by=sort_by)
+        assert areas(masks) == order, sort_by
+
+
+def test_morphology_stays_inside_the_grown_bbox():
+    mask = squares([(4, 4, 6), (20, 20, 4)])
+    # 孔洞
+    mask[0, 6:8, 6:8] = 0
+    _, filled, _, _, _ = split(mask, morphology="fill_holes")
+    assert areas(filled) == [36, 16]
+    _, dilated, _, _, _ = split(mask, morphology="dilate", morph_radius=2)
+    for region, grown in zip(split(mask)[1], dilated):
+        ys, xs = torch.nonzero(region, as_tuple=True)
+        outside = grown.clone()
+        outside[ys.min() - 2:ys.max() + 3, xs.min() - 2:xs.max() + 3] = 0
+        assert outside.sum() == 0
+        assert grown.sum() > region.sum()
+    _, eroded, _, _, _ = split(mask, morphology="erode", morph_radius=1)
+    # 包围盒外视为背景，4x4的区域腐蚀为2x2
+    assert areas(eroded)[1] == 4
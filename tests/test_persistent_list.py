@@ -0,0 +1,109 @@
+import pytest
+import torch
+
+from loop_image.flow_control import ConcatList
+from loop_image.persistent_list import PersistentList, TensorList, list_schema
+
+
+def frames(count, batch=1):
+    return [torch.full((batch, 2, 3, 3), float(i)) for i in range(count)]
+
+
+def test_tensor_list_doubles_its_buffer_and_keeps_old_views():
+    values = frames(5)
+    lists = [TensorList(capacity=2)]
+    rows = []
+    for value in values:
+        lists.append(lists[-1].appended(value))
+        rows.append(lists[-1]._buffer.data.shape[0])
+    assert rows == [2, 2, 4, 4, 8]
+    # 之前交出的列表在缓冲扩容后不变
+    for count, values_list in enumerate(lists):
+        assert values_list == values[:count]
+
+
+def test_tensor_list_batches_of_several_rows():
+    values = frames(3, batch=2)
+    result = TensorList.of(values, capacity=1)
+    assert len(result) == 3
+    assert torch.equal(result[1], values[1])
+    assert torch.equal(result.as_batch(), torch.cat(values))
+
+
+def test_as_batch_is_a_view_of_the_buffer():
+    result = TensorList.of(frames(4), capacity=4)
+    batch = result.as_batch()
+    assert batch.data_ptr() == result._buffer.data.data_ptr()
+    assert torch.equal(batch, torch.cat(frames(4)))
+    # 切片同样共享缓冲
+    tail = result[1:3]
+    assert tail.as_batch().data_ptr() == result[1].data_ptr()
+    assert TensorList(capacity=2).as_batch() is None
+
+
+def test_appending_to_a_shared_view_copies_instead_of_clobbering():
+    a, b, c = frames(3)
+    base = TensorList.of([a], capacity=4)
+    first = base.appended(b)
+    second = base.appended(c)
+    assert first == [a, b]
+    assert second == [a, c]
+    assert base == [a]
+    assert second._buffer is not first._buffer
+    # 最新的列表仍然原地追加
+    third = first.appended(c)
+    assert third._buffer is first._buffer
+    assert first == [a, b] and third == [a, b, c]
+
+
+def test_tensor_list_rejects_other_values_and_shapes():
+    result = TensorList.of(frames(1))
+    with pytest.raises(ValueError, match="only holds"):
+        result.appended(1)
+    with pytest.raises(ValueError, match="share their shape"):
+        result.appended(torch.zeros((1, 4, 4, 3)))
+
+
+def test_schema_is_carried_and_extended():
+    values = PersistentList([1, 2])
+    assert values.schema == {int}
+    appended = values.appended("a")
+    assert appended.schema == {int, str}
+    # 已有的类型不产生新的schema
+    assert appended.appended(3).schema is appended.schema
+    assert values.extended(PersistentList([1.5])).schema == {int, float}
+    assert list_schema([1, [2, "b"], []]) == {int, ("LIST", frozenset({int, str})), ("LIST", frozenset())}
+    assert list_schema(values) is values.schema
+
+
+@pytest.mark.parametrize("base,add", [
+    ([1, 2], [3]),
+    ([1], [True, 2]),  # bool是int的子类
+    ([torch.zeros(1)], [torch.ones(2)]),
+    ([[1, 2]], [[3]]),
+    ([[1, 2]], [[]]),  # 空的嵌套列表可以与任何嵌套列表合并
+    ([[]], [[1]]),
+    ([[[1]]], [[[2, 3]]]),
+    (PersistentList([[1], 2]), PersistentList([2, [3]])),
+], ids=["int", "bool", "tensor", "nested", "empty_nested", "into_empty_nested", "deeply_nested", "persistent"])
+def test_concat_type_check_accepts_matching_lists(base, add):
+    result, = ConcatList().concat(True, base, add)
+    assert list(result) == list(base) + list(add)
+
+
+@pytest.mark.parametrize("base,add", [
+    ([1, 2], ["a"]),
+    ([1], [1.5]),
+    ([torch.zeros(1)], [1]),
+    ([[1, 2]], [["a"]]),
+    ([[1]], [1]),
+    ([1], [[1]]),
+    ([[[1]]], [[["a"]]]),
+    (PersistentList([1]), PersistentList([[1]])),
+], ids=["str", "float", "tensor", "nested", "unnested", "nested_into_flat", "deeply_nested", "persistent"])
+def test_concat_type_check_rejects_mismatched_lists(base, add):
+    with pytest.raises(ValueError, match="is not correspond to list_base"):
+        ConcatList().concat(True, base, add)
+    # 不检查类型时照常合并
+    result, = ConcatList().concat(False, base, add)
+    assert len(result) == len(base) + len(add)
@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from loop_image.mask_split import MaskSplit
+from loop_image.segment_cache import SegmentCache
+
+
+def test_key_depends_only_on_foreground_and_options():
+    mask = torch.zeros((2, 9, 13))
+    mask[0, 2:5, 3:7] = 1.0
+    soft = mask * 0.5
+    options = (0, 0, 0, "left_to_right", "none", 3)
+    assert SegmentCache.make_key(mask, options) == SegmentCache.make_key(soft, options)
+    assert SegmentCache.make_key(mask, options) == SegmentCache.make_key(mask.numpy(), options)
+    assert SegmentCache.make_key(mask, options) != SegmentCache.make_key(mask, options[:-1] + (5,))
+    mask[1, 0, 0] = 1.0
+    assert SegmentCache.make_key(mask, options) != SegmentCache.make_key(soft, options)
+
+
+def test_cached_segments_keep_rois_on_the_host():
+    cache = SegmentCache()
+    mask = torch.zeros((1, 16, 16))
+    mask[0, 1:4, 1:4] = 1.0
+    mask[0, 8:12, 6:15] = 1.0
+    frame_lists = MaskSplit().label_frames(mask, backend="torch")
+    cache.put("key", frame_lists)
+    cached = cache.get("key")
+    assert all(isinstance(seg.roi, np.ndarray) for seg in cached[0])
+    assert [seg.bbox for seg in cached[0]] == [seg.bbox for seg in frame_lists[0]]
+    assert all(np.array_equal(a.roi, b.roi.numpy()) for a, b in zip(cached[0], frame_lists[0]))
+    assert cache.total_bytes == sum(seg.roi.nbytes for seg in cached[0])
+
+
+def test_cache_hit_gives_the_same_outputs():
+    mask = torch.zeros((1, 32, 32))
+    mask[0, 2:10, 3:9] = 1.0
+    mask[0, 20:30, 12:28] = 1.0
+    image = torch.rand((1, 32, 32, 3))
+    node = MaskSplit()
+    first = node.segment_mask(mask, image, backend="torch")
+    second = node.segment_mask(mask, image, backend="torch")
+    assert torch.equal(first[0], second[0])
+    assert torch.equal(first[1], second[1])
+    assert first[2:4] == second[2:4]
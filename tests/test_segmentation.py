@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from loop_image.mask_split import MaskSplit
+from loop_image.segmentation import label_components, label_components_torch
+
+
+def serpentine(size):
+    """单个蛇形区域，区域内路径长度约为 size*size/2"""
+    mask = np.zeros((size, size), dtype=np.uint8)
+    mask[::2] = 1
+    for row in range(0, size - 2, 2):
+        mask[row:row + 2, size - 1 if (row // 2) % 2 == 0 else 0] = 1
+    return mask
+
+
+def spiral(size):
+    mask = np.zeros((size, size), dtype=np.uint8)
+    x0, y0, x1, y1 = 0, 0, size - 1, size - 1
+    while x0 < x1 and y0 < y1:
+        mask[y0, x0:x1 + 1] = 1
+        mask[y0:y1 + 1, x1] = 1
+        mask[y1, x0:x1 + 1] = 1
+        mask[y0 + 2:y1 + 1, x0] = 1
+        mask[y0 + 2, x0:x0 + 3] = 1
+        x0, y0, x1, y1 = x0 + 2, y0 + 2, x1 - 2, y1 - 2
+    return mask
+
+
+def random_mask(size, density, seed):
+    return (np.random.default_rng(seed).random((size, size)) < density).astype(np.uint8)
+
+
+def describe(segments):
+    """与标签顺序无关的区域描述"""
+    return sorted(
+        (seg.top_left, seg.bbox, seg.area, np.asarray(seg.roi.cpu() if isinstance(seg.roi, torch.Tensor) else seg.roi).tobytes())
+        for seg in segments
+    )
+
+
+@pytest.mark.parametrize("mask", [
+    random_mask(64, 0.3, 0),
+    random_mask(96, 0.6, 1),
+    random_mask(128, 0.5, 2),
+    serpentine(128),
+    spiral(128),
+    np.zeros((32, 32), dtype=np.uint8),
+    np.ones((32, 48), dtype=np.uint8),
+], ids=["sparse", "dense", "percolating", "serpentine", "spiral", "empty", "full"])
+def test_torch_backend_matches_opencv(mask):
+    expected = label_components(mask * 255)
+    actual = label_components_torch(torch.from_numpy(mask > 0).unsqueeze(0))[0]
+    assert describe(actual) == describe(expected)
+
+
+def test_torch_backend_labels_batches_per_frame():
+    masks = np.stack([random_mask(64, 0.5, seed) for seed in range(3)])
+    frames = label_components_torch(torch.from_numpy(masks > 0))
+    for mask, segments in zip(masks, frames):
+        assert describe(segments) == describe(label_components(mask * 255))
+
+
+def test_long_paths_converge_within_the_iteration_limit():
+    # 最小值传播需要约 size*size/2 次迭代，挂接+路径压缩只需要对数级
+    segments = label_components_torch(torch.from_numpy(serpentine(256) > 0).unsqueeze(0), max_iterations=40)[0]
+    assert len(segments) == 1
+
+
+def test_iteration_limit_falls_back_to_opencv():
+    mask = torch.from_numpy(spiral(64)).float().unsqueeze(0)
+    with pytest.raises(RuntimeError):
+        label_components_torch(mask > 0, max_iterations=1)
+    segments = MaskSplit().label_frames(mask, backend="torch")[0]
+    assert describe(segments) == describe(label_components(spiral(64) * 255))
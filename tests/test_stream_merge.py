@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from graph_executor import Executor, batch_loop_prompt, sample_inputs
+
+
+def two_frames():
+    """两帧图片，第二帧的蒙版左右翻转，区域分属不同的原图"""
+    image, mask = sample_inputs()
+    second, _ = sample_inputs(seed=1)
+    return torch.cat([image, second]), torch.cat([mask, mask.flip(2)])
+
+
+def merged(image, mask, split, close):
+    prompt = batch_loop_prompt(image, mask, split=split, close=close)
+    prompt["merge"] = {"class_type": "CyberEve_MaskMerge", "inputs": {
+        "original_image": ["img", 0], "processed_images": ["close", 0], "masks": ["close", 1],
+        "source_indices": ["split", 2],
+        **({"bboxes": ["split", 3]} if split.get("crop_to_bbox") else {}),
+    }}
+    prompt["close"]["inputs"]["original_image"] = ["img", 0]
+    prompt["close"]["inputs"]["source_indices"] = ["split", 2]
+    if split.get("crop_to_bbox"):
+        prompt["close"]["inputs"]["bboxes"] = ["split", 3]
+    executor = Executor(prompt)
+    if close.get("stream_merge"):
+        return executor.run("close")[3]
+    return executor.run("merge")[0]
+
+
+@pytest.mark.parametrize("frames", [1, 2], ids=["plain", "source_indices"])
+@pytest.mark.parametrize("crop_to_bbox", [False, True], ids=["full", "bboxes"])
+@pytest.mark.parametrize("unroll_factor", [1, 3])
+def test_stream_merge_matches_mask_merge(frames, crop_to_bbox, unroll_factor):
+    image, mask = two_frames() if frames == 2 else sample_inputs()
+    split = {"batch_mode": frames == 2, "crop_to_bbox": crop_to_bbox}
+    expected = merged(image, mask, split, {})
+    result = merged(image, mask, split, {"stream_merge": True, "unroll_factor": unroll_factor})
+    assert result.shape == image.shape
+    assert torch.allclose(result, expected, atol=1e-6)
+    # 循环体修改了每个区域，合成图与原图不同
+    assert not torch.equal(result, image)
@@ -0,0 +1,62 @@
+from loop_image.tools import SmartType, TypeSet, VariantSupport
+
+
+def make_node():
+    calls = []
+
+    @VariantSupport()
+    class Node:
+        @classmethod
+        def INPUT_TYPES(cls):
+            calls.append(1)
+            return {
+                "required": {"image": ("IMAGE",), "count": ("INT", {"default": 1})},
+                "optional": {"value": ("INT,FLOAT",), "any": ("*",)},
+                "hidden": {"unique_id": "UNIQUE_ID"},
+            }
+
+        RETURN_TYPES = ("IMAGE", "INT,FLOAT")
+
+    return Node, calls
+
+
+def test_input_types_are_normalized_once():
+    node, calls = make_node()
+    first = node.INPUT_TYPES()
+    second = node.INPUT_TYPES()
+    assert len(calls) == 1
+    assert first == second
+    assert isinstance(first["required"]["image"][0], SmartType)
+    assert all(isinstance(t, SmartType) for t in node.RETURN_TYPES)
+
+
+def test_cached_input_types_are_not_shared_with_callers():
+    node, _ = make_node()
+    types = node.INPUT_TYPES()
+    types["required"]["extra"] = ("STRING",)
+    del types["optional"]["value"]
+    types["hidden"] = {}
+    fresh = node.INPUT_TYPES()
+    assert "extra" not in fresh["required"]
+    assert "value" in fresh["optional"]
+    assert fresh["hidden"] == {"unique_id": "UNIQUE_ID"}
+
+
+def test_type_sets_are_interned():
+    assert TypeSet("INT,FLOAT") is TypeSet("INT,FLOAT")
+    assert TypeSet("INT,FLOAT") == {"INT", "FLOAT"}
+    assert not SmartType("INT") != "INT,FLOAT"
+    assert SmartType("INT,FLOAT") != "INT"
+    assert not SmartType("*") != "IMAGE"
+
+
+def test_validate_inputs():
+    node, calls = make_node()
+    validate = node.VALIDATE_INPUTS
+    assert validate({"image": "IMAGE", "count": "INT"}) is True
+    assert validate({"value": "FLOAT", "any": "LATENT"}) is True
+    assert validate({"image": "MASK"}) == "Invalid type of image: MASK (expected IMAGE)"
+    assert validate({"value": "STRING"}) == "Invalid type of value: STRING (expected INT,FLOAT)"
+    # 上游节点的SmartType由其自身检查，未知的输入不检查
+    assert validate({"image": SmartType("MASK"), "unknown": "MASK"}) is True
+    assert len(calls) == 1
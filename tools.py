@@ -1,3 +1,12 @@
+_TYPE_SETS = {}
+
+def TypeSet(t):
+    # interned set of the comma-separated types in t, parsed once per distinct string
+    type_set = _TYPE_SETS.get(t)
+    if type_set is None:
+        type_set = _TYPE_SETS[t] = frozenset(t.split(','))
+    return type_set
+
 def MakeSmartType(t):
     if isinstance(t, str):
         return SmartType(t)
@@ -7,23 +16,22 @@ class SmartType(str):
     def __ne__(self, other):
         if self == "*" or other == "*":
             return False
-        selfset = set(self.split(','))
-        otherset = set(other.split(','))
-        return not selfset.issubset(otherset)
+        return not TypeSet(self).issubset(TypeSet(other))
 
 def VariantSupport():
     def decorator(cls):
         if hasattr(cls, "INPUT_TYPES"):
             old_input_types = getattr(cls, "INPUT_TYPES")
+            # the input types of the nodes are static, normalize them once and reuse the result
+            cache = {}
             def new_input_types(*args, **kwargs):
-                types = old_input_types(*args, **kwargs)
-                for category in ["required", "optional"]:
-                    if category not in types:
-                        continue
-                    for key, value in types[category].items():
-                        if isinstance(value, tuple):
-                            types[category][key] = (MakeSmartType(value[0]),) + value[1:]
-                return types
+                if args or kwargs:
+                    return normalize_input_types(old_input_types(*args, **kwargs))
+                if "types" not in cache:
+                    cache["types"] = normalize_input_types(old_input_types())
+                # a copy of each category, callers may add or remove inputs without touching the cache
+                return {category: dict(inputs) if isinstance(inputs, dict) else inputs
+                        for category, inputs in cache["types"].items()}
             setattr(cls, "INPUT_TYPES", new_input_types)
         if hasattr(cls, "RETURN_TYPES"):
             old_return_types = cls.RETURN_TYPES
@@ -32,17 +40,18 @@ def VariantSupport():
             # Reflection is used to determine what the function signature is, so we can't just change the function signature
             raise NotImplementedError("VariantSupport does not support VALIDATE_INPUTS yet")
         else:
+            expected_types = {}
             def validate_inputs(input_types):
-                inputs = cls.INPUT_TYPES()
+                if not expected_types:
+                    inputs = cls.INPUT_TYPES()
+                    # optional entries first so required ones win, as in the lookup order before
+                    for category in ["optional", "required"]:
+                        for key, value in inputs.get(category, {}).items():
+                            expected_types[key] = value[0]
                 for key, value in input_types.items():
                     if isinstance(value, SmartType):
                         continue
-                    if "required" in inputs and key in inputs["required"]:
-                        expected_type = inputs["required"][key][0]
-                    elif "optional" in inputs and key in inputs["optional"]:
-                        expected_type = inputs["optional"][key][0]
-                    else:
-                        expected_type = None
+                    expected_type = expected_types.get(key)
                     if expected_type is not None and MakeSmartType(value) != expected_type:
                         return f"Invalid type of {key}: {value} (expected {expected_type})"
                 return True
@@ -50,3 +59,11 @@ def VariantSupport():
         return cls
     return decorator
 
+def normalize_input_types(types):
+    for category in ["required", "optional"]:
+        if category not in types:
+            continue
+        for key, value in types[category].items():
+            if isinstance(value, tuple):
+                types[category][key] = (MakeSmartType(value[0]),) + value[1:]
+    return types